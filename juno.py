@@ -1,13 +1,39 @@
 # Built in library imports
+import abc
+import asyncio
+import collections
+import contextvars
+import functools
+import gzip
+import hashlib
+import html
+import inspect
+import io
+import itertools
+import json
 import mimetypes
+import mmap
 import re
 import os
+import shutil
+import stat
 import sys
+import threading
 import traceback
 import time
 # Server imports
+import concurrent.futures
+import email.utils
+import http.cookies
+import queue
+import select
+import selectors
+import signal
+import socket
+import sqlite3
+import struct
+import tempfile
 import urllib.parse
-import cgi
 
 class Juno(object):
     def __init__(self, configuration=None):
@@ -18,12 +44,23 @@ class Juno(object):
             print('         you might get some weird behavior.', file=sys.stderr)
         else: _hub = self
         self.routes = []
+        self.route_index = None
+        self.view_executor = None
+        self.static_cache = None
+        self.output_cache = None
+        self.fragment_cache = None
+        # (code, template file) => (template object, page parts), see get_error_page()
+        self.error_pages = {}
+        # The compiled JunoSettings (see get_settings())
+        self.settings = None
         # Find the directory of the user's app, so we can setup static/template_roots
         self.find_user_path(configuration)
         # Set options and merge in user-set options
         self.config = {
                 # General settings / meta information
                 'log':    True,
+                # Most errors logged a second (0: no limit), see log_error()
+                'log_rate_limit': 10,
                 'routes': self.routes,
                 'self':   self,
                 # Types and encodings
@@ -34,32 +71,84 @@ class Juno(object):
                 'scgi_port': 8000,
                 'fcgi_port': 8000,
                 'dev_port':  8000,
+                'threaded_port': 8000,
                 'bind_address': '127.0.0.1',
+                'server_threads':   16,
+                'server_backlog':   128,
+                'server_timeout':   30,
+                'server_keepalive': 5,
+                'prefork_workers':          None,
+                'prefork_max_requests':     0,
+                'prefork_reuseport':        False,
+                'prefork_graceful_timeout': 30,
+                # Request bodies (see parse_form())
+                'max_body_size':     100 * 1024 * 1024,
+                'max_form_parts':    1000,
+                'max_field_size':    1024 * 1024,
+                'upload_spool_size': 1024 * 1024,
+                'upload_dir':        None,
+                'max_json_size':     10 * 1024 * 1024,
+                # JSON (see web.json())
+                'use_orjson': True,
                 # Static file handling
                 'use_static':     True,
                 'static_url':     '/static/*:file/',
                 'static_root':    os.path.join(self.app_path, 'static/'),
                 'static_handler': static_serve,
                 'static_expires': 0,
+                'static_cache_control': None,
+                'static_cache_size':      32 * 1024 * 1024,
+                'static_cache_file_size': 256 * 1024,
+                'static_cache_check':     0,
+                # Output cache (see cached())
+                'output_cache_size':    64 * 1024 * 1024,
+                'output_cache_backend': 'memory',
+                'output_cache_path':    None,
+                # Template fragment cache (see cache_fragment())
+                'fragment_cache_size':  16 * 1024 * 1024,
+                # Compression
+                'use_compression':         True,
+                'compress_min_size':       1024,
+                'compress_level':          6,
+                'compress_brotli_quality': 5,
+                'compress_types':          ['text/', 'application/json',
+                                            'application/javascript',
+                                            'application/xml', 'image/svg+xml'],
                 # Template options
                 'use_templates':           False,
                 'template_lib':            'jinja2',
                 'get_template_handler':    _get_template_handler,
                 'render_template_handler': _render_template_handler,
+                'stream_template_handler': _stream_template_handler,
+                'stream_templates':        False,
+                'template_chunk_size':     8192,
                 'auto_reload_templates':   True,
                 'translations':            [],
                 'template_kwargs':         {},
                 'template_root':           os.path.join(self.app_path, 'templates/'),
+                # 'production' compiles templates at startup (see setup_templates())
+                'template_mode':            'dev',
+                'template_cache_dir':       None,
+                'template_compile_workers': 0,
                 '404_template':            '404.html',
                 '500_template':            '500.html',
                 '404_mimetype':            None,
                 '500_mimetype':            None,
                 '500_traceback':           False,
+                '500_show_traceback':      True,
+                'cache_error_pages':       True,
                 # Database options
                 'use_db':      False,
                 'db_type':     'sqlite',
                 'db_location': ':memory:',
                 'db_models':   {},
+                # Connection pool (see setup_database())
+                'db_pool_size':     5,
+                'db_max_overflow':  10,
+                'db_pool_timeout':  30,
+                'db_pool_recycle':  -1,
+                'db_pool_pre_ping': False,
+                'db_kwargs':        {},
                 # Session options
                 'use_sessions': False,
                 'session_lib':  'beaker',
@@ -116,7 +205,33 @@ class Juno(object):
     def setup_static(self):
         self.route(self.config['static_url'], self.config['static_handler'], '*')
 
+    def get_static_cache(self):
+        """The JunoStaticCache static_serve() and yield_file() use."""
+        if self.static_cache is None:
+            self.static_cache = JunoStaticCache(self.config['static_cache_size'],
+                                                self.config['static_cache_file_size'],
+                                                self.config['static_cache_check'])
+        return self.static_cache
+
+    def get_settings(self):
+        """The JunoSettings snapshot of self.config the request path reads.
+        Compiled by run(), and again after config() changes an option."""
+        if self.settings is None: self.settings = JunoSettings(self.config)
+        return self.settings
+
     def setup_templates(self):
+        # In production mode templates are compiled once, at startup, and
+        # never checked for changes
+        production = self.config['template_mode'] == 'production'
+        auto_reload = self.config['auto_reload_templates'] and not production
+        cache_dir = self.config['template_cache_dir']
+        if cache_dir is None and production:
+            # Shared by every worker of the app; private to this user, since
+            # the cached bytecode and modules are loaded as code
+            name = hashlib.md5(os.path.abspath(self.config['template_root']).encode()).hexdigest()
+            cache_dir = self.config['template_cache_dir'] = os.path.join(
+                private_tempdir('juno-templates'), name[:12])
+        if cache_dir: os.makedirs(cache_dir, 0o700, exist_ok=True)
         if self.config['template_lib'] == 'jinja2':
             import jinja2
             # If the user specified translation objects, load i18n extension
@@ -124,36 +239,106 @@ class Juno(object):
                 extensions = ['jinja2.ext.i18n']
             else:
                 extensions = []
-            kwargs = self.config['template_kwargs']
+            # {% cache %} blocks
+            extensions.append(jinja2_cache_extension())
+            kwargs = dict(self.config['template_kwargs'])
             if 'extensions' in kwargs: extensions.extend(kwargs['extensions'])
+            if cache_dir and 'bytecode_cache' not in kwargs:
+                kwargs['bytecode_cache'] = jinja2.FileSystemBytecodeCache(cache_dir)
+            # Keep every compiled template, not just the last 400 used
+            if production and 'cache_size' not in kwargs: kwargs['cache_size'] = -1
             kwargs.update({
                 'loader'      : jinja2.FileSystemLoader(
                                 searchpath = self.config['template_root'],
                                 encoding   = self.config['charset'],
                               ),
-                'auto_reload' : self.config['auto_reload_templates'],
+                'auto_reload' : auto_reload,
                 'extensions' : extensions
             })
             env = self.config['template_env'] = jinja2.Environment(**kwargs)
             for translation in self.config['translations']:
                 env.install_gettext_translations(translation)
         if self.config['template_lib'] == 'mako':
+            import mako.cache
             import mako.lookup
-            self.config['template_env'] = mako.lookup.TemplateLookup(
-                directories       = [self.config['template_root']],
-                input_encoding    = self.config['charset'],
-                output_encoding   = self.config['charset'],
-                filesystem_checks = self.config['auto_reload_templates'],
-                **self.config['template_kwargs']
-            )
+            # Cached blocks and defs go in the fragment cache
+            mako.cache.register_plugin('juno', __name__, 'JunoMakoCache')
+            kwargs = {
+                'directories'       : [self.config['template_root']],
+                'input_encoding'    : self.config['charset'],
+                'output_encoding'   : self.config['charset'],
+                'filesystem_checks' : auto_reload,
+                'module_directory'  : cache_dir,
+                'cache_impl'        : 'juno',
+            }
+            kwargs.update(self.config['template_kwargs'])
+            self.config['template_env'] = mako.lookup.TemplateLookup(**kwargs)
+        if production: self.precompile_templates()
+
+    def template_names(self):
+        """The names of the templates under 'template_root', skipping hidden
+        files and directories."""
+        root = self.config['template_root']
+        names = []
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+            for filename in filenames:
+                if filename.startswith('.'): continue
+                path = os.path.relpath(os.path.join(dirpath, filename), root)
+                names.append(path.replace(os.sep, '/'))
+        return sorted(names)
+
+    def precompile_templates(self):
+        """Compiles every template under 'template_root', so no request has to.
+        With 'template_compile_workers' > 1 (and a 'template_cache_dir'),
+        forked processes share the compiling, through the cache.  Returns the
+        number of templates compiled."""
+        start = time.time()
+        names = self.template_names()
+        workers = self.config['template_compile_workers']
+        if workers > 1 and len(names) > 1 and self.config['template_cache_dir'] \
+            and hasattr(os, 'fork'):
+            pids = []
+            for n in range(1, workers):
+                pid = os.fork()
+                if pid == 0:
+                    # The child only fills the cache; whatever it misses, the
+                    # parent compiles below
+                    try: self.compile_templates(names[n::workers], False)
+                    finally: os._exit(0)
+                pids.append(pid)
+            self.compile_templates(names[::workers])
+            for pid in pids: os.waitpid(pid, 0)
+        # Loads what the children compiled from the cache
+        compiled = self.compile_templates(names)
+        if self.config['log']:
+            print('Compiled %d templates in %.2fs' %(compiled, time.time() - start))
+        return compiled
+
+    def compile_templates(self, names, warn=True):
+        """Loads (compiling if need be) the named templates into the template
+        environment.  Returns how many of them compiled."""
+        env = self.config['template_env']
+        compiled = 0
+        for name in names:
+            try: env.get_template(name)
+            except Exception as e:
+                if warn: print('Warning: template %s failed to compile: %s' %(name, e), file=sys.stderr)
+            else: compiled += 1
+        return compiled
 
     def setup_database(self):
         # DB library imports
         from sqlalchemy import (create_engine, Table, MetaData, Column, Integer,
                                 String, Unicode, Text, UnicodeText, Date, Numeric,
-                                Time, Float, DateTime, Interval, Binary, Boolean,
+                                Time, Float, DateTime, Interval, LargeBinary, Boolean,
                                 PickleType)
-        from sqlalchemy.orm import sessionmaker, mapper, scoped_session
+        from sqlalchemy.orm import sessionmaker, scoped_session
+        # Classical mapping went from mapper() to a registry in SQLAlchemy 1.4
+        try:
+            from sqlalchemy.orm import registry
+            mapper = registry().map_imperatively
+        except ImportError: from sqlalchemy.orm import mapper
         # Create global name mappings for model()
         global column_mapping
         column_mapping = {'string': String,       'str': String,
@@ -162,7 +347,7 @@ class Juno(object):
                      'unicodetext': UnicodeText, 'date': Date,
                          'numeric': Numeric,     'time': Time,
                            'float': Float,   'datetime': DateTime,
-                        'interval': Interval,  'binary': Binary,
+                        'interval': Interval,  'binary': LargeBinary,
                          'boolean': Boolean,     'bool': Boolean,
                       'pickletype': PickleType,
         }
@@ -173,8 +358,18 @@ class Juno(object):
         if self.config['db_type'] == 'sqlite':
             self.config['db_location'] = '/' + self.config['db_location']
         eng_name = self.config['db_type'] + '://' + self.config['db_location']
-        self.config['db_engine'] = create_engine(eng_name)
-        self.config['db_session'] = scoped_session(sessionmaker(bind=self.config['db_engine']))
+        options = {'pool_recycle':  self.config['db_pool_recycle'],
+                   'pool_pre_ping': self.config['db_pool_pre_ping']}
+        # In-memory SQLite has a connection per thread, not a pool to size
+        if not (self.config['db_type'] == 'sqlite' and ':memory:' in eng_name):
+            options.update(pool_size=self.config['db_pool_size'],
+                           max_overflow=self.config['db_max_overflow'],
+                           pool_timeout=self.config['db_pool_timeout'])
+        options.update(self.config['db_kwargs'])
+        self.config['db_engine'] = create_engine(eng_name, **options)
+        # Each request gets its own session (see db_scoped())
+        self.config['db_session'] = scoped_session(sessionmaker(bind=self.config['db_engine']),
+                                                   scopefunc=db_scope)
 
     def run(self, mode=None):
         """Runs the Juno hub, in the set mode (default now is dev). """
@@ -182,53 +377,338 @@ class Juno(object):
         if mode is None: mode = config('mode')
         # Otherwise store the specified mode
         else: config('mode', mode)
+        # Compile the options requests read
+        self.settings = JunoSettings(self.config)
 
         if   mode == 'dev':  run_dev(config('bind_address'), config('dev_port'),  self.request)
         elif mode == 'scgi': run_scgi(config('bind_address'), config('scgi_port'), self.request)
         elif mode == 'fcgi': run_fcgi(config('bind_address'), config('fcgi_port'), self.request)
+        elif mode == 'threaded':
+            run_threaded(config('bind_address'), config('threaded_port'), self.request)
+        elif mode == 'prefork':
+            run_prefork(config('bind_address'), config('dev_port'), self.request)
         elif mode == 'wsgi': return run_wsgi(self.request)
+        elif mode == 'asgi': return run_asgi(self.request_async)
         elif mode == 'appengine': run_appengine(self.request)
         else:
             print('Error: unrecognized mode', file=sys.stderr)
             print('       exiting juno...', file=sys.stderr)
 
-    def request(self, request, method='*', params=None, **kwargs):
+    def request(self, request, method='*', params=None, environ=None, **kwargs):
         """Called when a request is received.  Routes a url to its view.
-        Returns a 3-tuple (status_string, headers, body) from
-        JunoResponse.render()."""
-        if config('log'): print('%s request for %s...' %(method, request))
-        req_obj = JunoRequest(kwargs)
-        # Set the global response object in case the view wants to use it
-        global _response
-        _response = JunoResponse()
+        The request's environ is a JunoEnviron from prepare_environ(), used
+        as it is, or else made from kwargs.  Returns a 3-tuple
+        (status_string, headers, body) from JunoResponse.render()."""
+        if environ is None: environ = JunoEnviron(kwargs)
+        # Make this hub and a fresh response object current for the request -
+        # both are context-local, so concurrent requests never share them
+        hub_token = _hub_var.set(self)
+        response_token = _response_var.set(JunoResponse())
+        try:
+            if self.get_settings().use_db:
+                return self.db_scoped(self.handle_request, request, method, params, environ)
+            return self.handle_request(request, method, params, environ)
+        finally:
+            _response_var.reset(response_token)
+            _hub_var.reset(hub_token)
+
+    def handle_request(self, request, method, params, environ):
+        """Does the work of request(), once the current hub and response
+        object are set up."""
+        req_obj, match = self.find_route(request, method, params, environ)
+        # No matches - 404
+        if match is None:
+            return notfound(error='No matching routes registered').render()
+        try:
+            # Views decorated with cached() may not need to run at all
+            key = self.output_cache_key(req_obj, match)
+            if key is not None: return self.cached_view(req_obj, match, key)
+            return self.call_view(req_obj, match)
+        finally: req_obj.close()
+
+    def cached_view(self, req_obj, match, key):
+        """Answers a request to a cached() view from the cache if it can.
+        Otherwise runs the view - once, however many identical requests
+        come in while it runs; they wait for it and share its response.
+        A stale response is served while one refresh runs in the background."""
+        cache = self.get_output_cache()
+        entry = cache.lookup(key, match.route.old_url)
+        if entry is not None:
+            if entry.expires <= time.time():
+                flight, leader = cache.join_flight(key)
+                if leader:
+                    self.get_view_executor().submit(contextvars.copy_context().run,
+                                                    self.refresh_view, req_obj, match,
+                                                    key, flight)
+            return own_rendered(entry.rendered)
+        flight, leader = cache.join_flight(key)
+        if leader: return self.run_cached_view(req_obj, match, key, flight)
+        rendered = own_rendered(flight.wait())
+        # The leader's response can't be shared (e.g. it's a stream)
+        if rendered is None: rendered = self.call_view(req_obj, match)
+        return rendered
+
+    def run_cached_view(self, req_obj, match, key, flight):
+        """Runs a cached() view, caches its response and hands it to the
+        requests waiting on flight."""
+        cache, rendered = self.get_output_cache(), None
+        try:
+            start = time.perf_counter()
+            rendered = self.call_view(req_obj, match)
+            policy = match.route.func.juno_cache
+            cache.set(key, match.route.old_url, rendered, policy.ttl,
+                      time.perf_counter() - start, policy.stale)
+        finally:
+            cache.land(key, flight, rendered)
+        return own_rendered(rendered)
+
+    def refresh_view(self, req_obj, match, key, flight):
+        """Re-runs a cached() view whose response went stale (in the
+        background, so with a response object of its own)."""
+        _response_var.set(JunoResponse())
+        if self.get_settings().use_db:
+            self.db_scoped(self.run_cached_view, req_obj, match, key, flight)
+        else: self.run_cached_view(req_obj, match, key, flight)
+
+    def db_scoped(self, handle, *args):
+        """Runs handle(*args), which returns a rendered response, with a
+        database session of its own.  The session is only opened by the
+        first session() or find(); see end_db_scope() for how it ends."""
+        token = _db_scope_var.set(object())
+        rendered = None
+        try:
+            rendered = handle(*args)
+        finally:
+            try: rendered = self.end_db_scope(rendered)
+            finally: _db_scope_var.reset(token)
+        return rendered
+
+    async def db_scoped_async(self, handle, *args):
+        """The asyncio version of db_scoped()."""
+        token = _db_scope_var.set(object())
+        rendered = None
+        try:
+            rendered = await handle(*args)
+        finally:
+            try: rendered = self.end_db_scope(rendered)
+            finally: _db_scope_var.reset(token)
+        return rendered
+
+    def end_db_scope(self, rendered):
+        """Ends the current request's database session, if it opened one.
+        It is committed if the request succeeded (rendered is a response
+        with a status below 500), rolled back if not, and closed - or, for
+        a streamed response, kept until the stream is done.  Returns the
+        response to send: a 500 if the commit failed."""
+        db_session = self.config['db_session']
+        ok = rendered is not None and int(rendered[0][:3]) < 500
+        # Files never use the session, and must stay JunoFiles to be sent
+        # with the server's wsgi.file_wrapper
+        if ok and is_stream(rendered[2]) and not isinstance(rendered[2], JunoFile):
+            # The stream runs in this request's scope, wherever it is pulled
+            return rendered[0], rendered[1], JunoDbStream(rendered[2], db_session,
+                                                          _db_scope_var.get())
+        if not db_session.registry.has(): return rendered
+        s = db_session()
+        db_session.registry.clear()
+        try: finish_db_session(s, ok)
+        except Exception:
+            if rendered is None or self.get_settings().raise_errors: raise
+            return servererror().render()
+        return rendered
+
+    def call_view(self, req_obj, match):
+        """Runs a matched view, returning its rendered response."""
+        # Get the return from the view
+        try:
+            response = match.route.dispatch(req_obj, match)
+        except JunoRequestError as e:
+            return e.render()
+        except:
+            if self.get_settings().raise_errors: raise
+            return servererror().render()
+        return self.render_response(response)
+
+    async def request_async(self, request, method='*', params=None, environ=None,
+                            **kwargs):
+        """The asyncio version of request(): awaits 'async def' views, and
+        runs plain views in a thread pool so they don't block the loop."""
+        if environ is None: environ = JunoEnviron(kwargs)
+        hub_token = _hub_var.set(self)
+        response_token = _response_var.set(JunoResponse())
+        try:
+            if self.get_settings().use_db:
+                return await self.db_scoped_async(self.handle_request_async, request,
+                                                  method, params, environ)
+            return await self.handle_request_async(request, method, params, environ)
+        finally:
+            _response_var.reset(response_token)
+            _hub_var.reset(hub_token)
+
+    async def handle_request_async(self, request, method, params, environ):
+        req_obj, match = self.find_route(request, method, params, environ)
+        if match is None:
+            return notfound(error='No matching routes registered').render()
+        try:
+            key = self.output_cache_key(req_obj, match)
+            if key is not None: return await self.cached_view_async(req_obj, match, key)
+            return await self.call_view_async(req_obj, match)
+        finally: req_obj.close()
+
+    async def cached_view_async(self, req_obj, match, key):
+        """The asyncio version of cached_view(): waiting requests and the
+        background refresh don't block the event loop."""
+        cache = self.get_output_cache()
+        entry = cache.lookup(key, match.route.old_url)
+        if entry is not None:
+            if entry.expires <= time.time():
+                flight, leader = cache.join_flight(key)
+                if leader:
+                    # Keep a reference, or the task may be collected mid-run
+                    flight.task = asyncio.get_running_loop().create_task(
+                        self.refresh_view_async(req_obj, match, key, flight),
+                        context=contextvars.copy_context())
+            return own_rendered(entry.rendered)
+        flight, leader = cache.join_flight(key)
+        if leader: return await self.run_cached_view_async(req_obj, match, key, flight)
+        rendered = own_rendered(await flight.wait_async())
+        if rendered is None: rendered = await self.call_view_async(req_obj, match)
+        return rendered
+
+    async def run_cached_view_async(self, req_obj, match, key, flight):
+        cache, rendered = self.get_output_cache(), None
+        try:
+            start = time.perf_counter()
+            rendered = await self.call_view_async(req_obj, match)
+            policy = match.route.func.juno_cache
+            cache.set(key, match.route.old_url, rendered, policy.ttl,
+                      time.perf_counter() - start, policy.stale)
+        finally:
+            cache.land(key, flight, rendered)
+        return own_rendered(rendered)
+
+    async def refresh_view_async(self, req_obj, match, key, flight):
+        _response_var.set(JunoResponse())
+        if self.get_settings().use_db:
+            await self.db_scoped_async(self.run_cached_view_async, req_obj, match, key, flight)
+        else: await self.run_cached_view_async(req_obj, match, key, flight)
+
+    async def call_view_async(self, req_obj, match):
+        executor = self.get_view_executor()
+        try:
+            if match.route.is_async: await self.parse_body_async(req_obj, executor)
+            response = await match.route.dispatch_async(req_obj, match, executor)
+        except JunoRequestError as e:
+            return e.render()
+        except:
+            if self.get_settings().raise_errors: raise
+            return servererror().render()
+        return self.render_response(response)
+
+    async def parse_body_async(self, req_obj, executor):
+        """Parses a big (over 64KB) form or JSON body in the thread pool
+        before an async view runs.  Async views run on the event loop, and
+        parsing it there when they ask for it would block every other
+        request; small bodies are still parsed on first use."""
+        environ = req_obj.raw
+        try: length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError: return
+        if length <= 65536: return
+        mimetype = parse_header(environ.get('CONTENT_TYPE') or '')[0]
+        if mimetype == 'application/json' or mimetype.endswith('+json'): key = 'JSON'
+        else: key = 'POST_DICT'
+        await asyncio.get_running_loop().run_in_executor(
+            executor, contextvars.copy_context().run, environ.__getitem__, key)
+
+    def find_route(self, request, method, params, environ):
+        """Returns the JunoRequest for a request and the JunoMatch of the
+        route handling it, or (None, None) if no route matches."""
+        log = self.get_settings().log
+        if log: print('%s request for %s...' %(method, request))
         # Add a slash if there isn't one - avoids frustrating matching bugs
         if request[-1] != '/': request += '/'
-        for route in self.routes:
-            if not route.match(request, method): continue
-            if params:
-                org_params = route.params.copy()
-                route.params.update(params)
-            if config('log'): print('%s matches, calling %s()...\n' %(
-                route.old_url, route.func.__name__))
-            # Get the return from the view
-            if config('raise_view_exceptions') or config('use_debugger'):
-                response = route.dispatch(req_obj)
-            else:
-                try:
-                    response = route.dispatch(req_obj)
-                except:
-                    if params: route.params = org_params
-                    return servererror(error=cgi.escape(traceback.format_exc())).render()
-            # If nothing returned, use the global object
-            if response is None: response = _response
-            # If user gives some params, be sure to reset it
-            if params: route.params = org_params
-            # If we don't have a string, render the Response to one
-            if isinstance(response, JunoResponse):
-                return response.render()
-            return JunoResponse(body=response).render()
-        # No matches - 404
-        return notfound(error='No matching routes registered').render()
+        match = self.get_route_index().match(request, method)
+        if match is None: return None, None
+        if params: match.params.update(params)
+        if log: print('%s matches, calling %s()...\n' %(
+            match.route.old_url, match.route.func.__name__))
+        return JunoRequest(environ), match
+
+    def render_response(self, response):
+        """Renders whatever a view returned."""
+        # If nothing returned, use the current response object
+        if response is None: response = _response_var.get()
+        # Streams keep the headers the view set, e.g. the content type
+        elif is_stream(response): response = _response_var.get().append(response)
+        # Dicts and lists are sent as JSON
+        elif isinstance(response, (dict, list)):
+            current = _response_var.get()
+            headers = current.config['headers']
+            if 'json' not in headers.get('Content-Type', ''):
+                headers['Content-Type'] = 'application/json'
+            response = current.append(json_dumps(response))
+        # If we don't have a string, render the Response to one
+        if isinstance(response, JunoResponse):
+            return response.render()
+        return JunoResponse(body=response).render()
+
+    def output_cache_key(self, req_obj, match):
+        """The output cache key for a request, or None if the matched view
+        isn't cached (or the request must bypass the cache)."""
+        policy = getattr(match.route.func, 'juno_cache', None)
+        if policy is None: return None
+        return policy.key(match.path, req_obj.raw)
+
+    def get_output_cache(self):
+        """The JunoOutputCache holding the responses of cached() views."""
+        if self.output_cache is None:
+            backend = self.config['output_cache_backend']
+            size = self.config['output_cache_size']
+            path = self.config['output_cache_path']
+            if backend == 'memory': backend = JunoMemoryBackend(size)
+            elif backend in ('mmap', 'sqlite'):
+                # Processes of one app share the file unless told otherwise
+                if path is None: path = os.path.join(private_tempdir('juno-cache'),
+                    'juno-%s.%s' %(hashlib.md5(self.app_path.encode('utf-8')).hexdigest()[:12],
+                                   backend))
+                if backend == 'mmap': backend = JunoMmapBackend(path, size)
+                else: backend = JunoSqliteBackend(path, size)
+            self.output_cache = JunoOutputCache(backend)
+        return self.output_cache
+
+    def get_fragment_cache(self):
+        """The JunoFragmentCache holding cached template fragments."""
+        if self.fragment_cache is None:
+            self.fragment_cache = JunoFragmentCache(self.config['fragment_cache_size'])
+        return self.fragment_cache
+
+    def get_error_page(self, code, file):
+        """The template object for an error status (None for Juno's own
+        page, used without templates or if file can't be loaded) and the
+        page split where the error goes.  The page is rendered once per
+        template object; the parts are None if it has to be rendered for
+        each error (the template changes the error, or 'cache_error_pages'
+        is off)."""
+        s = self.get_settings()
+        template_obj = None
+        if s.use_templates:
+            try: template_obj = get_template(file)
+            except Exception as e:
+                if s.log: log_error('Warning: no %d template %s: %s' %(code, file, e))
+        if not s.cache_error_pages: return template_obj, None
+        entry = self.error_pages.get((code, file))
+        # A reloaded template is a new object
+        if entry is None or entry[0] is not template_obj:
+            entry = self.error_pages[code, file] = (
+                template_obj, split_error_page(code, template_obj))
+        return entry
+
+    def get_view_executor(self):
+        """The thread pool request_async() runs plain (sync) views in."""
+        if self.view_executor is None:
+            self.view_executor = concurrent.futures.ThreadPoolExecutor(
+                config('server_threads'), 'juno-view')
+        return self.view_executor
 
     def route(self, url, func, method):
         """Attaches a view to a url or list of urls, for a given function. """
@@ -239,11 +719,19 @@ class Juno(object):
         # Otherwise add each url in the list
         else:
             for u in url: self.routes.append(JunoRoute(u, func, method))
+        # The index is rebuilt the next time a request is routed
+        self.route_index = None
+
+    def get_route_index(self):
+        """Returns the compiled JunoRouteIndex, rebuilding it if routes were
+        added (or self.routes was modified directly) since it was built."""
+        index = self.route_index
+        if index is None or index.size != len(self.routes):
+            index = self.route_index = JunoRouteIndex(self.routes)
+        return index
 
     def __getattr__(self, attr):
-        if attr in list(self.config.keys()):
-            return self.config[attr]
-        return None
+        return self.config.get(attr)
 
     def __repr__(self): return '<Juno>'
 
@@ -252,7 +740,11 @@ class JunoRoute(object):
     i.e., '/hello/*:name/' compiles to '^/hello/(?P<name>\w+)/' """
 
     # RE to match the splat format
-    splat_re = re.compile('^(?P<type>[*w]?):(?P<var>\w+)$')
+    splat_re = re.compile(r'^(?P<type>[*w]?):(?P<var>\w+)$')
+    # Url parts containing any of these are treated as regular expressions
+    regex_chars_re = re.compile(r'[.^$*+?{}\[\]\\|()]')
+
+    __slots__ = ('old_url', 'parts', 'url', 'func', 'is_async', 'method')
 
     def __init__(self, url, func, method):
         # Make sure the url begins and ends in a '/'
@@ -262,6 +754,9 @@ class JunoRoute(object):
         self.old_url = url
         # Start building our modified url
         buffer = '^'
+        # (type, text) pairs used by JunoRouteIndex - type is '' for a plain
+        # part, 're' for a part using regex syntax, or the wildcard type
+        self.parts = []
         for part in url.split('/'):
             # Beginning and end entries are empty, so skip them
             if not part: continue
@@ -269,6 +764,8 @@ class JunoRoute(object):
             # If it doesn't match, just add it without modification
             if not md:
                 buffer += '/' + part
+                if self.regex_chars_re.search(part): self.parts.append(('re', part))
+                else: self.parts.append(('', part))
             else:
                 # Otherwise replace it with python's regex format
                 patterns = {'*': '.+', 'w': r'\w+'}
@@ -276,32 +773,511 @@ class JunoRoute(object):
                 if type_ not in patterns:
                     raise ValueError('Invalid parse type: %s'%type_)
                 buffer += '/(?P<%s>%s)'%(md.group('var'), patterns[type_])
+                self.parts.append((type_, md.group('var')))
         # If we don't end with a wildcard, add a end of line modifier
         if buffer[-1] != ')': buffer += '/$'
         else: buffer += '/'
         self.url = re.compile(buffer)
         self.func = func
+        self.is_async = inspect.iscoroutinefunction(func)
         self.method = method.upper()
-        self.params = {}
 
     def match(self, request, method):
-        """Matches a request uri to this url object. """
+        """Matches a request uri to this url object.  Returns a JunoMatch
+        holding the parts that matched, or None."""
         match_obj = self.url.match(request)
-        if match_obj is None: return False
+        if match_obj is None: return None
         # Make sure the request method matches
-        if self.method != '*' and self.method != method: return False
-        # Store the parts that matched
-        self.params.update(match_obj.groupdict())
-        return True
+        if self.method != '*' and self.method != method: return None
+        return JunoMatch(self, match_obj.groupdict(), request)
+
+    def dispatch(self, req, match):
+        """Calls the route's view with the named parameters of a JunoMatch."""
+        if self.is_async: return asyncio.run(self.func(req, **match.params))
+        return self.func(req, **match.params)
 
-    def dispatch(self, req):
-        """Calls the route's view with any named parameters."""
-        return self.func(req, **self.params)
+    async def dispatch_async(self, req, match, executor=None):
+        """Like dispatch(), but awaits 'async def' views and runs other views
+        in executor, with the current context (response object etc.)."""
+        if self.is_async: return await self.func(req, **match.params)
+        call = functools.partial(self.func, req, **match.params)
+        return await asyncio.get_running_loop().run_in_executor(
+            executor, contextvars.copy_context().run, call)
 
     def __repr__(self):
         return '<JunoRoute: %s %s - %s()>' %(self.method, self.old_url,
                                              self.func.__name__)
 
+class JunoMatch(object):
+    """The result of a successful JunoRoute.match().  A new one is made for
+    every request, so concurrent requests to the same route never see each
+    other's url parameters."""
+    __slots__ = ('route', 'params', 'path')
+
+    def __init__(self, route, params, path=None):
+        self.route = route
+        self.params = params
+        # The url that matched
+        self.path = path
+
+    def __repr__(self):
+        return '<JunoMatch: %s %s>' %(self.route.old_url, self.params)
+
+class JunoRouteIndex(object):
+    """Compiled lookup structure for a list of JunoRoutes.  Fully static urls
+    go into a dictionary, everything else into a trie keyed on url segments.
+    candidates() returns the few routes that could match a request, in the
+    order they were registered; match() still runs JunoRoute.match() on
+    them, so the first registered match still wins."""
+
+    def __init__(self, routes):
+        self.routes = list(routes)
+        self.size = len(self.routes)
+        # '/url/' => [route positions]
+        self.static = {}
+        self.root = self.new_node()
+        # The first segments routes can start with, or None if some route
+        # can start with anything
+        self.heads = set()
+        for position, route in enumerate(self.routes):
+            self.add(position, route)
+
+    @staticmethod
+    def new_node():
+        # [literal children, 'w:' child, routes ending here,
+        #  routes ending in 'w:' here (prefix matches), routes to regex test]
+        return [{}, None, [], [], []]
+
+    def add(self, position, route):
+        if all(type_ == '' for type_, _ in route.parts):
+            url = '/'.join(text for _, text in route.parts)
+            url = '/' + url + '/' if url else '/'
+            self.static.setdefault(url, []).append(position)
+            if self.heads is not None: self.heads.add(url[1:url.index('/', 1)] if url != '/' else '')
+            return
+        if self.heads is not None:
+            if route.parts[0][0] == '': self.heads.add(route.parts[0][1])
+            else: self.heads = None
+        node = self.root
+        for type_, text in route.parts:
+            if type_ == '':
+                node = node[0].setdefault(text, self.new_node())
+            elif type_ == 'w':
+                if node[1] is None: node[1] = self.new_node()
+                node = node[1]
+            else:
+                # '*:' and regex parts can span segments, so anything from
+                # here on has to be checked by the route's own regex
+                node[4].append(position)
+                return
+        if route.parts[-1][0] == 'w': node[3].append(position)
+        else: node[2].append(position)
+
+    def candidates(self, request):
+        """Returns the routes that might match request (which must begin and
+        end with a '/'), in registration order."""
+        found = list(self.static.get(request, ()))
+        segments = request[1:-1].split('/') if request != '/' else []
+        count = len(segments)
+        stack = [(self.root, 0)]
+        while stack:
+            node, depth = stack.pop()
+            found.extend(node[4])
+            found.extend(node[3])
+            if depth == count:
+                found.extend(node[2])
+                continue
+            segment = segments[depth]
+            child = node[0].get(segment)
+            if child is not None: stack.append((child, depth + 1))
+            if node[1] is not None and segment:
+                stack.append((node[1], depth + 1))
+        found.sort()
+        return [self.routes[position] for position in found]
+
+    def match(self, request, method):
+        """Returns a JunoMatch for the first route matching request and
+        method, or None."""
+        # Most misses (like scanners trying '/wp-admin/...') are over at the
+        # first segment
+        if self.heads is not None and request[1:request.find('/', 1)] not in self.heads:
+            return None
+        for route in self.candidates(request):
+            match = route.match(request, method)
+            if match is not None: return match
+        return None
+
+    def __repr__(self):
+        return '<JunoRouteIndex: %s routes>' %self.size
+
+def private_tempdir(name):
+    """A directory in the temporary directory that only this user can use:
+    name-<uid>, made with mode 0700.  Raises RuntimeError if it is there
+    already but isn't this user's, or others can get in - they could plant
+    files in it (Jinja2 checks its default bytecode cache the same way)."""
+    path = os.path.join(tempfile.gettempdir(), name)
+    # Windows has a temporary directory per user
+    if not hasattr(os, 'getuid'):
+        os.makedirs(path, exist_ok=True)
+        return path
+    path = '%s-%d' %(path, os.getuid())
+    try: os.mkdir(path, 0o700)
+    except FileExistsError: pass
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() \
+        or stat.S_IMODE(info.st_mode) & 0o077:
+        raise RuntimeError('%s is not a private directory; set the path '
+                           'in the configuration instead' %path)
+    return path
+
+def parse_query(environ):
+    """The query string as a dict of lists: {'a': ['5']} from 'a=5'."""
+    query = environ.get('QUERY_STRING')
+    if not query: return {}
+    return urllib.parse.parse_qs(query, keep_blank_values=1)
+
+def parse_form(environ):
+    """Reads and parses the form data of a POST or PUT request, urlencoded
+    or multipart, into a dict of lists like parse_query().  Uploaded files
+    are JunoUpload objects.  The body is read in chunks, so only the fields
+    (at most 'max_field_size' bytes each) are held in memory.  Raises
+    JunoRequestError for malformed forms (400), and for ones over
+    'max_body_size' bytes or with more than 'max_form_parts' fields (413)."""
+    if environ.get('REQUEST_METHOD') not in ('POST', 'PUT'): return {}
+    mimetype, params = parse_header(environ.get('CONTENT_TYPE') or '')
+    s = settings()
+    if mimetype == 'application/x-www-form-urlencoded':
+        parser = JunoUrlencodedParser(s.charset, s.max_form_parts, s.max_field_size)
+    elif mimetype == 'multipart/form-data':
+        if not params.get('boundary'):
+            raise JunoRequestError(400, 'Multipart form without a boundary')
+        parser = JunoMultipartParser(params['boundary'].encode('latin-1'),
+                                     s.charset, s.max_form_parts, s.max_field_size,
+                                     s.upload_spool_size, s.upload_dir)
+    else: return {}
+    try:
+        for data in body_chunks(environ, s.max_body_size): parser.feed(data)
+        return parser.close()
+    except:
+        parser.abort()
+        raise
+
+def close_uploads(fields):
+    """Closes the JunoUploads among the values of a parsed form."""
+    for values in fields.values():
+        for value in values:
+            if isinstance(value, JunoUpload): value.close()
+
+def body_chunks(environ, max_size=None):
+    """Reads the request body in chunks of at most 256KB.  Raises
+    JunoRequestError (413) before reading anything if it is over max_size
+    bytes."""
+    try: length = int(environ.get('CONTENT_LENGTH') or 0)
+    except ValueError: raise JunoRequestError(400, 'Invalid Content-Length')
+    if max_size and length > max_size:
+        raise JunoRequestError(413, 'Request body too large')
+    stream = environ['wsgi.input']
+    while length > 0:
+        data = stream.read(min(262144, length))
+        if not data: break
+        length -= len(data)
+        yield data
+
+header_params = re.compile(r';\s*([^\s;=]+)\s*=\s*("(?:[^"\\]|\\.)*"|[^;]*)')
+
+def parse_header(value):
+    """Splits a header like Content-Type into its value (lowercased) and a
+    dict of its parameters: ('text/html', {'charset': 'utf-8'})."""
+    main, _, rest = value.partition(';')
+    params = {}
+    for name, param in header_params.findall(';' + rest):
+        param = param.strip()
+        if len(param) > 1 and param[0] == param[-1] == '"':
+            param = param[1:-1].replace('\\"', '"')
+        params[name.lower()] = param
+    return main.strip().lower(), params
+
+class JunoRequestError(Exception):
+    """Raised while reading a request Juno can't take, like a malformed or
+    too large form.  The request is answered with status and message
+    instead of the view's response."""
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+        self.message = message
+
+    def render(self):
+        response = JunoResponse(status=self.status, body=self.message + '\n')
+        response.header('Content-Type', 'text/plain; charset=%s' %response.charset)
+        return response.render()
+
+class JunoUpload(object):
+    """A file sent with a multipart form, as web.input() gives it.  Has the
+    field's name, the filename, type (the Content-Type of the part) and the
+    part's headers.  The contents are in file, a temporary file that stays
+    in memory until it is over 'upload_spool_size' bytes."""
+    def __init__(self, name, filename, type, headers, spool_size, dir=None):
+        self.name = name
+        self.filename = filename
+        self.type = type
+        self.headers = headers
+        self.file = tempfile.SpooledTemporaryFile(spool_size, dir=dir)
+        self.size = 0
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+
+    @property
+    def value(self):
+        """The contents, as bytes (all read into memory)."""
+        self.file.seek(0)
+        data = self.file.read()
+        self.file.seek(0)
+        return data
+
+    def save(self, path):
+        """Copies the contents to a file at path."""
+        self.file.seek(0)
+        with open(path, 'wb') as f: shutil.copyfileobj(self.file, f, 1024 * 1024)
+        self.file.seek(0)
+
+    def close(self):
+        self.file.close()
+
+    def __repr__(self):
+        return '<JunoUpload: %s %r, %d bytes>' %(self.name, self.filename, self.size)
+
+class JunoFormParser(abc.ABC):
+    """Parses a form body fed to it in chunks.  feed() it the body, then
+    close() returns the fields as a dict of lists."""
+    def __init__(self, charset, max_parts=None, max_field_size=None):
+        self.charset = charset
+        self.max_parts = max_parts
+        self.max_field_size = max_field_size
+        self.fields = {}
+        self.parts = 0
+
+    def count(self):
+        """Counts another field, checking 'max_form_parts'."""
+        self.parts += 1
+        if self.max_parts and self.parts > self.max_parts:
+            raise JunoRequestError(413, 'Too many form fields')
+
+    def check_size(self, size):
+        if self.max_field_size and size > self.max_field_size:
+            raise JunoRequestError(413, 'Form field too large')
+
+    def add(self, name, value):
+        if name in self.fields: self.fields[name].append(value)
+        else: self.fields[name] = [value]
+
+    @abc.abstractmethod
+    def feed(self, data):
+        """Parses the next chunk of the body."""
+
+    def close(self):
+        return self.fields
+
+    def abort(self):
+        """Lets go of what was parsed, after an error."""
+        close_uploads(self.fields)
+
+class JunoUrlencodedParser(JunoFormParser):
+    """Parses application/x-www-form-urlencoded bodies: 'a=1&b=2'."""
+    def __init__(self, charset, max_parts=None, max_field_size=None):
+        JunoFormParser.__init__(self, charset, max_parts, max_field_size)
+        # The field that isn't complete yet
+        self.buffer = b''
+
+    def feed(self, data):
+        pairs = (self.buffer + data).split(b'&')
+        self.buffer = pairs.pop()
+        for pair in pairs: self.add_pair(pair)
+        self.check_size(len(self.buffer))
+
+    def add_pair(self, pair):
+        if not pair: return
+        self.count()
+        self.check_size(len(pair))
+        name, _, value = pair.replace(b'+', b' ').partition(b'=')
+        self.add(urllib.parse.unquote_to_bytes(name).decode(self.charset, 'replace'),
+                 urllib.parse.unquote_to_bytes(value).decode(self.charset, 'replace'))
+
+    def close(self):
+        self.add_pair(self.buffer)
+        self.buffer = b''
+        return self.fields
+
+class JunoMultipartParser(JunoFormParser):
+    """Parses multipart/form-data bodies.  File parts are written to
+    JunoUpload objects as they come in; other fields are kept in memory,
+    up to max_field_size bytes each."""
+    # The most bytes of headers a part may have
+    max_header_size = 16384
+
+    def __init__(self, boundary, charset, max_parts=None, max_field_size=None,
+                 spool_size=1024 * 1024, upload_dir=None):
+        JunoFormParser.__init__(self, charset, max_parts, max_field_size)
+        self.spool_size = spool_size
+        self.upload_dir = upload_dir
+        # A part starts after the delimiter, and its data ends at the separator
+        self.delimiter = b'--' + boundary
+        self.separator = b'\r\n--' + boundary
+        self.buffer = b''
+        self.state = 'preamble'
+        # The current part: its name, and a JunoUpload or a bytearray
+        self.name = None
+        self.part = None
+
+    def feed(self, data):
+        self.buffer += data
+        while self.step(): pass
+
+    def step(self):
+        """Parses what it can of the buffer.  Returns whether to go on."""
+        buf = self.buffer
+        if self.state == 'preamble':
+            index = buf.find(self.delimiter)
+            if index < 0:
+                self.buffer = buf[-len(self.delimiter):]
+                return False
+            self.buffer = buf[index + len(self.delimiter):]
+            self.state = 'delimiter'
+            return True
+        if self.state == 'delimiter':
+            # '--' after a delimiter ends the body; otherwise a part follows
+            # on the next line
+            if buf[:2] == b'--':
+                self.state, self.buffer = 'done', b''
+                return False
+            end = buf.find(b'\r\n')
+            if end < 0:
+                if len(buf) > 1024: raise JunoRequestError(400, 'Malformed multipart body')
+                return False
+            self.buffer = buf[end + 2:]
+            self.state = 'headers'
+            return True
+        if self.state == 'headers':
+            if buf[:2] == b'\r\n': end = -2
+            else:
+                end = buf.find(b'\r\n\r\n')
+                if end < 0:
+                    if len(buf) > self.max_header_size:
+                        raise JunoRequestError(400, 'Multipart headers too long')
+                    return False
+            self.start_part(buf[:max(end, 0)])
+            self.buffer = buf[end + 4:]
+            self.state = 'data'
+            return True
+        if self.state == 'data':
+            index = buf.find(self.separator)
+            if index < 0:
+                # Keep what may be the start of the separator
+                keep = len(self.separator) - 1
+                if len(buf) > keep:
+                    self.write(memoryview(buf)[:-keep])
+                    self.buffer = buf[-keep:]
+                return False
+            self.write(buf[:index])
+            self.end_part()
+            self.buffer = buf[index + len(self.separator):]
+            self.state = 'delimiter'
+            return True
+        # Ignore anything after the last part
+        self.buffer = b''
+        return False
+
+    def start_part(self, head):
+        self.count()
+        headers = {}
+        for line in head.decode(self.charset, 'replace').split('\r\n'):
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        disposition, params = parse_header(headers.get('content-disposition', ''))
+        if 'name' not in params: raise JunoRequestError(400, 'Form field without a name')
+        self.name = params['name']
+        if 'filename' in params:
+            self.part = JunoUpload(self.name, params['filename'],
+                                   headers.get('content-type', 'application/octet-stream'),
+                                   headers, self.spool_size, self.upload_dir)
+        else: self.part = bytearray()
+
+    def write(self, data):
+        if isinstance(self.part, JunoUpload):
+            self.part.write(data)
+        else:
+            self.part += data
+            self.check_size(len(self.part))
+
+    def end_part(self):
+        if isinstance(self.part, JunoUpload):
+            self.part.file.seek(0)
+            self.add(self.name, self.part)
+        else: self.add(self.name, self.part.decode(self.charset, 'replace'))
+        self.name = self.part = None
+
+    def close(self):
+        if self.state != 'done': raise JunoRequestError(400, 'Incomplete multipart body')
+        return self.fields
+
+    def abort(self):
+        JunoFormParser.abort(self)
+        if isinstance(self.part, JunoUpload): self.part.close()
+
+def parse_json(environ):
+    """Reads and decodes a JSON request body (Content-Type application/json
+    or a '+json' type).  None if the request has no JSON body.  Raises
+    JunoRequestError for bodies over 'max_json_size' bytes (413), and for
+    invalid JSON (400)."""
+    mimetype, params = parse_header(environ.get('CONTENT_TYPE') or '')
+    if mimetype != 'application/json' and not mimetype.endswith('+json'): return None
+    data = b''.join(body_chunks(environ, settings().max_json_size))
+    if not data: return None
+    try: return json_loads(data)
+    except ValueError: raise JunoRequestError(400, 'Invalid JSON body')
+
+def parse_cookies(environ):
+    """The Cookie header as a dict: {'theme': 'dark'}."""
+    header = environ.get('HTTP_COOKIE')
+    if not header: return {}
+    try: cookies = http.cookies.SimpleCookie(header)
+    except http.cookies.CookieError: return {}
+    return dict((name, morsel.value) for name, morsel in cookies.items())
+
+def combine_input(environ):
+    """The query string and form data in one dict.  Repeated keys keep a
+    list of their values; others just have their value."""
+    input_dict = dict(environ['QUERY_DICT'])
+    for k, v in environ['POST_DICT'].items():
+        # Combine repeated keys
+        if k in input_dict: input_dict[k] = input_dict[k] + v
+        # Otherwise just add this key
+        else: input_dict[k] = v
+    # Reduce the dict - change one item lists ([a] to a)
+    for k, v in input_dict.items():
+        if len(v) == 1: input_dict[k] = v[0]
+    return input_dict
+
+class JunoEnviron(dict):
+    """The environ dict of a request (JunoRequest.raw).  The parsed query
+    string, form data, cookies and JSON body ('QUERY_DICT', 'POST_DICT',
+    'COOKIES', 'JSON') and the combined input ('input') are worked out on
+    first use, so a view that
+    never looks at them never pays for them - or reads the request body."""
+    parsers = {'QUERY_DICT': parse_query, 'POST_DICT': parse_form,
+               'COOKIES': parse_cookies, 'JSON': parse_json, 'input': combine_input}
+
+    def __missing__(self, key):
+        parser = self.parsers.get(key)
+        if parser is None: raise KeyError(key)
+        value = self[key] = parser(self)
+        return value
+
+    def get(self, key, default=None):
+        if key in self.parsers: return self[key]
+        return dict.get(self, key, default)
+
 class JunoRequest(object):
     """Offers following members:
         raw           => the header dict used to construct the JunoRequest
@@ -309,12 +1285,15 @@ class JunoRequest(object):
         full_location => uri with query string ('/?a=6' from '/?a=6')
         user_agent    => the user agent string of requester
     """
+    # One of these is made for every request, so keep it small
+    __slots__ = ('raw', 'location', 'full_location', 'user_agent', 'session')
+
     def __init__(self, request):
         # Make sure we have a request uri, and it ends in '/'
         if request['PATH_INFO'][-1] != '/': request['PATH_INFO'] += '/'
         # Set some instance variables
+        if not isinstance(request, JunoEnviron): request = JunoEnviron(request)
         self.raw = request
-        self.raw['input'] = {}
         self.location = request['PATH_INFO']
         # If we get a REQUEST_URI, store it.  Otherwise copy PATH_INFO
         if 'REQUEST_URI' in request:
@@ -326,27 +1305,15 @@ class JunoRequest(object):
         elif 'User-Agent' in request:
             self.user_agent = request['User-Agent']
         else: self.user_agent = ''
-        self.combine_request_dicts()
         # Check for sessions
-        if config('use_sessions') and config('session_lib') == 'beaker':
+        if settings().beaker_sessions:
             self.session = request['beaker.session']
 
-    def combine_request_dicts(self):
-        input_dict = self.raw['QUERY_DICT'].copy()
-        for k, v in list(self.raw['POST_DICT'].items()):
-            # Combine repeated keys
-            if k in list(input_dict.keys()): input_dict[k].extend(v)
-            # Otherwise just add this key
-            else: input_dict[k] = v
-        # Reduce the dict - change one item lists ([a] to a)
-        for k, v in list(input_dict.items()):
-            if len(v) == 1: input_dict[k] = v[0]
-        self.raw['input'] = input_dict
-
     def __getattr__(self, attr):
         # Try returning values from self.raw
-        if attr in list(self.keys()): return self.raw[attr]
-        if attr == 'session' and config('log'):
+        try: return self.raw[attr]
+        except KeyError: pass
+        if attr == 'session' and settings().log:
             print("Error: To use sessions, enable 'use_sessions'", file=sys.stderr)
             print("       when calling juno.init()", file=sys.stderr)
             print("", file=sys.stderr)
@@ -356,11 +1323,25 @@ class JunoRequest(object):
         # No args: return the whole dictionary
         if arg is None: return self.raw['input']
         # Otherwise try to return the value for that key
-        if arg in self.raw['input']:
-            return self.raw['input'][arg]
-        return None
+        return self.raw['input'].get(arg)
+
+    def json(self):
+        """The decoded JSON body of the request, or None if it hasn't one.
+        Invalid or too large bodies get a 400 or 413 response."""
+        return self.raw['JSON']
+
+    def cookie(self, name=None):
+        """The value of a request cookie, or None.  No name: a dict of all of
+        them."""
+        if name is None: return self.raw['COOKIES']
+        return self.raw['COOKIES'].get(name)
 
     # Make JunoRequest act as a dictionary for self.raw
+    def close(self):
+        """Closes the temporary files of the uploads that came with the
+        request (if its form was parsed at all), once it is over."""
+        if 'POST_DICT' in self.raw: close_uploads(self.raw['POST_DICT'])
+
     def __getitem__(self, key): return self.raw[key]
     def __setitem__(self, key, val): self.raw[key] = val
     def keys(self): return list(self.raw.keys())
@@ -375,6 +1356,10 @@ class JunoRequest(object):
 class JunoResponse(object):
     status_codes = {
         200: 'OK',
+        201: 'Created',
+        202: 'Accepted',
+        204: 'No Content',
+        206: 'Partial Content',
         301: 'Moved Permanently',
         302: 'Found',
         303: 'See Other',
@@ -384,43 +1369,98 @@ class JunoResponse(object):
         404: 'Not Found',
         405: 'Method Not Allowed',
         410: 'Gone',
+        413: 'Payload Too Large',
+        416: 'Range Not Satisfiable',
         500: 'Internal Server Error',
     }
+    __slots__ = ('config', 'charset', 'fragments', 'length', 'text', 'streamed')
+
     def __init__(self, configuration=None, **kwargs):
+        s = settings()
+        self.charset = s.charset
         # Set options and merge in user-set options
         self.config = {
             'body': '',
             'status': 200,
-            'headers': { 'Content-Type': "%s; charset=%s"%(config('content_type'),config('charset')), },
+            'headers': { 'Content-Type': s.content_type_header, },
         }
-        if configuration is None: configuration = {}
-        self.config.update(configuration)
-        self.config.update(kwargs)
-        self.config['headers']['Content-Length'] = get_content_length(self.config['body'])
+        if configuration: self.config.update(configuration)
+        if kwargs: self.config.update(kwargs)
+        self.clear()
+        self.append(self.config.pop('body'))
+
+    def clear(self):
+        """Empties the body."""
+        # The body is kept as a list of encoded fragments, joined once when
+        # it is read or rendered, so appending doesn't copy what's there
+        self.fragments = []
+        # None once a stream of unknown length was added
+        self.length = 0
+        # False once binary data was added to a non-text response
+        self.text = True
+        # True once a generator or other iterable was added
+        self.streamed = False
+        self.config['headers']['Content-Length'] = 0
+        return self
 
     # Add text and adjust content-length
     def append(self, text):
-        if type(text) is bytes:
-            if self.config['headers']['Content-Type'].startswith('text'):
-                text = str(text, config('charset'))
+        if is_stream(text):
+            # Streamed bodies are sent as they are generated; only files
+            # know their length up front
+            self.fragments.append(text)
+            self.streamed = True
+            if self.length is not None and isinstance(text, JunoFile):
+                self.add_length(len(text))
             else:
-                self.config['body'] = text
-                self.config['headers']['Content-Length'] = get_content_length(text)
-                return self
-        self.config['body'] += str(text)
-        self.config['headers']['Content-Length'] = get_content_length(self.config['body'])
+                self.length = None
+                self.config['headers'].pop('Content-Length', None)
+            return self
+        if isinstance(text, (bytes, bytearray)):
+            if not self.config['headers'].get('Content-Type', '').startswith('text'):
+                self.text = False
+            data = bytes(text)
+        else: data = str(text).encode(self.charset)
+        if not data: return self
+        self.fragments.append(data)
+        if self.length is not None: self.add_length(len(data))
         return self
 
+    def add_length(self, size):
+        self.length += size
+        self.config['headers']['Content-Length'] = self.length
+
     # Implement +=
     def __iadd__(self, text):
         return self.append(text)
 
+    def join(self):
+        """Returns the (non-streamed) body as bytes."""
+        if len(self.fragments) > 1: self.fragments = [b''.join(self.fragments)]
+        return self.fragments[0] if self.fragments else b''
+
+    @property
+    def body(self):
+        """The body as text, or bytes for binary responses, or an iterator
+        over the chunks for streamed responses."""
+        if self.streamed: return self.stream()
+        if self.text: return self.join().decode(self.charset)
+        return self.join()
+
+    def stream(self):
+        """Returns the streamed body as one iterable."""
+        # A lone stream is passed on as it is, so servers can recognize
+        # files (see JunoFile.wrap())
+        if len(self.fragments) == 1: return self.fragments[0]
+        return chain_body(*self.fragments)
+
     def render(self):
         """Returns a 3-tuple (status_string, headers, body)."""
         status_string = '%s %s' %(self.config['status'],
                                   self.status_codes[self.config['status']])
-        headers = [(k, str(v)) for k, v in list(self.config['headers'].items())]
-        return (status_string, headers, self.config['body'])
+        headers = [(k, str(v)) for k, v in self.config['headers'].items()]
+        if self.streamed: return (status_string, headers, self.stream())
+        return (status_string, headers, self.join())
 
     # Set a header value
     def header(self, header, value):
@@ -432,7 +1472,9 @@ class JunoResponse(object):
     def __getitem__(self, header): return self.config['headers'][header]
 
     def __getattr__(self, attr):
-        return self.config[attr]
+        # status, headers and any other option given to __init__
+        try: return self.config[attr]
+        except KeyError: raise AttributeError(attr)
 
     def __repr__(self):
         return '<JunoResponse: %s %s>' %(self.status, self.status_codes[self.status])
@@ -442,6 +1484,8 @@ class JunoResponse(object):
 #
 
 _hub = None
+# The hub handling the current request, if it isn't _hub (see subdirect())
+_hub_var = contextvars.ContextVar('juno_hub', default=None)
 
 def init(configuration=None):
     """Set up Juno with an optional configuration."""
@@ -452,18 +1496,61 @@ def init(configuration=None):
     return _hub
 
 def config(key, value=None):
-    """Get or set configuration options."""
-    if _hub is None: init()
+    """Get or set configuration options.  Setting options recompiles the
+    settings() snapshot; changing hub.config directly doesn't."""
+    hub = getHub()
+    if hub is None: hub = init()
     if value is None:
         # Either pass a configuration dictionary
-        if type(key) == dict: _hub.config.update(key)
+        if type(key) == dict:
+            hub.config.update(key)
+            hub.settings = None
         # Or retrieve a value
         else:
-            if key in list(_hub.config.keys()):
-                return _hub.config[key]
-            return None
+            return hub.config.get(key)
     # Or set a specific value
-    else: _hub.config[key] = value
+    else:
+        hub.config[key] = value
+        hub.settings = None
+
+def settings():
+    """The current hub's JunoSettings: its options as read-only attributes,
+    for code that runs on every request (settings().charset)."""
+    hub = getHub()
+    if hub is None: hub = init()
+    return hub.get_settings()
+
+class JunoSettings(object):
+    """A read-only snapshot of a configuration dict, with the options as
+    attributes (None for unknown ones).  Also has some values worked out
+    from them:
+        content_type_header => default Content-Type ('text/html; charset=utf-8')
+        raise_errors        => whether view exceptions are raised, not rendered
+        beaker_sessions     => whether requests get a Beaker session
+        session_cookie      => start of the session cookie ('session_key=')
+        static_cache_header => Cache-Control header of static files (or None)
+    """
+    def __init__(self, configuration):
+        self.__dict__.update(configuration)
+        self.__dict__.update(
+            content_type_header = '%s; charset=%s' %(configuration.get('content_type'),
+                                                     configuration.get('charset')),
+            raise_errors = bool(configuration.get('raise_view_exceptions')
+                                or configuration.get('use_debugger')),
+            beaker_sessions = bool(configuration.get('use_sessions')
+                                   and configuration.get('session_lib') == 'beaker'),
+            session_cookie = '%s=' %configuration.get('session_key'),
+            static_cache_header = configuration.get('static_cache_control') or (
+                'public, max-age=%d' %configuration['static_expires']
+                if configuration.get('static_expires') else None),
+        )
+
+    def __getattr__(self, attr): return None
+
+    def __setattr__(self, attr, value):
+        raise AttributeError('settings are read-only; use config(%r, value)' %attr)
+
+    def __repr__(self): return '<JunoSettings>'
 
 def run(mode=None):
     """Start Juno, with an optional mode argument."""
@@ -493,20 +1580,62 @@ def close_nutshell():
         _hub, _nut = _nut, None
 
 def getHub():
-    return _hub
+    """Returns the hub handling the current request, or the global hub."""
+    hub = _hub_var.get()
+    if hub is None: return _hub
+    return hub
 
 def get_content_length(data):
     if isinstance(data, str):
-        return len(bytes(data, config('charset')))
+        return len(bytes(data, settings().charset))
     return len(data)
 
+def is_stream(data):
+    """True for bodies that are sent piece by piece: generators, iterators,
+    files and other iterables that aren't text, bytes or plain data."""
+    if isinstance(data, (str, bytes, bytearray, list, tuple, dict)): return False
+    return hasattr(data, '__iter__')
+
+def chain_body(*parts):
+    """Yields the chunks of several bodies, streamed or not, in order."""
+    for part in parts:
+        if is_stream(part): yield from part
+        elif part: yield part
+
+class JunoEncodedStream(object):
+    """The chunks of a streamed body as bytes, skipping empty ones.  The
+    body is closed when it runs out, or by close() - even if the server
+    never started iterating, which a generator's own finally would miss."""
+    def __init__(self, body, charset):
+        self.body = body
+        self.chunks = iter(body)
+        self.charset = charset
+
+    def __iter__(self): return self
+
+    def __next__(self):
+        while True:
+            try: chunk = next(self.chunks)
+            except StopIteration:
+                self.close()
+                raise
+            if isinstance(chunk, str): chunk = chunk.encode(self.charset)
+            if chunk: return chunk
+
+    def close(self):
+        close = getattr(self.body, 'close', None)
+        if close is not None: close()
+
 #
 #   Decorators to add routes based on request methods
 #
 
 def route(url=None, method='*'):
     if _hub is None: init()
-    def wrap(f): _hub.route(url, f, method)
+    def wrap(f):
+        _hub.route(url, f, method)
+        # Keep the view usable, e.g. for invalidate_route()
+        return f
     return wrap
 
 def post(url=None):   return route(url, 'post')
@@ -516,59 +1645,574 @@ def put(url=None):    return route(url, 'put')
 def delete(url=None): return route(url, 'delete')
 
 #
-#   Functions to deal with the global response object (_response)
+#   Functions to deal with the current response object (_response)
 #
 
-_response = None
+# Each request gets its own response object.  It is stored in a context
+# variable so that threads and asyncio tasks serving different requests
+# each see their own; `juno._response` still works through __getattr__.
+_response_var = contextvars.ContextVar('juno_response', default=None)
+# Set to an object of its own for each request (see Juno.db_scoped())
+_db_scope_var = contextvars.ContextVar('juno_db_scope', default=None)
+
+def __getattr__(name):
+    if name == '_response': return _response_var.get()
+    raise AttributeError("module %r has no attribute %r" %(__name__, name))
 
 def append(body):
     """Add text to response body. """
-    global _response
-    return _response.append(body)
+    return _response_var.get().append(body)
 
 def header(key, value):
     """Set a response header. """
-    global _response
-    return _response.header(key, value)
+    return _response_var.get().header(key, value)
 
 def content_type(type):
     """Set the content type header. """
     header('Content-Type', type)
 
 def status(code):
-    _response.config['status'] = code
+    _response_var.get().config['status'] = code
+
+#
+#   Output caching
+#
+
+def cached(ttl=60, vary=(), stale=0):
+    """Decorator caching a view's rendered response for ttl seconds.  Put
+    it under the route decorator:
+
+        @get('/news/')
+        @cached(60, vary=['Accept-Language'])
+        def news(web): ...
+
+    Responses are cached per method, path and query string, and per value
+    of the request headers named in vary.  For stale seconds after that, an
+    expired response is still served while the view runs in the background
+    to refresh it."""
+    def wrap(func):
+        func.juno_cache = JunoCachePolicy(ttl, vary, stale)
+        return func
+    return wrap
+
+def invalidate(url, method='GET'):
+    """Drops the cached responses for a url ('/news/?page=2'), for every
+    value of the route's vary headers."""
+    path, _, query = url.partition('?')
+    if path[-1] != '/': path += '/'
+    getHub().get_output_cache().delete_url(cache_url(method, path, query))
+
+def invalidate_route(route):
+    """Drops every cached response of a route, given by url pattern (as
+    passed to route()) or view function."""
+    hub = getHub()
+    if callable(route):
+        urls = [r.old_url for r in hub.routes if r.func is route]
+    else:
+        if route[0] != '/': route = '/' + route
+        if route[-1] != '/': route += '/'
+        urls = [route]
+    for url in urls: hub.get_output_cache().delete_route(url)
+
+def output_cache_stats():
+    """Output cache counters per route: hits, misses, hit_rate, saved
+    (seconds of view time saved by hits), stale (hits on stale responses)
+    and coalesced (misses that waited for another request's view run)."""
+    return getHub().get_output_cache().stats()
+
+def cache_url(method, path, query):
+    # HEAD requests get the same response as GET, without the body
+    if method == 'HEAD': method = 'GET'
+    if query: return '%s %s?%s' %(method, path, query)
+    return '%s %s' %(method, path)
+
+class JunoCachePolicy(object):
+    """How a cached() view is cached."""
+    def __init__(self, ttl, vary=(), stale=0):
+        self.ttl = ttl
+        self.stale = stale
+        # WSGI names of the vary headers: 'Accept-Language' -> 'HTTP_ACCEPT_LANGUAGE'
+        self.vary = ['HTTP_' + name.upper().replace('-', '_') for name in vary]
+
+    def key(self, path, environ):
+        """The cache key for a request, or None if it mustn't be cached:
+        only GET and HEAD requests are, and not ones that carry a session
+        cookie or credentials, which may get a personal response."""
+        if environ.get('REQUEST_METHOD', 'GET') not in ('GET', 'HEAD'): return None
+        if 'HTTP_AUTHORIZATION' in environ: return None
+        cookie = environ.get('HTTP_COOKIE')
+        if cookie and settings().session_cookie in cookie: return None
+        key = cache_url(environ.get('REQUEST_METHOD', 'GET'), path,
+                        environ.get('QUERY_STRING', ''))
+        for name in self.vary: key += '\n%s' %environ.get(name, '')
+        return key
+
+    def __repr__(self):
+        return '<JunoCachePolicy: %ss (+%ss stale), vary %s>' %(self.ttl, self.stale,
+                                                               self.vary)
+
+def own_rendered(rendered):
+    """A cached (shared) rendered response with a headers list of its own,
+    as middleware may add headers to the list it is given."""
+    if rendered is None: return None
+    status_string, headers, body = rendered
+    return status_string, list(headers), body
+
+class JunoCacheEntry(object):
+    """A response in the output cache."""
+    # Roughly what an entry costs besides its headers and body
+    overhead = 512
+
+    def __init__(self, rendered, route, url, expires, render_time, stale=0):
+        self.rendered = rendered
+        # The route pattern and the method and url (see cache_url()) the
+        # response is for, for invalidate_route() and invalidate()
+        self.route = route
+        self.url = url
+        # The response is fresh until expires, then stale for stale seconds
+        self.expires = expires
+        self.stale = stale
+        # How long the view took; a hit saves that much
+        self.render_time = render_time
+        status_string, headers, body = rendered
+        self.size = self.overhead + len(body) + sum(len(k) + len(v) for k, v in headers)
+
+    def encode(self):
+        """The entry as bytes, for backends that keep it outside this
+        process: its details as JSON, a newline, then the body.  Not a
+        pickle - loading one from a file others can write to would run
+        their code."""
+        status_string, headers, body = self.rendered
+        head = json.dumps([self.url, self.route, self.expires, self.stale,
+                           self.render_time, status_string, headers])
+        return head.encode('utf-8') + b'\n' + body
+
+    @classmethod
+    def decode(cls, data):
+        """The entry encode() turned into data, or None if data isn't one."""
+        head, _, body = bytes(data).partition(b'\n')
+        try:
+            url, route, expires, stale, render_time, status_string, headers = json.loads(head)
+            headers = [(str(name), str(value)) for name, value in headers]
+        except (ValueError, TypeError): return None
+        return cls((status_string, headers, body), route, url, expires, render_time, stale)
+
+class JunoFlight(object):
+    """A run of a cached() view that identical requests arriving meanwhile
+    wait for, in threads (wait()) or coroutines (wait_async())."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.rendered = None
+        # (event loop, future) of each waiting coroutine
+        self.waiters = []
+        self.task = None
+
+    def land(self, rendered):
+        """Hands the view's rendered response (None if it can't be shared)
+        to the waiting requests."""
+        with self.lock:
+            self.rendered = rendered
+            self.done.set()
+            waiters, self.waiters = self.waiters, []
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(self.resolve, future)
+
+    def resolve(self, future):
+        if not future.done(): future.set_result(self.rendered)
+
+    def wait(self):
+        self.done.wait()
+        return self.rendered
+
+    async def wait_async(self):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self.lock:
+            if self.done.is_set(): return self.rendered
+            self.waiters.append((loop, future))
+        return await future
+
+class JunoOutputCache(object):
+    """Rendered responses of cached() views, kept in a JunoCacheBackend,
+    with the view runs in progress and per-route hit counters (both for
+    this process)."""
+    def __init__(self, backend):
+        self.backend = backend
+        self.lock = threading.Lock()
+        # key -> JunoFlight
+        self.flights = {}
+        # route url -> [hits, misses, seconds saved, stale hits, coalesced]
+        self.counters = {}
+
+    def lookup(self, key, route):
+        """Returns the entry cached under key, fresh or stale, or None."""
+        entry = self.backend.get(key)
+        now = time.time()
+        if entry is not None and entry.expires + entry.stale <= now:
+            self.backend.delete(key)
+            entry = None
+        with self.lock:
+            counters = self.counters.setdefault(route, [0, 0, 0.0, 0, 0])
+            if entry is None:
+                counters[1] += 1
+                if key in self.flights: counters[4] += 1
+                return None
+            counters[0] += 1
+            counters[2] += entry.render_time
+            if entry.expires <= now: counters[3] += 1
+        return entry
+
+    def get(self, key, route):
+        """Returns the rendered response cached under key, or None."""
+        entry = self.lookup(key, route)
+        if entry is None: return None
+        return entry.rendered
+
+    def shareable(self, rendered):
+        """Whether a rendered response can go to other clients: a complete
+        response that doesn't set cookies."""
+        status_string, headers, body = rendered
+        if not isinstance(body, bytes): return False
+        for name, value in headers:
+            if name.lower() == 'set-cookie': return False
+        return True
+
+    def set(self, key, route, rendered, ttl, render_time=0.0, stale=0):
+        """Caches a rendered response for ttl seconds (and stale seconds
+        more as a stale response), if it is a shareable 200 response."""
+        if not rendered[0].startswith('200') or not self.shareable(rendered): return
+        self.backend.set(key, JunoCacheEntry(rendered, route, key.split('\n')[0],
+                                             time.time() + ttl, render_time, stale))
+
+    def join_flight(self, key):
+        """Returns (flight, leader): the JunoFlight of the view run for key,
+        and whether the caller must run the view (its flight is new) or
+        just wait for it.  The leader must call land() when done."""
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is not None: return flight, False
+            flight = self.flights[key] = JunoFlight()
+            return flight, True
+
+    def land(self, key, flight, rendered):
+        with self.lock:
+            if self.flights.get(key) is flight: del self.flights[key]
+        if rendered is not None and not self.shareable(rendered): rendered = None
+        flight.land(rendered)
+
+    def delete(self, key): self.backend.delete(key)
+    def delete_url(self, url): self.backend.delete_url(url)
+    def delete_route(self, route): self.backend.delete_route(route)
+    def clear(self): self.backend.clear()
+
+    def stats(self):
+        with self.lock:
+            stats = {}
+            for route, (hits, misses, saved, stale, coalesced) in self.counters.items():
+                stats[route] = {'hits': hits, 'misses': misses, 'saved': saved,
+                                'stale': stale, 'coalesced': coalesced,
+                                'hit_rate': hits / float(hits + misses or 1)}
+            return stats
+
+    def __repr__(self):
+        return '<JunoOutputCache: %r>' %self.backend
+
+class JunoCacheBackend(abc.ABC):
+    """Where a JunoOutputCache keeps its JunoCacheEntry objects.  Backends
+    don't need to check expiry times, but must be safe to use from several
+    threads.  Set 'output_cache_backend' to an instance of a subclass to use
+    your own."""
+    @abc.abstractmethod
+    def get(self, key):
+        """Returns the entry stored under key, or None."""
+
+    @abc.abstractmethod
+    def set(self, key, entry): pass
+
+    @abc.abstractmethod
+    def delete(self, key): pass
+
+    @abc.abstractmethod
+    def delete_url(self, url):
+        """Deletes the entries whose url is url."""
+
+    @abc.abstractmethod
+    def delete_route(self, route):
+        """Deletes the entries whose route is route."""
+
+    @abc.abstractmethod
+    def clear(self): pass
+
+class JunoMemoryBackend(JunoCacheBackend):
+    """Keeps entries in this process: a least recently used cache holding
+    at most max_bytes."""
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.bytes = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None: self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry):
+        with self.lock:
+            self.remove(key)
+            if entry.size > self.max_bytes: return
+            self.entries[key] = entry
+            self.bytes += entry.size
+            while self.bytes > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None: self.bytes -= entry.size
+
+    def delete(self, key):
+        with self.lock: self.remove(key)
+
+    def delete_url(self, url):
+        with self.lock:
+            for key in [k for k, e in self.entries.items() if e.url == url]:
+                self.remove(key)
+
+    def delete_route(self, route):
+        with self.lock:
+            for key in [k for k, e in self.entries.items() if e.route == route]:
+                self.remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def __repr__(self):
+        return '<JunoMemoryBackend: %d entries, %d/%d bytes>' %(
+            len(self.entries), self.bytes, self.max_bytes)
+
+class JunoMmapBackend(JunoCacheBackend):
+    """Keeps entries in a file of size bytes that every process maps into
+    memory, so the workers of a prefork server share them.  The file is
+    split into slots of slot_size bytes; a key always goes in the same slot
+    (found by hashing it), replacing what was there.  Entries that don't
+    fit in a slot aren't cached.  Processes take turns with flock()."""
+    # Slot header: data length, expiry time, then lengths of the key, url
+    # and route that follow it
+    header = struct.Struct('!IdHHH')
+
+    def __init__(self, path, size, slot_size=65536):
+        self.path = path
+        self.slot_size = slot_size
+        self.slots = max(1, size // slot_size)
+        self.size = self.slots * slot_size
+        self.lock = threading.Lock()
+        self.pid = None
+
+    def open(self):
+        """Maps the file, again after a fork: flock() locks belong to the
+        open file, which a forked child would share with its parent."""
+        if self.pid == os.getpid(): return
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT | getattr(os, 'O_NOFOLLOW', 0),
+                          0o600)
+        if os.fstat(self.fd).st_size < self.size: os.ftruncate(self.fd, self.size)
+        self.map = mmap.mmap(self.fd, self.size)
+        self.pid = os.getpid()
+
+    def locked(self, operation):
+        """Runs operation() holding the thread lock and the file lock."""
+        import fcntl
+        with self.lock:
+            self.open()
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try: return operation()
+            finally: fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def slot(self, key):
+        digest = hashlib.md5(key.encode('utf-8')).digest()
+        return int.from_bytes(digest[:8], 'big') % self.slots * self.slot_size
+
+    def read(self, offset):
+        """Returns (key, url, route, expires, payload offset, payload
+        length) for the slot at offset, or None if it's empty."""
+        length, expires, key_len, url_len, route_len = \
+            self.header.unpack_from(self.map, offset)
+        if not length: return None
+        start = offset + self.header.size
+        names = []
+        for size in (key_len, url_len, route_len):
+            names.append(self.map[start:start + size].decode('utf-8'))
+            start += size
+        key, url, route = names
+        return key, url, route, expires, start, length - (start - offset)
+
+    def get(self, key):
+        offset = self.slot(key)
+        def get():
+            slot = self.read(offset)
+            if slot is None or slot[0] != key: return None
+            return self.map[slot[4]:slot[4] + slot[5]]
+        data = self.locked(get)
+        if data is None: return None
+        return JunoCacheEntry.decode(data)
+
+    def set(self, key, entry):
+        names = [name.encode('utf-8') for name in (key, entry.url, entry.route)]
+        payload = entry.encode()
+        length = self.header.size + sum(len(name) for name in names) + len(payload)
+        if length > self.slot_size or max(len(name) for name in names) > 0xffff: return
+        offset = self.slot(key)
+        def write():
+            self.header.pack_into(self.map, offset, length, entry.expires + entry.stale,
+                                  *[len(name) for name in names])
+            start = offset + self.header.size
+            data = b''.join(names) + payload
+            self.map[start:start + len(data)] = data
+        self.locked(write)
+
+    def delete_matching(self, test):
+        """Empties every slot for which test(key, url, route) is true."""
+        def delete():
+            for offset in range(0, self.size, self.slot_size):
+                slot = self.read(offset)
+                if slot is not None and test(*slot[:3]):
+                    self.header.pack_into(self.map, offset, 0, 0, 0, 0, 0)
+        self.locked(delete)
+
+    def delete(self, key):
+        offset = self.slot(key)
+        def delete():
+            slot = self.read(offset)
+            if slot is not None and slot[0] == key:
+                self.header.pack_into(self.map, offset, 0, 0, 0, 0, 0)
+        self.locked(delete)
+
+    def delete_url(self, url):
+        self.delete_matching(lambda key, url_, route: url_ == url)
+
+    def delete_route(self, route):
+        self.delete_matching(lambda key, url, route_: route_ == route)
+
+    def clear(self):
+        self.delete_matching(lambda key, url, route: True)
+
+    def __repr__(self):
+        return '<JunoMmapBackend: %s, %d slots of %d bytes>' %(
+            self.path, self.slots, self.slot_size)
+
+class JunoSqliteBackend(JunoCacheBackend):
+    """Keeps entries in a SQLite database file in WAL mode, which every
+    process can use at once, so the workers of a prefork server share them.
+    Holds at most max_bytes; the entries closest to expiring are dropped
+    first."""
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.local = threading.local()
+        # Bytes stored since the size was last checked (by any thread)
+        self.lock = threading.Lock()
+        self.added = 0
+        with self.connection() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS juno_cache (key TEXT PRIMARY KEY,'
+                       ' url TEXT, route TEXT, expires REAL, size INTEGER, value BLOB)')
+            db.execute('CREATE INDEX IF NOT EXISTS juno_cache_url ON juno_cache (url)')
+            db.execute('CREATE INDEX IF NOT EXISTS juno_cache_route ON juno_cache (route)')
+            db.execute('CREATE INDEX IF NOT EXISTS juno_cache_expires ON juno_cache (expires)')
+
+    def connection(self):
+        """This thread's connection (a new one after a fork)."""
+        db = getattr(self.local, 'db', None)
+        if db is None or self.local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None,
+                                 check_same_thread=False)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self.local.db, self.local.pid = db, os.getpid()
+        return db
+
+    def get(self, key):
+        row = self.connection().execute('SELECT value FROM juno_cache WHERE key = ?',
+                                        (key,)).fetchone()
+        if row is None: return None
+        return JunoCacheEntry.decode(row[0])
+
+    def set(self, key, entry):
+        if entry.size > self.max_bytes: return
+        value = entry.encode()
+        db = self.connection()
+        db.execute('INSERT OR REPLACE INTO juno_cache VALUES (?, ?, ?, ?, ?, ?)',
+                   (key, entry.url, entry.route, entry.expires + entry.stale,
+                    entry.size, value))
+        # Summing the sizes reads the whole table, so only do it now and then
+        with self.lock:
+            self.added += entry.size
+            shrink = self.added > self.max_bytes // 16
+            if shrink: self.added = 0
+        if shrink: self.shrink()
+
+    def shrink(self):
+        """Drops expired entries, then the ones closest to expiring until
+        the cache is within max_bytes."""
+        db = self.connection()
+        db.execute('DELETE FROM juno_cache WHERE expires <= ?', (time.time(),))
+        excess = db.execute('SELECT total(size) FROM juno_cache').fetchone()[0] - self.max_bytes
+        if excess <= 0: return
+        for key, size in db.execute('SELECT key, size FROM juno_cache ORDER BY'
+                                    ' expires').fetchall():
+            db.execute('DELETE FROM juno_cache WHERE key = ?', (key,))
+            excess -= size
+            if excess <= 0: break
+
+    def delete(self, key):
+        self.connection().execute('DELETE FROM juno_cache WHERE key = ?', (key,))
+
+    def delete_url(self, url):
+        self.connection().execute('DELETE FROM juno_cache WHERE url = ?', (url,))
+
+    def delete_route(self, route):
+        self.connection().execute('DELETE FROM juno_cache WHERE route = ?', (route,))
+
+    def clear(self):
+        self.connection().execute('DELETE FROM juno_cache')
+
+    def __repr__(self):
+        return '<JunoSqliteBackend: %s>' %self.path
 
 #
 #   Convenience functions for 404s and redirects
 #
 
 def subdirect(web, hub, request):
-    global _hub
     if request == '': request = '/'
     if request[-1] != '/': request += '/'
     if request[ 0] != '/': request = '/' + request
-    if config('log'): print('subdirecting from %s to %s' % (web['PATH_INFO'], request))
-    org, _hub = _hub, hub
+    if settings().log: print('subdirecting from %s to %s' % (web['PATH_INFO'], request))
+    # hub.request() makes hub current for the duration of the call
     status_string, headers, body = hub.request(request, web['REQUEST_METHOD'], **web.raw)
-    _hub = org
+    response = _response_var.get()
     for key, value in headers: header(key, value)
     status(int(status_string.split()[0]))
-    if _response.body != body: append(body) #FIXME
-    return _response
+    if response.body != body: append(body) #FIXME
+    return response
 
 def redirect(url, code=302):
     status(code)
     # clear the response headers and add the location header
-    _response.config['headers'] = { 'Location': url }
-    return _response
+    response = _response_var.get()
+    response.config['headers'] = { 'Location': url }
+    return response
 
 def direct(web, request, **kwargs):
-    status_string, headers, body = _hub.request(
+    status_string, headers, body = getHub().request(
         request, web['REQUEST_METHOD'], params=kwargs, **web.raw)
+    response = _response_var.get()
     for key, value in headers: header(key, value)
     status(int(status_string.split()[0]))
-    if _response.body != body: append(body) #FIXME
-    return _response
+    if response.body != body: append(body) #FIXME
+    return response
 
 def assign(from_, to):
     if type(from_) not in (list, tuple): from_ = [from_]
@@ -577,30 +2221,121 @@ def assign(from_, to):
         def temp(web): redirect(to)
 
 def notfound(error='Unspecified error', file=None):
-    """Sets the response to a 404, sets the body to 404_template."""
-    if config('log'): print('Not Found: %s' % error, file=sys.stderr)
+    """Sets the response to a 404, sets the body to 404_template, with error
+    (HTML-escaped) in it."""
+    if settings().log: log_error('Not Found: %s' % error)
     status(404)
-    mt = config('404_mimetype')
-    if mt:
-        content_type(mt)
-    if file is None: file = config('404_template')
-    return template(file, error=error)
-
-def servererror(error='Unspecified error', file=None):
-    """Sets the response to a 500, sets the body to 500_template."""
+    return error_page(404, error, file)
+
+def servererror(error=None, file=None):
+    """Sets the response to a 500, sets the body to 500_template, with error
+    (HTML-escaped) in it.  error defaults to the traceback of the exception
+    being handled if '500_show_traceback' is on, 'Unspecified error' if not."""
     t, v, tb = sys.exc_info()
-    if config('log'):
-        print('Error: (%s, %s)' % (t, v), file=sys.stderr)
-        if config('500_traceback'):
-            traceback.print_tb(tb)
+    s = settings()
+    if s.log: log_error('Error: (%s, %s)' % (t, v), getattr(s, '500_traceback') and tb)
+    if error is None:
+        if tb is not None and getattr(s, '500_show_traceback'): error = traceback.format_exc()
+        else: error = 'Unspecified error'
     status(500)
-    mt = config('500_mimetype')
-    if mt:
-        content_type(mt)
-    if file is None: file = config('500_template')
     # Resets the response, in case the error occurred as we added data to it
-    _response.config['body'] = ''
-    return template(file, error=error)
+    _response_var.get().clear()
+    return error_page(500, error, file)
+
+def error_page(code, error, file=None):
+    """Appends the page for an error status to the response: file (by
+    default the '404_template' or '500_template') with error in it.  The
+    page is only rendered the first time; after that error is just put in
+    its place (see Juno.get_error_page())."""
+    s = settings()
+    mimetype = getattr(s, '%d_mimetype' % code)
+    if mimetype: content_type(mimetype)
+    if file is None: file = getattr(s, '%d_template' % code)
+    error = escape_error(error)
+    template_obj, parts = getHub().get_error_page(code, file)
+    if parts is None: return append(render_error_page(code, template_obj, error))
+    return append(error.join(parts))
+
+# Juno's own error page, for when there are no templates
+builtin_error_page = """<!DOCTYPE html>
+<html><head><title>%(status)s</title></head>
+<body><h1>%(status)s</h1>
+<pre>%(error)s</pre>
+</body></html>
+"""
+
+# Stands in for the error when an error page is rendered to be cached
+error_marker = 'juno-error-%s' % os.urandom(8).hex()
+
+def escape_error(error):
+    """error, HTML-escaped - unless it is markup already (has __html__, like
+    markupsafe.Markup)."""
+    if hasattr(error, '__html__'): return error.__html__()
+    return html.escape(str(error))
+
+@functools.lru_cache(maxsize=None)
+def markup_class():
+    """markupsafe.Markup (which Jinja2 autoescaping leaves alone), or str if
+    it isn't installed."""
+    try: from markupsafe import Markup
+    except ImportError: return str
+    return Markup
+
+def render_error_page(code, template_obj, error):
+    """Renders template_obj with error (escaped already) in it, or Juno's own
+    page if template_obj is None."""
+    if template_obj is None:
+        return builtin_error_page %{'error': error,
+            'status': '%d %s' %(code, JunoResponse.status_codes[code])}
+    page = render_template(template_obj, error=markup_class()(error))
+    if isinstance(page, bytes): page = page.decode(settings().charset)
+    return page
+
+def split_error_page(code, template_obj):
+    """Renders an error page once, with a marker for the error.  Returns the
+    page split at the marker, or None if the template changes the error, so
+    the page can't be cached."""
+    page = render_error_page(code, template_obj, error_marker)
+    parts = page.split(error_marker)
+    if len(parts) > 1: return parts
+    # Either the page doesn't show the error at all, or it changes it
+    if render_error_page(code, template_obj, error_marker[::-1]) == page: return parts
+    return None
+
+class JunoLogLimiter(object):
+    """Lets at most rate log messages a second through; counts the others."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.second = 0
+        self.count = 0
+        self.left_out = 0
+
+    def allow(self, rate):
+        """Returns None if a message can't be logged now, or else how many
+        messages were left out since the last one logged."""
+        if not rate: return 0
+        now = int(time.monotonic())
+        with self.lock:
+            if now != self.second: self.second, self.count = now, 0
+            if self.count >= rate:
+                self.left_out += 1
+                return None
+            self.count += 1
+            left_out, self.left_out = self.left_out, 0
+            return left_out
+
+_error_log = JunoLogLimiter()
+
+def log_error(message, tb=None):
+    """Prints message (and the traceback tb) to stderr - unless
+    'log_rate_limit' messages were printed this second already, so a flood
+    of bad requests can't flood the log.  The next message printed says how
+    many were left out."""
+    left_out = _error_log.allow(settings().log_rate_limit)
+    if left_out is None: return
+    if left_out: message += ' (%d more not logged)' % left_out
+    print(message, file=sys.stderr)
+    if tb: traceback.print_tb(tb)
 
 #
 #   Serve static files.
@@ -608,30 +2343,408 @@ def servererror(error='Unspecified error', file=None):
 
 def static_serve(web, file):
     """The default static file serve function. Maps arguments to dir structure."""
-    file = os.path.join(config('static_root'), file)
-    realfile = os.path.realpath(file)
-    if not realfile.startswith(os.path.realpath(config('static_root'))):
-        notfound("that file could not be found/served")
-    elif yield_file(file) != 7:
-        notfound("that file could not be found/served")
-    mtime = os.stat(file).st_mtime
-    header('Last-Modified', time.strftime('%a, %d %b %Y %H:%M:%S +0000', time.gmtime(mtime)))
-    if config('static_expires'):
-        header('Expires', time.strftime('%a, %d %b %Y %H:%M:%S +0000', time.gmtime(time.time() + config('static_expires'))))
-
-def yield_file(filename, type=None):
+    cache = getHub().get_static_cache()
+    # Make sure the path stays inside static_root before the cache (or the
+    # file) is touched: '..' is resolved here, and cache.get() checks where
+    # symlinks lead before it reads a file
+    s = settings()
+    root = cache.realpath(s.static_root)
+    path = os.path.normpath(os.path.join(root, file))
+    if not path.startswith(root if root.endswith(os.sep) else root + os.sep):
+        return notfound("that file could not be found/served")
+    entry = cache.get(path, root)
+    if entry is None: return notfound("that file could not be found/served")
+    # A compressed copy, if the client takes one (not for partial requests)
+    etag, encoding, compressed = entry.etag, None, None
+    if s.use_compression and 'HTTP_RANGE' not in web.raw \
+        and compressible(entry.mimetype or 'text/plain'):
+        header('Vary', 'Accept-Encoding')
+        encoding = choose_encoding(web.raw.get('HTTP_ACCEPT_ENCODING'))
+        if encoding is not None: compressed = cache.compressed(entry, encoding)
+        if compressed is not None: etag = '%s-%s"' %(entry.etag[:-1], encoding)
+    header('Last-Modified', entry.last_modified)
+    header('ETag', etag)
+    header('Accept-Ranges', 'bytes')
+    if s.static_expires:
+        header('Expires', time.strftime('%a, %d %b %Y %H:%M:%S +0000', time.gmtime(time.time() + s.static_expires)))
+    if s.static_cache_header: header('Cache-Control', s.static_cache_header)
+    # The client's copy is up to date - don't send (or even open) the file
+    if not modified_since(web, etag, entry.stat.st_mtime):
+        status(304)
+        _response_var.get().config['headers'].pop('Content-Length', None)
+        return
+    if compressed is not None:
+        content_type(entry.mimetype or 'text/plain')
+        header('Content-Encoding', encoding)
+        append(compressed)
+        return
+    # Send only the requested part of the file, unless it changed since the
+    # client got the first part
+    byte_range = None
+    if web.raw.get('HTTP_IF_RANGE', entry.etag) in (entry.etag, entry.last_modified):
+        byte_range = parse_range(web.raw.get('HTTP_RANGE'), entry.stat.st_size)
+    if byte_range is None:
+        send_static_entry(entry)
+        return
+    start, stop = byte_range
+    if start >= stop:
+        status(416)
+        header('Content-Range', 'bytes */%d' %entry.stat.st_size)
+        return
+    status(206)
+    header('Content-Range', 'bytes %d-%d/%d' %(start, stop - 1, entry.stat.st_size))
+    send_static_entry(entry, offset=start, length=stop - start)
+
+def modified_since(web, etag, mtime):
+    """False if a conditional request's If-None-Match or If-Modified-Since
+    header shows the client already has this version of a resource."""
+    if 'HTTP_IF_NONE_MATCH' in web.raw:
+        tags = [tag.strip() for tag in web.raw['HTTP_IF_NONE_MATCH'].split(',')]
+        # Weak comparison: 'W/"x"' matches '"x"'
+        tags = [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+        return etag not in tags and '*' not in tags
+    if 'HTTP_IF_MODIFIED_SINCE' in web.raw:
+        since = email.utils.parsedate_tz(web.raw['HTTP_IF_MODIFIED_SINCE'])
+        if since is None: return True
+        # Dates only have whole seconds
+        return int(mtime) > email.utils.mktime_tz(since)
+    return True
+
+def parse_range(value, size):
+    """Parses a 'Range: bytes=...' header for a file of size bytes.  Returns
+    (start, stop), which is empty (start == stop) if the range can't be
+    satisfied, or None if the header should be ignored (it's missing,
+    invalid, or asks for several ranges)."""
+    if not value or not value.startswith('bytes=') or ',' in value: return None
+    first, sep, last = value[len('bytes='):].strip().partition('-')
+    if not sep or not (first or last) or not (first + last).isdigit(): return None
+    if not first:
+        # 'bytes=-500' is the last 500 bytes
+        return (max(0, size - int(last)), size) if int(last) else (size, size)
+    start = int(first)
+    if last and int(last) < start: return None
+    if start >= size: return (size, size)
+    return (start, min(int(last) + 1, size) if last else size)
+
+def yield_file(filename, type=None, offset=0, length=None):
     """Append the content of a file to the response. Guesses file type if not
     included.  Returns 1 if requested file can't be accessed (often means doesn't
-    exist).  Returns 2 if requested file is a directory.  Returns 7 on success. """
-    if not os.access(filename, os.F_OK): return 1
-    if os.path.isdir(filename): return 2
+    exist).  Returns 2 if requested file is a directory.  Returns 7 on success.
+    offset and length select part of the file.  Small files come from the
+    static cache; others are streamed when the response is sent, rather than
+    read into memory here. """
+    entry = getHub().get_static_cache().get(filename)
+    if entry is None:
+        if os.path.isdir(filename): return 2
+        return 1
+    send_static_entry(entry, type, offset, length)
+    return 7
+
+def send_static_entry(entry, type=None, offset=0, length=None):
+    """Appends a file the static cache has an entry for to the response, like
+    yield_file() (which looks the entry up first)."""
     if type is None:
-        guess = mimetypes.guess_type(filename)[0]
-        if guess is None: content_type('text/plain')
-        else: content_type(guess)
+        if entry.mimetype is None: content_type('text/plain')
+        else: content_type(entry.mimetype)
     else: content_type(type)
-    append(open(filename, 'rb').read())
-    return 7
+    if length is None: length = entry.stat.st_size - offset
+    if entry.data is None: append(JunoFile(entry.path, offset, length))
+    elif offset == 0 and length == len(entry.data): append(entry.data)
+    else: append(entry.data[offset:offset + length])
+
+class JunoStaticEntry(object):
+    """What Juno knows about a static file: its stat() result, MIME type and
+    validators, and its contents if it is small.  Raises OSError if the file
+    can't be read, and IsADirectoryError if it isn't a regular file."""
+    # Roughly what an entry costs besides the file's contents
+    overhead = 1024
+
+    def __init__(self, path, max_data=0):
+        self.path = path
+        self.stat = os.stat(path)
+        if not stat.S_ISREG(self.stat.st_mode): raise IsADirectoryError(path)
+        self.mimetype = mimetypes.guess_type(path)[0]
+        self.last_modified = email.utils.formatdate(self.stat.st_mtime, usegmt=True)
+        self.etag = '"%x-%x-%x"' %(self.stat.st_ino, self.stat.st_size,
+                                   self.stat.st_mtime_ns)
+        self.data = None
+        # Compressed copies of data, and precompressed sibling files (or
+        # None if there is none), by content coding
+        self.compressed = {}
+        self.siblings = {}
+        if self.stat.st_size <= max_data:
+            with open(path, 'rb') as f: data = f.read()
+            # Keep it only if the file didn't change while we read it
+            if len(data) == self.stat.st_size: self.data = data
+        self.size = self.overhead + len(self.data or b'')
+        self.checked = time.time()
+
+    def changed(self, interval=0):
+        """Whether the file changed since the entry was made, checking
+        at most once every interval seconds."""
+        now = time.time()
+        if now - self.checked < interval: return False
+        try: current = os.stat(self.path)
+        except OSError: return True
+        if (current.st_ino, current.st_size, current.st_mtime_ns) != \
+            (self.stat.st_ino, self.stat.st_size, self.stat.st_mtime_ns):
+            return True
+        self.checked = now
+        return False
+
+    def __repr__(self):
+        return '<JunoStaticEntry: %s %d bytes%s>' %(self.path, self.stat.st_size,
+            ', cached' if self.data is not None else '')
+
+class JunoStaticCache(object):
+    """A least recently used cache of JunoStaticEntry objects, keyed by path.
+    Holds at most max_bytes (file contents included); only files of at most
+    max_file_size bytes have their contents cached.  Entries are checked
+    against the file's mtime, size and inode, at most once every
+    check_interval seconds."""
+    def __init__(self, max_bytes, max_file_size, check_interval=0):
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self.check_interval = check_interval
+        self.entries = collections.OrderedDict()
+        self.roots = {}
+        self.lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, path, root=None):
+        """Returns the entry for the file at path, or None if it isn't a
+        readable file - or, given a root, if the file isn't inside it once
+        symlinks are resolved."""
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None: self.entries.move_to_end(path)
+        if entry is not None and not entry.changed(self.check_interval):
+            with self.lock: self.hits += 1
+            return entry
+        # Don't read contents that couldn't be kept anyway
+        max_data = min(self.max_file_size, self.max_bytes - JunoStaticEntry.overhead)
+        try:
+            if root is not None and not os.path.realpath(path).startswith(
+                root if root.endswith(os.sep) else root + os.sep): raise OSError
+            entry = JunoStaticEntry(path, max_data)
+        except OSError: entry = None
+        with self.lock:
+            self.misses += 1
+            self.remove(path)
+            if entry is not None and entry.size <= self.max_bytes:
+                self.entries[path] = entry
+                self.bytes += entry.size
+                while self.bytes > self.max_bytes:
+                    self.remove(next(iter(self.entries)))
+                    self.evictions += 1
+        return entry
+
+    def compressed(self, entry, encoding):
+        """Returns the body to send for entry in a content coding: its
+        precompressed sibling ('.gz' or '.br' file), if it has an up to date
+        one, or else its contents compressed (once, then kept in the entry).
+        None for big files without a sibling."""
+        if encoding not in entry.siblings:
+            path = entry.path + encoding_suffixes[encoding]
+            entry.siblings[encoding] = path if os.path.isfile(path) else None
+        if entry.siblings[encoding] is not None:
+            sibling = self.get(entry.siblings[encoding])
+            if sibling is not None and sibling.stat.st_mtime >= entry.stat.st_mtime:
+                if sibling.data is not None: return sibling.data
+                return JunoFile(sibling.path, 0, sibling.stat.st_size)
+        if entry.data is None: return None
+        if encoding not in entry.compressed:
+            data = compress(entry.data, encoding)
+            with self.lock:
+                entry.compressed[encoding] = data
+                if self.entries.get(entry.path) is entry:
+                    entry.size += len(data)
+                    self.bytes += len(data)
+        return entry.compressed[encoding]
+
+    def remove(self, path):
+        entry = self.entries.pop(path, None)
+        if entry is not None: self.bytes -= entry.size
+
+    def realpath(self, path):
+        """os.path.realpath(), remembered (for static_root)."""
+        if path not in self.roots: self.roots[path] = os.path.realpath(path)
+        return self.roots[path]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.roots.clear()
+            self.bytes = 0
+
+    def stats(self):
+        """Counters for monitoring: hits, misses, evictions, entries and
+        bytes in use."""
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'entries': len(self.entries),
+                    'bytes': self.bytes}
+
+    def __repr__(self):
+        return '<JunoStaticCache: %d entries, %d/%d bytes>' %(
+            len(self.entries), self.bytes, self.max_bytes)
+
+class JunoFile(object):
+    """A response body read from a file (or length bytes of it, starting at
+    offset) as it is sent, instead of all at once."""
+    block_size = 65536
+
+    def __init__(self, path, offset=0, length=None):
+        self.path = path
+        self.offset = offset
+        if length is None: length = os.path.getsize(path) - offset
+        self.length = length
+
+    def __len__(self): return self.length
+
+    def open(self):
+        f = open(self.path, 'rb')
+        f.seek(self.offset)
+        return f
+
+    def __iter__(self):
+        with self.open() as f:
+            remaining = self.length
+            while remaining > 0:
+                data = f.read(min(self.block_size, remaining))
+                if not data: break
+                remaining -= len(data)
+                yield data
+
+    def wrap(self, file_wrapper):
+        """Returns the body to give a WSGI server: the file in its
+        wsgi.file_wrapper if it has one (which may use sendfile()), or
+        else the file in chunks."""
+        if file_wrapper is JunoFileWrapper:
+            return JunoFileWrapper(self.open(), self.block_size, self.length)
+        # Other servers' wrappers send everything up to the end of the file
+        if file_wrapper is None or \
+            self.offset + self.length != os.path.getsize(self.path):
+            return self
+        return file_wrapper(self.open(), self.block_size)
+
+    def __repr__(self):
+        return '<JunoFile: %s %d+%d>' %(self.path, self.offset, self.length)
+
+#
+#   JSON
+#
+
+@functools.lru_cache(maxsize=None)
+def orjson_module():
+    """The orjson module, or None if it isn't installed."""
+    try: import orjson
+    except ImportError: return None
+    return orjson
+
+def json_dumps(data):
+    """Serializes data to JSON, as UTF-8 bytes.  Uses orjson if it is
+    installed (and 'use_orjson' is on), the json module otherwise."""
+    orjson = settings().use_orjson and orjson_module()
+    if orjson:
+        # orjson refuses some things json takes, like integers over 64 bits
+        try: return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError: pass
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def json_loads(data):
+    """Decodes JSON bytes, with orjson if it is installed.  Raises
+    ValueError for invalid JSON."""
+    orjson = settings().use_orjson and orjson_module()
+    if orjson: return orjson.loads(data)
+    return json.loads(data)
+
+#
+#   Compression
+#
+
+encoding_suffixes = {'br': '.br', 'gzip': '.gz'}
+
+@functools.lru_cache(maxsize=None)
+def available_encodings():
+    """The content codings Juno can compress with, best first.  Brotli
+    needs the brotli package."""
+    try: import brotli
+    except ImportError: return ('gzip',)
+    return ('br', 'gzip')
+
+def choose_encoding(accept):
+    """Picks the content coding to use for an Accept-Encoding header, or
+    None to send the body as it is."""
+    if not accept: return None
+    quality = {}
+    for item in accept.split(','):
+        name, _, params = item.partition(';')
+        q = 1.0
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try: q = float(value)
+                except ValueError: q = 0.0
+        quality[name.strip().lower()] = q
+    best = None
+    for encoding in available_encodings():
+        q = quality.get(encoding, quality.get('*', 0.0))
+        if q > 0 and (best is None or q > best[0]): best = (q, encoding)
+    if best is None: return None
+    return best[1]
+
+def compressible(content_type):
+    """Whether a Content-Type is worth compressing (see 'compress_types')."""
+    content_type = content_type.split(';')[0].strip().lower()
+    for prefix in settings().compress_types:
+        if content_type.startswith(prefix): return True
+    return False
+
+def compress(data, encoding, level=None):
+    """Compresses bytes with a content coding ('gzip' or 'br')."""
+    if encoding == 'br':
+        import brotli
+        if level is None: level = settings().compress_brotli_quality
+        return brotli.compress(data, quality=level)
+    if level is None: level = settings().compress_level
+    return gzip.compress(data, level, mtime=0)
+
+def compress_response(environ, status_str, headers, body):
+    """Compresses a rendered 200 body for clients that accept it, if it is
+    text-like and at least 'compress_min_size' bytes.  Returns the new
+    headers and body."""
+    s = settings()
+    if not s.use_compression or not isinstance(body, bytes) \
+        or len(body) < s.compress_min_size or not status_str.startswith('200'):
+        return headers, body
+    names = dict((name.lower(), value) for name, value in headers)
+    # A range is a range of the uncompressed body
+    if 'content-encoding' in names or 'content-range' in names \
+        or not compressible(names.get('content-type', '')):
+        return headers, body
+    encoding = choose_encoding(environ.get('HTTP_ACCEPT_ENCODING'))
+    vary = names.get('vary')
+    headers = [(name, value) for name, value in headers
+               if name.lower() != 'vary' and (encoding is None or
+                   name.lower() not in ('content-length', 'etag'))]
+    if not vary: vary = 'Accept-Encoding'
+    elif 'accept-encoding' not in [v.strip().lower() for v in vary.split(',')]:
+        vary += ', Accept-Encoding'
+    headers.append(('Vary', vary))
+    if encoding is None: return headers, body
+    body = compress(body, encoding)
+    headers.append(('Content-Encoding', encoding))
+    headers.append(('Content-Length', str(len(body))))
+    # The compressed body is a different representation
+    if 'etag' in names:
+        etag = names['etag']
+        if etag.endswith('"'): etag = '%s-%s"' %(etag[:-1], encoding)
+        headers.append(('ETag', etag))
+    return headers, body
 
 #
 #   Templating
@@ -639,7 +2752,10 @@ def yield_file(filename, type=None):
 
 def template(template_path, template_dict=None, **kwargs):
     """Append a rendered template to response.  If template_dict is provided,
-    it is passed to the render function.  If not, kwargs is."""
+    it is passed to the render function.  If not, kwargs is.  With
+    'stream_templates' on, the template is streamed (see stream_template())."""
+    if settings().stream_templates:
+        return stream_template(template_path, template_dict, **kwargs)
     # Retreive a template object.
     t = get_template(template_path)
     # Render it without arguments.
@@ -655,7 +2771,7 @@ def get_template(template_path):
     """Returns a template object by calling the default value of
     'get_template_handler'.  Allows getting a template to be the same
     regardless of template library."""
-    return config('get_template_handler')(template_path)
+    return settings().get_template_handler(template_path)
 
 # The default value of config('get_template_handler')
 def _get_template_handler(template_path):
@@ -665,11 +2781,18 @@ def _get_template_handler(template_path):
     to return an object that will be passed to your rendering function."""
     return config('template_env').get_template(template_path)
 
-def render_template(template_obj, **kwargs):
+def render_template(template_obj, _cache_key=None, _cache_ttl=60, **kwargs):
     """Renders a template object by using the default value of
     'render_template_handler'.  Allows rendering a template to be consistent
-    regardless of template library."""
-    return config('render_template_handler')(template_obj, **kwargs)
+    regardless of template library.  With a _cache_key, the rendering is
+    kept in the fragment cache for _cache_ttl seconds, per template and key
+    (see cache_fragment())."""
+    handler = settings().render_template_handler
+    if _cache_key is None: return handler(template_obj, **kwargs)
+    name = getattr(template_obj, 'name', None) or getattr(template_obj, 'uri', None) \
+        or repr(template_obj)
+    return cache_fragment(name, _cache_key, _cache_ttl,
+                          lambda: handler(template_obj, **kwargs))
 
 # The default value of config('render_template_handler')
 def _render_template_handler(template_obj, **kwargs):
@@ -679,6 +2802,262 @@ def _render_template_handler(template_obj, **kwargs):
     optional **kwargs parameter.  Needs to return a string."""
     return template_obj.render(**kwargs)
 
+def cache_fragment(name, key, ttl, render):
+    """Returns the fragment cached under name and key, or else render()'s
+    result, which is cached for ttl seconds.  name groups a fragment's
+    entries, for invalidate_fragment() and fragment_cache_stats(); key is
+    what it varies by (a user id, a language...).  {% cache %} blocks in
+    Jinja2 templates and cached blocks in Mako templates use this."""
+    if isinstance(key, list): key = tuple(key)
+    cache = getHub().get_fragment_cache()
+    value = cache.get(name, key)
+    if value is None:
+        value = render()
+        cache.set(name, key, value, ttl)
+    return value
+
+def invalidate_fragment(name, key=None):
+    """Drops a cached fragment, or every entry of name if key is None.
+    Jinja2 {% cache %} blocks are named 'template name:line'."""
+    if isinstance(key, list): key = tuple(key)
+    getHub().get_fragment_cache().delete(name, key)
+
+def fragment_cache_stats():
+    """Fragment cache counters per fragment name: hits, misses, hit_rate."""
+    return getHub().get_fragment_cache().stats()
+
+class JunoFragmentCache(object):
+    """Cached template fragments of this process, by fragment name and key:
+    a least recently used cache holding at most max_bytes, with hit
+    counters per name."""
+    # Roughly what an entry costs besides its text
+    overhead = 256
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        # (name, key) -> (value, expires, size)
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.bytes = 0
+        # name -> [hits, misses]
+        self.counters = {}
+
+    def get(self, name, key):
+        """Returns the fragment cached under name and key, or None."""
+        with self.lock:
+            counters = self.counters.setdefault(name, [0, 0])
+            entry = self.entries.get((name, key))
+            if entry is not None and entry[1] <= time.time():
+                self.remove((name, key))
+                entry = None
+            if entry is None:
+                counters[1] += 1
+                return None
+            self.entries.move_to_end((name, key))
+            counters[0] += 1
+            return entry[0]
+
+    def set(self, name, key, value, ttl):
+        size = self.overhead + len(value)
+        with self.lock:
+            self.remove((name, key))
+            if size > self.max_bytes: return
+            self.entries[(name, key)] = (value, time.time() + ttl, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+
+    def remove(self, entry_key):
+        entry = self.entries.pop(entry_key, None)
+        if entry is not None: self.bytes -= entry[2]
+
+    def delete(self, name, key=None):
+        with self.lock:
+            if key is not None: self.remove((name, key))
+            else:
+                for entry_key in [k for k in self.entries if k[0] == name]:
+                    self.remove(entry_key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self.lock:
+            stats = {}
+            for name, (hits, misses) in self.counters.items():
+                stats[name] = {'hits': hits, 'misses': misses,
+                               'hit_rate': hits / float(hits + misses or 1)}
+            return stats
+
+    def __repr__(self):
+        return '<JunoFragmentCache: %d entries, %d/%d bytes>' %(
+            len(self.entries), self.bytes, self.max_bytes)
+
+@functools.lru_cache(maxsize=None)
+def jinja2_cache_extension():
+    """The Jinja2 extension adding {% cache %} blocks, made on first use so
+    Jinja2 is only imported when it is used."""
+    import jinja2.ext
+    import jinja2.nodes
+
+    class JunoCacheExtension(jinja2.ext.Extension):
+        """{% cache key, ttl %}...{% endcache %} keeps what is inside in the
+        fragment cache for ttl seconds (60 if left out), per value of key.
+        Each block is a fragment of its own, named 'template name:line'."""
+        tags = {'cache'}
+
+        def parse(self, parser):
+            lineno = next(parser.stream).lineno
+            name = jinja2.nodes.Const('%s:%d' %(parser.name, lineno))
+            key = parser.parse_expression()
+            if parser.stream.skip_if('comma'): ttl = parser.parse_expression()
+            else: ttl = jinja2.nodes.Const(60)
+            body = parser.parse_statements(['name:endcache'], drop_needle=True)
+            call = self.call_method('cache', [name, key, ttl])
+            return jinja2.nodes.CallBlock(call, [], [], body).set_lineno(lineno)
+
+        def cache(self, name, key, ttl, caller):
+            return cache_fragment(name, key, ttl, caller)
+
+    return JunoCacheExtension
+
+class JunoMakoCache(object):
+    """Mako cache plugin ('cache_impl': 'juno', the default Juno sets up)
+    keeping cached blocks and defs in the fragment cache, named after their
+    template:
+
+        <%block name="sidebar" cached="True" cache_key="${user.id}"
+                cache_timeout="300">
+    """
+    pass_context = False
+
+    def __init__(self, cache):
+        self.name = cache.template.uri
+
+    def ttl(self, kw):
+        return float(kw.get('timeout') or 60)
+
+    def get_or_create(self, key, creation_function, **kw):
+        return cache_fragment(self.name, key, self.ttl(kw), creation_function)
+
+    def set(self, key, value, **kw):
+        getHub().get_fragment_cache().set(self.name, key, value, self.ttl(kw))
+
+    def get(self, key, **kw):
+        return getHub().get_fragment_cache().get(self.name, key)
+
+    def invalidate(self, key, **kw):
+        invalidate_fragment(self.name, key)
+
+def stream_template(template_path, template_dict=None, **kwargs):
+    """Append a template to the response as a stream: it is rendered as it
+    is sent, in chunks of at least 'template_chunk_size' characters, so the
+    page never has to be in memory whole and the browser gets its head (and
+    starts fetching CSS and scripts) early."""
+    t = get_template(template_path)
+    if template_dict: kwargs = template_dict
+    chunks = settings().stream_template_handler(t, **kwargs)
+    size = settings().template_chunk_size
+    if size: chunks = buffer_chunks(chunks, size)
+    return append(chunks)
+
+# The default value of config('stream_template_handler')
+def _stream_template_handler(template_obj, **kwargs):
+    """Returns an iterator over the pieces of a template as it renders -
+    Jinja2's generate(), or a JunoMakoStream for Mako.  Other template
+    objects are rendered whole, with 'render_template_handler'."""
+    if hasattr(template_obj, 'generate'): return template_obj.generate(**kwargs)
+    if hasattr(template_obj, 'render_context'):
+        return JunoMakoStream(template_obj, kwargs, settings().template_chunk_size)
+    return iter([render_template(template_obj, **kwargs)])
+
+def buffer_chunks(chunks, size):
+    """Joins the (text) pieces of chunks into chunks of at least size
+    characters; the last may be smaller."""
+    pieces = iter(chunks)
+    buffer, length, batch = [], 0, 1
+    try:
+        while True:
+            # Template engines make lots of tiny pieces; join them a batch
+            # at a time (of up to 64, going by their size so far) rather
+            # than looking at each one
+            joined = list(itertools.islice(pieces, batch))
+            if not joined: break
+            text = ''.join(joined)
+            buffer.append(text)
+            length += len(text)
+            batch = max(1, min(64, size * len(joined) // (len(text) or 1)))
+            if length >= size:
+                yield ''.join(buffer)
+                buffer, length = [], 0
+        if buffer: yield ''.join(buffer)
+    finally:
+        if hasattr(chunks, 'close'): chunks.close()
+
+class JunoMakoStream(object):
+    """Renders a Mako template in another thread, and iterates over what it
+    writes as it is written, in chunks of at least chunk_size characters.
+    At most size chunks wait to be sent, so a slow client holds the
+    rendering back rather than filling memory.  Exceptions the template
+    raises are raised by the iteration."""
+    # Marks the end of the template
+    end = object()
+
+    def __init__(self, template_obj, kwargs, chunk_size=8192, size=16):
+        self.template_obj = template_obj
+        self.kwargs = kwargs
+        self.chunk_size = chunk_size
+        self.pieces = queue.Queue(size)
+        self.closed = False
+        # Mako writes many small pieces; handing each one to the other
+        # thread would cost more than making it
+        self.buffer = []
+        self.length = 0
+
+    def __iter__(self):
+        # The rendering starts once the body is sent, not before
+        thread = threading.Thread(target=contextvars.copy_context().run,
+                                  args=(self.render,), daemon=True)
+        thread.start()
+        try:
+            while True:
+                piece = self.pieces.get()
+                if piece is self.end: return
+                if isinstance(piece, BaseException): raise piece
+                yield piece
+        finally: self.close()
+
+    def render(self):
+        import mako.runtime
+        try:
+            self.template_obj.render_context(mako.runtime.Context(self, **self.kwargs))
+            if self.buffer: self.put(''.join(self.buffer))
+            end = self.end
+        except BaseException as e: end = e
+        try: self.put(end)
+        except IOError: pass
+
+    def write(self, piece):
+        """Called by Mako with each piece of the template."""
+        self.buffer.append(piece)
+        self.length += len(piece)
+        if self.length >= self.chunk_size:
+            chunk = ''.join(self.buffer)
+            self.buffer, self.length = [], 0
+            self.put(chunk)
+
+    def put(self, piece):
+        while not self.closed:
+            try: return self.pieces.put(piece, timeout=1)
+            except queue.Full: pass
+        # Stops the rendering once nobody reads it
+        raise IOError('Stream closed')
+
+    def close(self):
+        self.closed = True
+
 def autotemplate(urls, template_path, **kwargs):
     """Automatically renders a template for a given path.  Currently can't
     use any arguments in the url."""
@@ -696,7 +3075,60 @@ def autotemplate(urls, template_path, **kwargs):
 # Map SQLAlchemy's types to string versions of them for convenience
 column_mapping = {} # Constructed in Juno.setup_database
 
-session = lambda: config('db_session')()
+def session():
+    """The current request's database session, opened the first time it is
+    asked for.  Outside of requests, each thread has its own."""
+    return config('db_session')()
+
+def db_scope():
+    """Tells the database sessions of requests apart (see Juno.db_scoped())."""
+    return _db_scope_var.get() or threading.get_ident()
+
+def finish_db_session(db_session, commit):
+    """Commits (or rolls back) and closes a request's database session."""
+    try:
+        if commit: db_session.commit()
+        else: db_session.rollback()
+    except Exception:
+        db_session.rollback()
+        raise
+    finally: db_session.close()
+
+class JunoDbStream(object):
+    """A streamed body run in its request's database scope: each chunk is
+    produced with the request's session, which is committed and closed when
+    the body is closed (rolled back if producing the body failed)."""
+    def __init__(self, body, db_session, scope):
+        self.body = body
+        self.db_session = db_session
+        self.scope = scope
+        self.ok = True
+
+    def __iter__(self):
+        chunks = iter(self.body)
+        while True:
+            # Chunks may be pulled from any thread or context (the ASGI
+            # application uses an executor), so the scope is set for each
+            token = _db_scope_var.set(self.scope)
+            try: chunk = next(chunks)
+            except StopIteration: return
+            except:
+                self.ok = False
+                raise
+            finally: _db_scope_var.reset(token)
+            yield chunk
+
+    def close(self):
+        token = _db_scope_var.set(self.scope)
+        try:
+            if hasattr(self.body, 'close'): self.body.close()
+        finally:
+            try:
+                if self.db_session.registry.has():
+                    db_session = self.db_session()
+                    self.db_session.registry.clear()
+                    finish_db_session(db_session, self.ok)
+            finally: _db_scope_var.reset(token)
 
 def model(model_name, **kwargs):
     if not _hub: init()
@@ -774,53 +3206,18 @@ def get_application(process_func):
             print('Error: environ is None for some reason.', file=sys.stderr)
             print('Error: environ=%s' %environ, file=sys.stderr)
             sys.exit()
-        # Ensure some variable exist (WSGI doesn't guarantee them)
-        if 'PATH_INFO' not in list(environ.keys()) or not environ['PATH_INFO']:
-            environ['PATH_INFO'] = '/'
-        if 'QUERY_STRING' not in list(environ.keys()):
-            environ['QUERY_STRING'] = ''
-        if 'CONTENT_LENGTH' not in list(environ.keys()) or not environ['CONTENT_LENGTH']:
-            environ['CONTENT_LENGTH'] = '0'
-        # Standardize some header names
-        environ['DOCUMENT_URI'] = environ['PATH_INFO']
-        if environ['QUERY_STRING']:
-            environ['REQUEST_URI'] = environ['PATH_INFO']+'?'+environ['QUERY_STRING']
-        else:
-            environ['REQUEST_URI'] = environ['DOCUMENT_URI']
-        # Parse query string arguments
-        environ['QUERY_DICT'] = urllib.parse.parse_qs(environ['QUERY_STRING'],
-                                             keep_blank_values=1)
-        if environ['REQUEST_METHOD'] in ('POST', 'PUT') \
-            and environ['CONTENT_TYPE'] in ('application/x-www-form-urlencoded', \
-                'multipart/form-data'):
-            fs = cgi.FieldStorage(fp=environ['wsgi.input'],
-                                  environ=environ,
-                                  keep_blank_values=True)
-
-            post_dict = {}
-            if fs.list:
-                for field in fs.list:
-                    if field.filename:
-                        value = field
-                    else:
-                        value = field.value
-
-                    # Each element of post_dict will be a list, even if it contains only
-                    # one item. This is in line with QUERY_DICT which also works like this.
-                    if not field.name in post_dict:
-                        post_dict[field.name] = [value]
-                    else:
-                        post_dict[field.name].append(value)
-
-            environ['POST_DICT'] = post_dict
-        else: environ['POST_DICT'] = {}
+        environ = prepare_environ(environ)
         # Done parsing inputs, now ready to send to Juno
         status_str, headers, body = process_func(environ['PATH_INFO'],
                                                  environ['REQUEST_METHOD'],
-                                                 **environ)
+                                                 environ=environ)
+        s = settings()
+        if isinstance(body, str): body = body.encode(s.charset)
+        headers, body = compress_response(environ, status_str, headers, body)
         start_response(status_str, headers)
-        if config('use_sessions'): session().close()
-        if isinstance(body, str): body = body.encode(config('charset'))
+        if isinstance(body, JunoFile):
+            return body.wrap(environ.get('wsgi.file_wrapper'))
+        if is_stream(body): return JunoEncodedStream(body, s.charset)
         return [body]
 
     middleware_list = []
@@ -841,6 +3238,24 @@ def get_application(process_func):
 
     return application
 
+def prepare_environ(environ):
+    """Fills in the environ keys Juno relies on, and returns the request's
+    JunoEnviron - the one copy of environ made for a request.  The query
+    string, form data and cookies are parsed later, if the view asks for
+    them (see JunoEnviron)."""
+    # Ensure some variable exist (WSGI doesn't guarantee them)
+    if not environ.get('PATH_INFO'): environ['PATH_INFO'] = '/'
+    if 'QUERY_STRING' not in environ: environ['QUERY_STRING'] = ''
+    if not environ.get('CONTENT_LENGTH'): environ['CONTENT_LENGTH'] = '0'
+    # Standardize some header names
+    environ['DOCUMENT_URI'] = environ['PATH_INFO']
+    if environ['QUERY_STRING']:
+        environ['REQUEST_URI'] = environ['PATH_INFO']+'?'+environ['QUERY_STRING']
+    else:
+        environ['REQUEST_URI'] = environ['DOCUMENT_URI']
+    if isinstance(environ, JunoEnviron): return environ
+    return JunoEnviron(environ)
+
 def _load_middleware(application, middleware_list):
     for middleware, args in middleware_list:
         parts = middleware.split('.')
@@ -867,6 +3282,45 @@ def run_dev(addr, port, process_func):
         print('interrupted; exiting juno...')
         srv.socket.close()
 
+def run_threaded(addr, port, process_func):
+    app = get_application(process_func)
+    srv = JunoServer((addr, port), app,
+                     threads   = config('server_threads'),
+                     backlog   = config('server_backlog'),
+                     timeout   = config('server_timeout'),
+                     keepalive = config('server_keepalive'))
+    print('')
+    print('running Juno threaded server (%s threads), <C-c> to exit...'
+          %config('server_threads'))
+    print('connect to %s:%s to use your app...' %(addr, port))
+    print('')
+    try:
+        srv.serve_forever()
+    except KeyboardInterrupt:
+        print('interrupted; exiting juno...')
+    finally:
+        srv.server_close()
+
+def run_prefork(addr, port, process_func):
+    app = get_application(process_func)
+    master = JunoPreforkMaster((addr, port), app,
+                               workers          = config('prefork_workers'),
+                               max_requests     = config('prefork_max_requests'),
+                               reuseport        = config('prefork_reuseport'),
+                               graceful_timeout = config('prefork_graceful_timeout'),
+                               threads          = config('server_threads'),
+                               backlog          = config('server_backlog'),
+                               timeout          = config('server_timeout'),
+                               keepalive        = config('server_keepalive'))
+    print('')
+    print('running Juno prefork server (%s workers, pid %s), <C-c> to exit...'
+          %(master.worker_count, os.getpid()))
+    print('connect to %s:%s to use your app...' %(addr, port))
+    print('  SIGHUP: reload workers, SIGUSR1: print request counts,')
+    print('  SIGUSR2: start a new master with fresh code, SIGTERM: stop')
+    print('')
+    master.run()
+
 def run_scgi(addr, port, process_func):
     from flup.server.scgi_fork import WSGIServer as SCGI
     app = get_application(process_func)
@@ -881,7 +3335,825 @@ def run_wsgi(process_func):
     sys.stdout = sys.stderr
     return get_application(process_func)
 
+def run_asgi(process_func):
+    sys.stdout = sys.stderr
+    return get_asgi_application(process_func)
+
+def get_asgi_application(process_func):
+    """Returns an ASGI application for an ASGI server such as uvicorn.
+    process_func must be a coroutine function like Juno.request_async."""
+    if config('use_sessions') or config('use_debugger') or config('middleware'):
+        print('Warning: WSGI middleware (sessions, debugger, custom middleware)', file=sys.stderr)
+        print('         is not used in asgi mode.', file=sys.stderr)
+
+    async def application(scope, receive, send):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+        if scope['type'] != 'http': return
+        environ = asgi_environ(scope)
+        # Read the whole body without blocking the loop, so views can read
+        # it like a WSGI request's - unless no route takes the request
+        body, limit = b'', None
+        if routable(environ):
+            # The body is held in memory, so 'max_body_size' applies to all
+            limit, size, chunks = settings().max_body_size, 0, []
+            while True:
+                message = await receive()
+                if message['type'] == 'http.disconnect': return
+                chunks.append(message.get('body', b''))
+                size += len(chunks[-1])
+                if limit and size > limit: break
+                if not message.get('more_body'): break
+            body = b''.join(chunks)
+        environ['wsgi.input'] = io.BytesIO(body)
+        environ['CONTENT_LENGTH'] = str(len(body))
+        environ = prepare_environ(environ)
+        if limit and len(body) > limit:
+            status_str, headers, body = JunoRequestError(413, 'Request body too large').render()
+        else:
+            status_str, headers, body = await process_func(environ['PATH_INFO'],
+                                                           environ['REQUEST_METHOD'],
+                                                           environ=environ)
+        # The body is closed however sending ends (the client may be gone
+        # before the first chunk)
+        try:
+            if isinstance(body, str): body = body.encode(settings().charset)
+            headers, body = compress_response(environ, status_str, headers, body)
+            await send({
+                'type':    'http.response.start',
+                'status':  int(status_str.split()[0]),
+                'headers': [(k.lower().encode('latin-1'), v.encode('latin-1'))
+                            for k, v in headers],
+            })
+            if not is_stream(body):
+                await send({'type': 'http.response.body', 'body': body})
+                return
+            # Generating a chunk may block, so it happens in another thread
+            chunks = iter(JunoEncodedStream(body, settings().charset))
+            loop = asyncio.get_running_loop()
+            while True:
+                chunk = await loop.run_in_executor(None, next, chunks, None)
+                if chunk is None: break
+                await send({'type': 'http.response.body', 'body': chunk,
+                            'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            close = getattr(body, 'close', None)
+            if close is not None: close()
+
+    return application
+
+def routable(environ):
+    """Whether a route takes the request."""
+    path = environ['PATH_INFO'] or '/'
+    if path[-1] != '/': path += '/'
+    return getHub().get_route_index().match(path, environ['REQUEST_METHOD']) is not None
+
+def asgi_environ(scope):
+    """Builds a WSGI-style environ dictionary from an ASGI http scope."""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD':  scope['method'],
+        'SCRIPT_NAME':     scope.get('root_path', ''),
+        'PATH_INFO':       scope['path'],
+        'QUERY_STRING':    scope.get('query_string', b'').decode('latin-1'),
+        'CONTENT_TYPE':    '',
+        'SERVER_NAME':     server[0],
+        'SERVER_PORT':     str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/%s' %scope.get('http_version', '1.1'),
+        'REMOTE_ADDR':     client[0],
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.errors':     sys.stderr,
+        'asgi.scope':      scope,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'): name = 'HTTP_' + name
+        if name in environ and name.startswith('HTTP_'):
+            environ[name] += ',' + value
+        else: environ[name] = value
+    return environ
+
 def run_appengine(process_func):
     sys.stdout = sys.stderr
     from google.appengine.ext.webapp.util import run_wsgi_app
     run_wsgi_app(get_application(process_func))
+
+####
+#   Juno's threaded HTTP/1.1 server (the 'threaded' mode)
+####
+
+class JunoServer(object):
+    """A WSGI server with a bounded pool of worker threads.  One thread
+    accepts connections and watches idle keep-alive connections; a worker is
+    only used while a request is being read, run and answered.  So idle or
+    slow clients hold at most one worker each, and never stall the rest.
+    While every worker is busy, new connections wait in the listen backlog.
+    If max_requests is set, serve_forever() returns after exactly that many
+    requests: no request is started once the ones finished and running add
+    up to max_requests, and keep-alive connections are closed instead.
+    """
+
+    def __init__(self, address, application, threads=16, backlog=128,
+                 timeout=30, keepalive=5, sock=None, max_requests=0):
+        self.application = application
+        self.threads = threads
+        self.timeout = timeout
+        self.keepalive = keepalive
+        self.max_requests = max_requests
+        self.requests = 0
+        if sock is None: sock = socket.create_server(address, backlog=backlog)
+        self.socket = sock
+        self.socket.setblocking(False)
+        self.server_address = self.socket.getsockname()[:2]
+        self.pool = concurrent.futures.ThreadPoolExecutor(threads, 'juno-worker')
+        self.selector = selectors.DefaultSelector()
+        # Workers hand connections back through this queue, then write a
+        # byte to wakeup_w so the selector notices
+        self.finished = queue.SimpleQueue()
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+        self.wakeup_r.setblocking(False)
+        self.wakeup_w.setblocking(False)
+        # These are only touched by the thread running serve_forever()
+        self.busy = 0
+        self.idle = {}
+        self.accepting = False
+        self.running = False
+        # Whether server_close() serves connections still in the backlog -
+        # only useful when no other process accepts on the same socket
+        self.drain_backlog = False
+
+    def serve_forever(self):
+        self.running = True
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ)
+        self.watch_listener(True)
+        next_expire = time.monotonic() + 1
+        while self.running:
+            for key, _ in self.selector.select(1.0):
+                if key.fileobj is self.socket: self.accept()
+                elif key.fileobj is self.wakeup_r: self.collect()
+                else:
+                    # An idle keep-alive connection sent its next request
+                    self.selector.unregister(key.fileobj)
+                    del self.idle[key.data]
+                    if self.running and self.has_budget(): self.submit(key.data)
+                    else: key.data.close()
+            self.watch_listener(self.busy < self.threads and self.has_budget())
+            if time.monotonic() >= next_expire:
+                self.periodic()
+                next_expire = time.monotonic() + 1
+
+    def shutdown(self):
+        """Stops serve_forever(); requests in progress are finished by
+        server_close()."""
+        self.running = False
+        self.wake()
+
+    def server_close(self):
+        """Closes the listening socket, waits for requests in progress and
+        closes every connection."""
+        self.running = False
+        self.watch_listener(False)
+        # Serve the connections already waiting in the backlog, rather than
+        # dropping them with the socket
+        if self.drain_backlog: self.accept(drain=True)
+        self.socket.close()
+        self.pool.shutdown(wait=True)
+        self.collect()
+        for conn in list(self.idle): conn.close()
+        self.idle.clear()
+        self.selector.close()
+        self.wakeup_r.close()
+        self.wakeup_w.close()
+
+    def watch_listener(self, accepting):
+        if accepting == self.accepting: return
+        if accepting: self.selector.register(self.socket, selectors.EVENT_READ)
+        else: self.selector.unregister(self.socket)
+        self.accepting = accepting
+
+    def accept(self, drain=False):
+        while drain or (self.running and self.busy < self.threads
+                        and self.has_budget()):
+            try:
+                sock, address = self.socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                # Usually out of file descriptors; try again later
+                print('Error: accept() failed: %s' %e, file=sys.stderr)
+                return
+            self.submit(JunoConnection(self, sock, address))
+
+    def submit(self, conn):
+        self.busy += 1
+        self.pool.submit(self.process, conn)
+
+    def process(self, conn):
+        """Runs in a worker thread: serves one request on conn."""
+        keep = False
+        try:
+            keep = conn.handle()
+        except Exception:
+            traceback.print_exc()
+        if not keep: conn.close()
+        self.finished.put((conn if keep else None, conn.served))
+        self.wake()
+
+    def wake(self):
+        try: self.wakeup_w.send(b'\0')
+        except OSError: pass
+
+    def collect(self):
+        """Takes back connections from workers that finished a request."""
+        try:
+            while self.wakeup_r.recv(4096): pass
+        except OSError: pass
+        while True:
+            try: conn, served = self.finished.get_nowait()
+            except queue.Empty: return
+            self.busy -= 1
+            if served: self.request_finished()
+            if conn is None: continue
+            if not self.running or not self.has_budget(): conn.close()
+            # The client already sent (pipelined) its next request
+            elif conn.buffer: self.submit(conn)
+            else:
+                self.idle[conn] = time.monotonic() + self.keepalive
+                self.selector.register(conn.sock, selectors.EVENT_READ, conn)
+
+    def has_budget(self):
+        """Whether another request may start without passing max_requests."""
+        return not self.max_requests or self.requests + self.busy < self.max_requests
+
+    def request_finished(self):
+        """Called by serve_forever()'s thread after each request."""
+        self.requests += 1
+        if self.max_requests and self.requests >= self.max_requests:
+            self.running = False
+
+    def periodic(self):
+        """Called by serve_forever() about once a second."""
+        self.expire()
+
+    def expire(self):
+        """Closes keep-alive connections idle for more than self.keepalive."""
+        now = time.monotonic()
+        for conn, deadline in list(self.idle.items()):
+            if deadline > now: continue
+            self.selector.unregister(conn.sock)
+            del self.idle[conn]
+            conn.close()
+
+    def __repr__(self):
+        return '<JunoServer: %s:%s>' %self.server_address
+
+class JunoConnection(object):
+    """One client connection of a JunoServer.  handle() reads a request,
+    runs the WSGI application and writes its response."""
+
+    max_head_size = 65536
+    block_size = 65536
+
+    def __init__(self, server, sock, address):
+        self.server = server
+        self.sock = sock
+        self.address = address
+        # Bytes received but not consumed yet
+        self.buffer = b''
+        # Whether the last handle() call got as far as the application
+        self.served = False
+        sock.settimeout(server.timeout)
+        if sock.family in (socket.AF_INET, socket.AF_INET6):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle(self):
+        """Serves one request.  Returns True if the connection can be kept
+        open for another one."""
+        self.served = False
+        try:
+            head = self.read_head()
+            if head is None: return False
+            environ = self.parse_head(head)
+        except ValueError:
+            self.send_error('400 Bad Request')
+            return False
+        except OSError:
+            return False
+        if environ is None: return False
+        self.served = True
+        try:
+            self.run_application(environ)
+        except OSError:
+            return False
+        # Skip any request body the application didn't read
+        if self.input.remaining:
+            if self.input.remaining > self.block_size: return False
+            try: self.input.read()
+            except OSError: return False
+        return self.keep_alive
+
+    def read_head(self):
+        """Returns the request line and headers, or None if the client
+        closed the connection."""
+        while True:
+            self.buffer = self.buffer.lstrip(b'\r\n')
+            end = self.buffer.find(b'\r\n\r\n')
+            if end >= 0: break
+            if len(self.buffer) > self.max_head_size:
+                raise ValueError('request head too large')
+            if not self.fill(): return None
+        head, self.buffer = self.buffer[:end], self.buffer[end + 4:]
+        return head
+
+    def parse_head(self, head):
+        """Builds the WSGI environ for a request.  Returns None if the
+        request was already answered with an error."""
+        lines = head.decode('latin-1').split('\r\n')
+        parts = lines[0].split()
+        if len(parts) != 3 or parts[2] not in ('HTTP/1.1', 'HTTP/1.0'):
+            raise ValueError('bad request line')
+        method, target, version = parts
+        # Absolute form: 'http://host/path'
+        if '://' in target: target = '/' + target.split('://', 1)[1].partition('/')[2]
+        path, _, query = target.partition('?')
+        host, port = self.server.server_address
+        environ = {
+            'REQUEST_METHOD':    method,
+            'SCRIPT_NAME':       '',
+            'PATH_INFO':         urllib.parse.unquote(path, 'latin-1'),
+            'QUERY_STRING':      query,
+            'CONTENT_TYPE':      '',
+            'CONTENT_LENGTH':    '',
+            'SERVER_NAME':       host,
+            'SERVER_PORT':       str(port),
+            'SERVER_PROTOCOL':   version,
+            'REMOTE_ADDR':       self.address[0] if self.address else '',
+            'wsgi.version':      (1, 0),
+            'wsgi.url_scheme':   'http',
+            'wsgi.errors':       sys.stderr,
+            'wsgi.multithread':  True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once':     False,
+            'wsgi.file_wrapper': JunoFileWrapper,
+        }
+        for line in lines[1:]:
+            name, sep, value = line.partition(':')
+            if not sep: raise ValueError('bad header line')
+            name = name.strip().upper().replace('-', '_')
+            value = value.strip()
+            if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'): name = 'HTTP_' + name
+            if name in environ and name.startswith('HTTP_'):
+                environ[name] += ',' + value
+            else: environ[name] = value
+        self.method = method
+        self.http11 = version == 'HTTP/1.1'
+        connection = environ.get('HTTP_CONNECTION', '').lower()
+        if self.http11: self.keep_alive = 'close' not in connection
+        else: self.keep_alive = 'keep-alive' in connection
+        if not self.server.keepalive: self.keep_alive = False
+        if 'HTTP_TRANSFER_ENCODING' in environ:
+            self.send_error('411 Length Required')
+            return None
+        length = environ['CONTENT_LENGTH']
+        if length and (not length.isdigit()): raise ValueError('bad content length')
+        expect = environ.get('HTTP_EXPECT', '').lower() == '100-continue'
+        self.input = environ['wsgi.input'] = JunoInput(self, int(length or 0), expect)
+        return environ
+
+    def run_application(self, environ):
+        self.status = None
+        self.response_headers = None
+        self.headers_sent = False
+        self.chunked = False
+        self.length = None
+        try:
+            result = self.server.application(environ, self.start_response)
+        except Exception:
+            traceback.print_exc()
+            self.send_error('500 Internal Server Error')
+            return
+        try:
+            if isinstance(result, (list, tuple)):
+                self.length = sum(len(data) for data in result)
+            if not (isinstance(result, JunoFileWrapper) and self.send_file(result)):
+                for data in result:
+                    if data: self.write(data)
+            if not self.headers_sent: self.write(b'')
+            if self.chunked: self.sock.sendall(b'0\r\n\r\n')
+        except Exception as e:
+            if isinstance(e, OSError): raise
+            traceback.print_exc()
+            if self.headers_sent: self.keep_alive = False
+            else: self.send_error('500 Internal Server Error')
+        finally:
+            if hasattr(result, 'close'): result.close()
+
+    def start_response(self, status, headers, exc_info=None):
+        if exc_info:
+            try:
+                if self.headers_sent: raise exc_info[1].with_traceback(exc_info[2])
+            finally:
+                exc_info = None
+        elif self.status is not None:
+            raise AssertionError('start_response() called twice')
+        self.status = status
+        self.response_headers = headers
+        return self.write
+
+    def write(self, data):
+        """Sends data to the client, preceded by the headers the first time;
+        also the write() callable returned by start_response()."""
+        if self.status is None: raise AssertionError('write() before start_response()')
+        out = []
+        if not self.headers_sent:
+            out.append(self.build_head())
+            self.headers_sent = True
+        if data and self.method != 'HEAD':
+            if self.chunked: out.extend((b'%x\r\n' %len(data), data, b'\r\n'))
+            else: out.append(data)
+        if len(data) < self.block_size: self.sock.sendall(b''.join(out))
+        else:
+            for piece in out: self.sock.sendall(piece)
+
+    def build_head(self):
+        code = int(self.status[:3])
+        names = set()
+        lines = ['HTTP/1.1 ' + self.status]
+        for name, value in self.response_headers:
+            names.add(name.lower())
+            lines.append('%s: %s' %(name, value))
+        if 'date' not in names: lines.append('Date: ' + _http_date())
+        if 'server' not in names: lines.append('Server: Juno')
+        if 'content-length' not in names and code not in (204, 304) and code >= 200:
+            if self.length is not None:
+                lines.append('Content-Length: %d' %self.length)
+            elif self.method == 'HEAD': pass
+            elif self.http11:
+                self.chunked = True
+                lines.append('Transfer-Encoding: chunked')
+            else:
+                # HTTP/1.0 with an unknown length: the end of the connection
+                # marks the end of the body
+                self.keep_alive = False
+        if 'connection' in names:
+            for name, value in self.response_headers:
+                if name.lower() == 'connection' and value.lower() == 'close':
+                    self.keep_alive = False
+        elif not self.keep_alive: lines.append('Connection: close')
+        elif not self.http11: lines.append('Connection: keep-alive')
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+    def send_file(self, wrapper):
+        """Sends a JunoFileWrapper's file with sendfile().  Returns False if
+        it has to be sent by iterating over the wrapper instead."""
+        try: wrapper.filelike.fileno()
+        except (AttributeError, OSError, io.UnsupportedOperation): return False
+        if wrapper.length is not None: self.length = wrapper.length
+        self.write(b'')
+        if self.chunked: return False
+        if self.method != 'HEAD':
+            sent = self.sock.sendfile(wrapper.filelike, wrapper.filelike.tell(),
+                                      wrapper.length)
+            # The file got shorter; the client can't tell where the body ends
+            if wrapper.length is not None and sent < wrapper.length:
+                self.keep_alive = False
+        return True
+
+    def send_error(self, status):
+        self.keep_alive = False
+        try:
+            self.sock.sendall(('HTTP/1.1 %s\r\nContent-Length: 0\r\n'
+                               'Connection: close\r\n\r\n' %status).encode('latin-1'))
+        except OSError: pass
+
+    def fill(self):
+        """Receives more data into the buffer; False if the client closed."""
+        data = self.sock.recv(self.block_size)
+        if not data: return False
+        self.buffer += data
+        return True
+
+    def take(self, size):
+        """Returns up to size bytes, from the buffer if there are any."""
+        if self.buffer:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+            return data
+        return self.sock.recv(min(size, self.block_size))
+
+    def close(self):
+        try: self.sock.close()
+        except OSError: pass
+
+    def __repr__(self):
+        return '<JunoConnection: %s>' %(self.address,)
+
+class JunoFileWrapper(object):
+    """wsgi.file_wrapper for JunoServer, which sends the file with
+    sendfile().  length optionally limits how much of the file (from its
+    current position) is sent."""
+    def __init__(self, filelike, block_size=8192, length=None):
+        self.filelike = filelike
+        self.block_size = block_size
+        self.length = length
+
+    def __iter__(self):
+        remaining = self.length
+        while remaining is None or remaining > 0:
+            size = self.block_size
+            if remaining is not None: size = min(size, remaining)
+            data = self.filelike.read(size)
+            if not data: return
+            if remaining is not None: remaining -= len(data)
+            yield data
+
+    def close(self):
+        if hasattr(self.filelike, 'close'): self.filelike.close()
+
+class JunoInput(object):
+    """wsgi.input for JunoConnection: reads at most CONTENT_LENGTH bytes of
+    request body, answering an 'Expect: 100-continue' on the first read."""
+
+    def __init__(self, conn, length, expect_continue=False):
+        self.conn = conn
+        self.remaining = length
+        self.expect_continue = expect_continue
+
+    def send_continue(self):
+        if self.expect_continue:
+            self.expect_continue = False
+            self.conn.sock.sendall(b'HTTP/1.1 100 Continue\r\n\r\n')
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining: size = self.remaining
+        if size <= 0: return b''
+        self.send_continue()
+        chunks = []
+        while size > 0:
+            data = self.conn.take(size)
+            if not data: break
+            chunks.append(data)
+            size -= len(data)
+            self.remaining -= len(data)
+        return b''.join(chunks)
+
+    def readline(self, size=-1):
+        if size is None or size < 0 or size > self.remaining: size = self.remaining
+        if size <= 0: return b''
+        self.send_continue()
+        conn = self.conn
+        while True:
+            end = conn.buffer.find(b'\n', 0, size)
+            if end >= 0:
+                size = end + 1
+                break
+            if len(conn.buffer) >= size or not conn.fill(): break
+        line, conn.buffer = conn.buffer[:size], conn.buffer[size:]
+        self.remaining -= len(line)
+        return line
+
+    def readlines(self, hint=None):
+        return list(self)
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line: return
+            yield line
+
+_date_cache = [0, '']
+
+def _http_date():
+    """The current time as an HTTP date, recomputed at most once a second."""
+    now = int(time.time())
+    if _date_cache[0] != now:
+        _date_cache[:] = [now, email.utils.formatdate(now, usegmt=True)]
+    return _date_cache[1]
+
+####
+#   Juno's pre-forking server (the 'prefork' mode)
+####
+
+class JunoPreforkMaster(object):
+    """Binds the listening socket, then forks `workers` processes (default:
+    one per CPU) that each run a JunoServer on it.  With reuseport, every
+    worker binds its own SO_REUSEPORT socket instead and the kernel spreads
+    connections between them.
+
+    The master restarts workers that die, and a worker exits (and is
+    replaced) after max_requests requests.  Signals:
+        SIGHUP          => start a new set of workers, then stop the old ones
+                           once they finish their requests
+        SIGTERM, SIGINT => stop accepting, let workers finish, then exit
+        SIGUSR1         => print the request count of each worker
+        SIGUSR2         => start a new master (re-running the app's code) on
+                           the same socket; SIGTERM the old one afterwards
+    """
+
+    def __init__(self, address, application, workers=None, max_requests=0,
+                 reuseport=False, graceful_timeout=30, threads=16,
+                 backlog=128, timeout=30, keepalive=5):
+        import multiprocessing.sharedctypes
+        self.address = address
+        self.application = application
+        self.worker_count = workers or os.cpu_count() or 1
+        self.max_requests = max_requests
+        self.reuseport = reuseport
+        self.graceful_timeout = graceful_timeout
+        self.server_options = {'threads': threads, 'timeout': timeout,
+                               'keepalive': keepalive, 'backlog': backlog}
+        if 'JUNO_LISTEN_FD' in os.environ:
+            # Started by SIGUSR2 from an older master: take over its socket
+            fd = int(os.environ.pop('JUNO_LISTEN_FD'))
+            self.socket = socket.socket(fileno=fd)
+        elif reuseport:
+            self.socket = socket.create_server(address, backlog=backlog,
+                                               reuse_port=True)
+        else:
+            self.socket = socket.create_server(address, backlog=backlog)
+        self.address = self.socket.getsockname()[:2]
+        # Request counts, one slot per worker, written by the workers.  There
+        # is room for two generations of workers while reloading.
+        self.counts = multiprocessing.sharedctypes.RawArray('Q', 4 * self.worker_count)
+        self.retired_requests = 0
+        # pid => (slot, generation, start time)
+        self.workers = {}
+        self.generation = 0
+        self.respawn_after = 0
+        self.signals = []
+        self.stopping = False
+        self.stop_deadline = None
+
+    def run(self):
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        os.set_blocking(self.wakeup_r, False)
+        os.set_blocking(self.wakeup_w, False)
+        signal.set_wakeup_fd(self.wakeup_w)
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT,
+                       signal.SIGUSR1, signal.SIGUSR2, signal.SIGCHLD):
+            signal.signal(signum, self.handle_signal)
+        if self.reuseport:
+            # Workers bind their own sockets; the master's would steal
+            # connections that nobody accepts
+            self.socket.close()
+        try:
+            self.spawn_workers()
+            while self.workers or not self.stopping:
+                select.select([self.wakeup_r], [], [], 1.0)
+                try:
+                    while os.read(self.wakeup_r, 4096): pass
+                except OSError: pass
+                self.reap()
+                while self.signals: self.dispatch_signal(self.signals.pop(0))
+                if self.stopping:
+                    if time.monotonic() > self.stop_deadline:
+                        self.kill_workers(self.workers, signal.SIGKILL)
+                else: self.spawn_workers()
+        finally:
+            signal.set_wakeup_fd(-1)
+            os.close(self.wakeup_r)
+            os.close(self.wakeup_w)
+            self.socket.close()
+
+    def handle_signal(self, signum, frame):
+        self.signals.append(signum)
+
+    def dispatch_signal(self, signum):
+        if signum in (signal.SIGTERM, signal.SIGINT): self.stop()
+        elif signum == signal.SIGHUP: self.reload()
+        elif signum == signal.SIGUSR1: self.print_stats()
+        elif signum == signal.SIGUSR2: self.reexec()
+
+    def stop(self):
+        """Stops every worker gracefully; kills what's left after
+        graceful_timeout seconds."""
+        if self.stopping: return
+        self.stopping = True
+        self.stop_deadline = time.monotonic() + self.graceful_timeout
+        self.kill_workers(self.workers, signal.SIGTERM)
+
+    def reload(self):
+        """Replaces every worker without refusing any connection."""
+        old = [pid for pid, worker in self.workers.items()
+               if worker[1] == self.generation]
+        self.generation += 1
+        self.spawn_workers()
+        self.kill_workers(old, signal.SIGTERM)
+
+    def reexec(self):
+        """Starts a fresh master process with the same command line, handing
+        it the listening socket."""
+        pid = os.fork()
+        if pid != 0: return
+        if not self.reuseport:
+            os.set_inheritable(self.socket.fileno(), True)
+            os.environ['JUNO_LISTEN_FD'] = str(self.socket.fileno())
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+
+    def kill_workers(self, pids, signum):
+        for pid in list(pids):
+            try: os.kill(pid, signum)
+            except OSError: pass
+
+    def spawn_workers(self):
+        if time.monotonic() < self.respawn_after: return
+        current = [w for w in self.workers.values() if w[1] == self.generation]
+        used = set(w[0] for w in self.workers.values())
+        free = [slot for slot in range(len(self.counts)) if slot not in used]
+        for slot in free[:self.worker_count - len(current)]:
+            self.counts[slot] = 0
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    self.run_worker(slot)
+                    status = 0
+                except BaseException:
+                    traceback.print_exc()
+                finally:
+                    os._exit(status)
+            self.workers[pid] = (slot, self.generation, time.monotonic())
+
+    def reap(self):
+        while True:
+            try: pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError: return
+            if pid == 0: return
+            if pid not in self.workers: continue
+            slot, generation, started = self.workers.pop(pid)
+            self.retired_requests += self.counts[slot]
+            if status != 0 and not self.stopping:
+                print('Warning: worker %s exited with status %s' %(pid, status),
+                      file=sys.stderr)
+                # Don't fork in a tight loop if workers die on startup
+                if time.monotonic() - started < 1:
+                    self.respawn_after = time.monotonic() + 1
+
+    def run_worker(self, slot):
+        """Runs in a forked worker process."""
+        signal.set_wakeup_fd(-1)
+        os.close(self.wakeup_r)
+        os.close(self.wakeup_w)
+        for signum in (signal.SIGHUP, signal.SIGUSR1, signal.SIGUSR2, signal.SIGCHLD):
+            signal.signal(signum, signal.SIG_DFL)
+        # Ctrl-C reaches the whole process group; let the master handle it
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        sock = self.socket
+        if self.reuseport:
+            sock = socket.create_server(self.address, reuse_port=True,
+                                        backlog=self.server_options['backlog'])
+        server = JunoPreforkWorker(self.counts, slot, self.address, self.application,
+                                   sock=sock, max_requests=self.max_requests,
+                                   **self.server_options)
+        server.drain_backlog = self.reuseport
+        signal.signal(signal.SIGTERM, lambda signum, frame: server.shutdown())
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+
+    def stats(self):
+        """Returns {pid: requests served} for the running workers."""
+        return dict((pid, self.counts[worker[0]])
+                    for pid, worker in self.workers.items())
+
+    def total_requests(self):
+        return self.retired_requests + sum(self.stats().values())
+
+    def print_stats(self):
+        print('Juno prefork master %s: %s requests served' %(
+              os.getpid(), self.total_requests()))
+        for pid, count in sorted(self.stats().items()):
+            print('  worker %s: %s requests' %(pid, count))
+        sys.stdout.flush()
+
+    def __repr__(self):
+        return '<JunoPreforkMaster: %s:%s, %s workers>' %(
+            self.address[0], self.address[1], len(self.workers))
+
+class JunoPreforkWorker(JunoServer):
+    """The JunoServer run by each prefork worker; publishes its request
+    count in the master's shared counts array."""
+
+    def __init__(self, counts, slot, *args, **kwargs):
+        JunoServer.__init__(self, *args, **kwargs)
+        self.counts = counts
+        self.slot = slot
+        self.master_pid = os.getppid()
+
+    def request_finished(self):
+        JunoServer.request_finished(self)
+        self.counts[self.slot] = self.requests
+
+    def periodic(self):
+        JunoServer.periodic(self)
+        # Don't outlive a master that was killed
+        if os.getppid() != self.master_pid: self.running = False
@@ -0,0 +1,782 @@
+# # # # # # # #
+#
+# Benchmarks for Juno's request path.
+#
+# Run them all with `python bench.py`, or pick some by
+# name: `python bench.py routes`.  Numbers are printed
+# as a small table; they are only meaningful relative
+# to each other on the same machine.
+#
+# # # # # # # #
+
+import http.client
+import io
+import json
+import os
+import resource
+import signal
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import timeit
+import tracemalloc
+
+import juno
+
+juno.init({'use_db': False, 'mode': 'wsgi', 'log': False, 'use_static': False,
+           'use_templates': False})
+
+benchmarks = {}
+
+def benchmark(func):
+    benchmarks[func.__name__[len('bench_'):]] = func
+    return func
+
+def best_of(func, number, repeat=5):
+    """Best time per call of func, in microseconds."""
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number * 1e6
+
+def view(web, **kwargs): return ''
+
+@juno.get('/hello/')
+def hello(web): return 'Hello'
+
+@juno.get('/io/')
+def slow_io(web):
+    # Stands in for a view waiting on a database or another service
+    time.sleep(0.005)
+    return 'Done'
+
+@juno.get('/report/w:rows/')
+def report(web, rows):
+    return ''.join('%d,row %d\n' %(n, n) for n in range(int(rows)))
+
+@juno.get('/stream/w:rows/')
+def report_stream(web, rows):
+    return ('%d,row %d\n' %(n, n) for n in range(int(rows)))
+
+@juno.post('/form/')
+def form(web): return 'ok'
+
+@juno.post('/form/input/')
+def form_input(web): return web.input('name')
+
+@juno.post('/echo/manual/')
+def echo_manual(web):
+    # How JSON endpoints had to be written before web.json()
+    data = json.loads(web['wsgi.input'].read(int(web['CONTENT_LENGTH'])))
+    juno.content_type('application/json')
+    juno.append(json.dumps(data))
+
+@juno.post('/echo/')
+def echo(web): return web.json()
+
+@juno.get('/page/w:n/')
+def page(web, n):
+    juno.template('page%s.%s' %(n, juno.config('template_lib')),
+                  title='Page %s' %n, items=range(20))
+
+@juno.get('/listing/w:rows/')
+def listing(web, rows):
+    juno.template('listing.%s' %juno.config('template_lib'), rows=range(int(rows)))
+
+@juno.get('/user/w:name/')
+def user(web, name): return {'name': name, 'agent': web.user_agent}
+
+@juno.get('/boom/')
+def boom(web): raise ValueError('<boom>')
+
+@juno.get('/note/w:n/')
+def note(web, n):
+    notes = juno.find('Note')
+    juno.session().add(juno.config('db_models')['Note'](text='note %s' %n))
+    return '%d notes' %notes.filter_by(text='note %s' %n).count()
+
+juno.get('/static/*:file/')(juno.static_serve)
+
+application = juno.run()
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def load_test(port, url, connections=100, requests=20, timeout=10):
+    """Runs `connections` concurrent clients against a server.  Returns
+    (requests per second, p99 latency in ms, failed requests).  A request
+    that fails counts as taking `timeout` seconds."""
+    latencies = []
+    def client():
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=timeout)
+        for i in range(requests):
+            start = time.perf_counter()
+            try:
+                conn.request('GET', url)
+                conn.getresponse().read()
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                latencies.append(None)
+                continue
+            latencies.append(time.perf_counter() - start)
+        conn.close()
+    threads = [threading.Thread(target=client) for i in range(connections)]
+    start = time.perf_counter()
+    for t in threads: t.start()
+    for t in threads: t.join()
+    elapsed = time.perf_counter() - start
+    failed = latencies.count(None)
+    latencies = [timeout if l is None else l for l in latencies]
+    return ((len(latencies) - failed) / elapsed, percentile(latencies, 99) * 1000,
+            failed)
+
+def serve_in_child(server):
+    """Forks a process running server.serve_forever().  Returns its pid."""
+    pid = os.fork()
+    if pid == 0:
+        try: server.serve_forever()
+        finally: os._exit(0)
+    return pid
+
+@benchmark
+def bench_routes():
+    """Route dispatch: linear scan vs. JunoRouteIndex, for the last static
+    route, the last wildcard route, and a url that matches nothing."""
+    print('%8s %-10s %12s %12s' %('routes', 'request', 'linear us', 'index us'))
+    for count in (10, 100, 1000, 5000):
+        routes = []
+        for i in range(count // 2):
+            routes.append(juno.JunoRoute('/page%d/' %i, view, 'get'))
+            routes.append(juno.JunoRoute('/section%d/w:id/*:rest/' %i, view, 'get'))
+        index = juno.JunoRouteIndex(routes)
+        last = count // 2 - 1
+        requests = (('static', '/page%d/' %last),
+                    ('wildcard', '/section%d/42/a/b/' %last),
+                    ('miss', '/no/such/page/'))
+        for name, url in requests:
+            def linear():
+                for route in routes:
+                    if route.match(url, 'GET'): return route
+            def indexed():
+                for route in index.candidates(url):
+                    if route.match(url, 'GET'): return route
+            assert linear() is indexed()
+            print('%8d %-10s %12.2f %12.2f' %(count, name, best_of(linear, 20),
+                                             best_of(indexed, 2000)))
+
+@benchmark
+def bench_server():
+    """'dev' (wsgiref) vs. 'threaded' mode with 100 concurrent connections,
+    for a trivial view and for one that waits 5 ms on I/O."""
+    from wsgiref.simple_server import make_server, WSGIRequestHandler
+    class QuietHandler(WSGIRequestHandler):
+        def log_message(self, *args): pass
+    print('%-10s %-8s %10s %10s %8s' %('server', 'view', 'req/s', 'p99 ms', 'failed'))
+    for url in ('/hello/', '/io/'):
+        for name in ('dev', 'threaded'):
+            if name == 'dev':
+                server = make_server('127.0.0.1', 0, application,
+                                     handler_class=QuietHandler)
+            else:
+                server = juno.JunoServer(('127.0.0.1', 0), application, threads=16)
+            port = server.server_address[1]
+            pid = serve_in_child(server)
+            server.socket.close()
+            try:
+                rps, p99, failed = load_test(port, url)
+            finally:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            print('%-10s %-8s %10.0f %10.1f %8d' %(name, url, rps, p99, failed))
+
+@benchmark
+def bench_append():
+    """Building a body from many small append() calls."""
+    print('%8s %12s %12s' %('appends', 'total ms', 'per call us'))
+    for count in (1000, 10000, 100000):
+        def build():
+            response = juno.JunoResponse()
+            for i in range(count): response.append('<li>%d</li>' %i)
+            return response.render()
+        took = best_of(build, 1, repeat=3)
+        print('%8d %12.2f %12.2f' %(count, took / 1000, took / count))
+
+@benchmark
+def bench_stream():
+    """Time to first byte and peak memory of a CSV report, built in memory
+    vs. returned as a generator."""
+    def call(url):
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': url, 'QUERY_STRING': '',
+                   'CONTENT_TYPE': '', 'wsgi.input': None}
+        tracemalloc.start()
+        start = time.perf_counter()
+        body = iter(application(environ, lambda status, headers: None))
+        next(body)
+        first = time.perf_counter() - start
+        for chunk in body: pass
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return first * 1000, peak / 1024
+    print('%8s %-10s %12s %12s' %('rows', 'body', 'ttfb ms', 'peak KiB'))
+    for rows in (1000, 100000, 1000000):
+        for name, url in (('buffered', '/report/%d/'), ('streamed', '/stream/%d/')):
+            first, peak = call(url %rows)
+            print('%8d %-10s %12.2f %12.0f' %(rows, name, first, peak))
+
+def wsgi_get(url, **headers):
+    """Calls the application directly.  Returns the response headers and
+    the number of body bytes."""
+    environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': url, 'QUERY_STRING': '',
+               'CONTENT_TYPE': '', 'wsgi.input': None}
+    environ.update(headers)
+    response = {}
+    body = application(environ, lambda status, headers: response.update(headers))
+    return response, sum(len(chunk) for chunk in body)
+
+@benchmark
+def bench_static():
+    """Serving an unchanged 100KB asset to a client without and with a
+    cached copy (If-None-Match), with Juno's static cache off and on."""
+    root = tempfile.mkdtemp()
+    juno.config('static_root', root)
+    hub = juno.getHub()
+    size = hub.config['static_cache_size']
+    try:
+        with open(os.path.join(root, 'app.js'), 'wb') as f: f.write(b'x' * 100000)
+        etag = wsgi_get('/static/app.js')[0]['ETag']
+        print('%-6s %-8s %12s %12s' %('cache', 'client', 'bytes/req', 'us/req'))
+        for cache, cache_size in (('off', 0), ('on', size)):
+            hub.config['static_cache_size'] = cache_size
+            hub.static_cache = None
+            for name, headers in (('cold', {}), ('warm', {'HTTP_IF_NONE_MATCH': etag})):
+                sent = wsgi_get('/static/app.js', **headers)[1]
+                took = best_of(lambda: wsgi_get('/static/app.js', **headers), 1000)
+                print('%-6s %-8s %12d %12.1f' %(cache, name, sent, took))
+    finally:
+        hub.config['static_cache_size'] = size
+        hub.static_cache = None
+        shutil.rmtree(root)
+
+@benchmark
+def bench_compress():
+    """Bytes on the wire and CPU time per response for a 60KB HTML page,
+    for each content coding and compression level."""
+    page = ''.join('<tr><td>%d</td><td>Item %d</td><td>%s</td></tr>\n'
+                   %(n, n * 7919 % 1000, time.ctime(n * 3600)) for n in range(1000))
+    page = ('<html><body><table>\n%s</table></body></html>' %page).encode('utf-8')
+    levels = [('identity', None), ('gzip', 1), ('gzip', 6), ('gzip', 9)]
+    if 'br' in juno.available_encodings():
+        levels += [('br', 1), ('br', 5), ('br', 11)]
+    print('%-10s %6s %10s %8s %12s' %('encoding', 'level', 'bytes', 'ratio', 'cpu us'))
+    for encoding, level in levels:
+        if encoding == 'identity':
+            size, took = len(page), 0.0
+        else:
+            size = len(juno.compress(page, encoding, level))
+            took = best_of(lambda: juno.compress(page, encoding, level), 20)
+        print('%-10s %6s %10d %8.2f %12.1f' %(encoding, level or '-', size,
+                                             len(page) / size, took))
+
+@benchmark
+def bench_cache():
+    """Output cache hit latency for a 10KB response: a plain dict lookup,
+    then each backend (the mmap and SQLite ones are shared by processes)."""
+    root = tempfile.mkdtemp()
+    rendered = ('200 OK', [('Content-Type', 'text/html; charset=utf-8')], b'x' * 10240)
+    key = 'GET /news/?page=2'
+    plain = {key: rendered}
+    backends = [('memory', juno.JunoMemoryBackend(64 * 1024 * 1024)),
+                ('mmap', juno.JunoMmapBackend(os.path.join(root, 'cache.mmap'),
+                                              64 * 1024 * 1024)),
+                ('sqlite', juno.JunoSqliteBackend(os.path.join(root, 'cache.db'),
+                                                  64 * 1024 * 1024))]
+    try:
+        print('%-8s %12s %12s' %('backend', 'hit us', 'miss us'))
+        print('%-8s %12.2f %12s' %('dict', best_of(lambda: plain.get(key), 10000), '-'))
+        for name, backend in backends:
+            cache = juno.JunoOutputCache(backend)
+            cache.set(key, '/news/', rendered, 3600)
+            assert cache.get(key, '/news/') == rendered
+            hit = best_of(lambda: cache.get(key, '/news/'), 2000)
+            miss = best_of(lambda: cache.get('GET /other/', '/news/'), 2000)
+            print('%-8s %12.2f %12.2f' %(name, hit, miss))
+    finally:
+        shutil.rmtree(root)
+
+@benchmark
+def bench_parse():
+    """Per-request time for GET requests with a query string and cookies,
+    form POSTs to views that ignore or read the form, and 404s."""
+    body = '&'.join('field%d=value%d' %(n, n) for n in range(20)).encode('ascii')
+    def request(method, url, body=b''):
+        environ = {'REQUEST_METHOD': method, 'PATH_INFO': url,
+                   'QUERY_STRING': 'page=2&sort=name&q=juno',
+                   'HTTP_COOKIE': 'theme=dark; lang=en; seen=1',
+                   'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+                   'CONTENT_LENGTH': str(len(body)), 'wsgi.input': io.BytesIO(body)}
+        return b''.join(application(environ, lambda status, headers: None))
+    cases = [('GET', 'GET', '/hello/', b''),
+             ('POST ignored', 'POST', '/form/', body),
+             ('POST read', 'POST', '/form/input/', body),
+             ('404 GET', 'GET', '/missing/', b''),
+             ('404 POST', 'POST', '/missing/', body)]
+    # The 404 page needs a template; use a trivial one
+    hub = juno.getHub()
+    handlers = hub.config['get_template_handler'], hub.config['render_template_handler']
+    juno.config({'get_template_handler': lambda path: path,
+                 'render_template_handler': lambda template, **kwargs: 'Not found'})
+    try:
+        print('%-14s %12s' %('request', 'us/req'))
+        for name, method, url, data in cases:
+            took = best_of(lambda: request(method, url, data), 2000)
+            print('%-14s %12.1f' %(name, took))
+    finally:
+        juno.config({'get_template_handler': handlers[0],
+                     'render_template_handler': handlers[1]})
+
+def footprint(obj):
+    """Bytes an object takes, with its instance __dict__ if it has one."""
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'): size += sys.getsizeof(obj.__dict__)
+    return size
+
+@benchmark
+def bench_alloc():
+    """Time, peak traced memory and memory kept per request, and the size
+    of the request, response, route and match objects."""
+    def request(url):
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': url, 'QUERY_STRING': 'a=1',
+                   'HTTP_USER_AGENT': 'bench', 'wsgi.input': io.BytesIO()}
+        return b''.join(application(environ, lambda status, headers: None))
+    print('%-10s %10s %12s %12s' %('url', 'us/req', 'peak B/req', 'kept B/req'))
+    for url in ('/hello/', '/user/juno/'):
+        took = best_of(lambda: request(url), 5000)
+        for n in range(100): request(url)
+        tracemalloc.start()
+        peak = 0
+        for n in range(100):
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            request(url)
+            peak = max(peak, tracemalloc.get_traced_memory()[1] - before)
+        start = tracemalloc.get_traced_memory()[0]
+        for n in range(1000): request(url)
+        kept = (tracemalloc.get_traced_memory()[0] - start) / 1000
+        tracemalloc.stop()
+        print('%-10s %10.1f %12d %12.1f' %(url, took, peak, kept))
+    environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/user/juno/', 'QUERY_STRING': ''}
+    juno.prepare_environ(environ)
+    match = juno.getHub().get_route_index().match('/user/juno/', 'GET')
+    print()
+    for obj in (juno.JunoRequest(environ), juno.JunoResponse(), match.route, match):
+        print('%-14s %6d bytes' %(type(obj).__name__, footprint(obj)))
+
+@benchmark
+def bench_json():
+    """Requests per second for a JSON echo endpoint (a 1.5KB document),
+    decoding by hand and with web.json(), with the json module and orjson."""
+    document = {'id': 12345, 'name': 'Juno', 'tags': ['web', 'wsgi', 'json'],
+                'active': True, 'score': 98.6, 'owner': {'id': 7, 'name': 'dodo'},
+                'items': [{'sku': 'A%03d' %n, 'qty': n, 'price': n * 1.25}
+                          for n in range(40)]}
+    body = json.dumps(document).encode('utf-8')
+    def request(url):
+        environ = {'REQUEST_METHOD': 'POST', 'PATH_INFO': url, 'QUERY_STRING': '',
+                   'CONTENT_TYPE': 'application/json', 'CONTENT_LENGTH': str(len(body)),
+                   'wsgi.input': io.BytesIO(body)}
+        return b''.join(application(environ, lambda status, headers: None))
+    print('%-22s %12s %12s' %('endpoint', 'us/req', 'req/s'))
+    for name, url, orjson in (('manual, json', '/echo/manual/', False),
+                              ('web.json(), json', '/echo/', False),
+                              ('web.json(), orjson', '/echo/', True)):
+        if orjson and juno.orjson_module() is None: continue
+        juno.config('use_orjson', orjson)
+        assert json.loads(request(url)) == document
+        took = best_of(lambda: request(url), 2000)
+        print('%-22s %12.1f %12.0f' %(name, took, 1e6 / took))
+    juno.config('use_orjson', True)
+
+class BodyStream(object):
+    """A wsgi.input made up as it is read: head, then block repeated count
+    times, then tail."""
+    def __init__(self, head, block, count, tail):
+        self.chunks = iter([head] + [block] * count + [tail])
+        self.buffer = b''
+
+    def fill(self, size):
+        while len(self.buffer) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None: break
+            self.buffer += chunk
+
+    def read(self, size=-1):
+        if size < 0: size = 1 << 62
+        self.fill(size)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def readline(self, size=-1):
+        if size < 0: size = 1 << 62
+        while True:
+            end = self.buffer.find(b'\n', 0, size)
+            if end >= 0: size = end + 1
+            if end >= 0 or len(self.buffer) >= size: break
+            before = len(self.buffer)
+            self.fill(len(self.buffer) + 1)
+            if len(self.buffer) == before: break
+        return self.read(size)
+
+def in_child(func):
+    """Runs func() in a forked process.  Returns (seconds, growth of the
+    peak memory use in MB)."""
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            start = time.perf_counter()
+            func()
+            took = time.perf_counter() - start
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_rss
+            os.write(write, ('%f %f' %(took, peak / 1024.0)).encode())
+        finally: os._exit(0)
+    os.close(write)
+    result = os.read(read, 100).decode()
+    os.close(read)
+    os.waitpid(pid, 0)
+    took, peak = result.split()
+    return float(took), float(peak)
+
+@benchmark
+def bench_upload():
+    """Parsing a 1GB file upload and a 10,000 field form with Juno's form
+    parser and with cgi.FieldStorage (what Juno used before)."""
+    import warnings
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', DeprecationWarning)
+        import cgi
+    boundary = '----WebKitFormBoundary7MA4YWxkTrZu0gW'
+    block = bytes(range(256)).replace(b'\n', b'') * 256
+    count = 1024 ** 3 // len(block)
+    head = ('--%s\r\nContent-Disposition: form-data; name="f"; filename="big.bin"\r\n'
+            'Content-Type: application/octet-stream\r\n\r\n' %boundary).encode()
+    tail = ('\r\n--%s--\r\n' %boundary).encode()
+    fields = ''.join('--%s\r\nContent-Disposition: form-data; name="field%d"\r\n\r\n'
+                     'value %d\r\n' %(boundary, n, n) for n in range(10000)).encode()
+    urlencoded = '&'.join('field%d=value+%d' %(n, n) for n in range(10000)).encode()
+    cases = [('1GB upload', 'multipart/form-data; boundary=' + boundary,
+              (head, block, count, tail), len(head) + len(block) * count + len(tail)),
+             ('10k multipart', 'multipart/form-data; boundary=' + boundary,
+              (fields + tail[2:], b'', 0, b''), len(fields) + len(tail) - 2),
+             ('10k urlencoded', 'application/x-www-form-urlencoded',
+              (urlencoded, b'', 0, b''), len(urlencoded))]
+    juno.config({'max_body_size': 2 * 1024 ** 3, 'max_form_parts': 20000})
+    def environ(content_type, body, length):
+        return {'REQUEST_METHOD': 'POST', 'CONTENT_TYPE': content_type,
+                'CONTENT_LENGTH': str(length), 'QUERY_STRING': '',
+                'wsgi.input': BodyStream(*body)}
+    def parse_juno(content_type, body, length):
+        fields = juno.parse_form(environ(content_type, body, length))
+        assert len(fields) in (1, 10000)
+    def parse_cgi(content_type, body, length):
+        env = environ(content_type, body, length)
+        fs = cgi.FieldStorage(fp=env['wsgi.input'], environ=env, keep_blank_values=True)
+        assert len(fs.list) in (1, 10000)
+    print('%-16s %-8s %10s %12s' %('body', 'parser', 'seconds', 'peak MB'))
+    for name, content_type, body, length in cases:
+        for parser, func in (('cgi', parse_cgi), ('juno', parse_juno)):
+            took, peak = in_child(lambda: func(content_type, body, length))
+            print('%-16s %-8s %10.3f %12.1f' %(name, parser, took, peak))
+
+def forked(func):
+    """Runs func() in a forked process and returns its result, a tuple of
+    numbers."""
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try: os.write(write, ' '.join('%f' %n for n in func()).encode())
+        finally: os._exit(0)
+    os.close(write)
+    result = os.read(read, 1000).decode()
+    os.close(read)
+    os.waitpid(pid, 0)
+    return [float(n) for n in result.split()]
+
+# A page using a base template and macros, and the same for Mako.  BODY
+# is replaced with a number of sections, N with the section number.
+jinja_base = '''<html><head><title>{% block title %}{% endblock %}</title></head>
+<body>{% block body %}{% endblock %}</body></html>'''
+jinja_macros = '''{% macro row(item, n) %}<tr class="{{ loop_class(n) }}"><td>{{ item|e }}</td>
+<td>{{ "%.2f"|format(item * 1.5) }}</td></tr>{% endmacro %}
+{% macro loop_class(n) %}{% if n is even %}even{% else %}odd{% endif %}{% endmacro %}'''
+jinja_page = '''{% extends "base.jinja2" %}{% import "macros.jinja2" as m %}
+{% block title %}{{ title }}{% endblock %}
+{% block body %}<h1>{{ title|upper }}</h1>
+BODY{% endblock %}'''
+jinja_section = '''<h2>Section N</h2><table>{% for item in items %}{{ m.row(item, loop.index) }}{% endfor %}</table>
+{% if items|length > 10 %}<p>{{ items|length }} items, {{ items|sum }} in all</p>{% else %}<p>Few</p>{% endif %}
+'''
+mako_base = '''<html><head><title>${self.page_title()}</title></head><body>${self.body()}</body></html>'''
+mako_page = '''<%inherit file="base.mako"/>
+<%def name="page_title()">${title}</%def>
+<%def name="row(item, n)"><tr class="${'even' if n % 2 == 0 else 'odd'}"><td>${item | h}</td>
+<td>${'%.2f' % (item * 1.5)}</td></tr></%def>
+<h1>${title.upper()}</h1>
+BODY'''
+mako_section = '''<h2>Section N</h2><table>
+% for n, item in enumerate(items):
+${row(item, n)}
+% endfor
+</table>
+% if len(items) > 10:
+<p>${len(items)} items, ${sum(items)} in all</p>
+% else:
+<p>Few</p>
+% endif
+'''
+
+@benchmark
+def bench_templates():
+    """Startup time (setting up templates), the time of a new worker's
+    first request and the median of the next 50 (to 10 pages), for 200
+    templates, with and without the 'production' template mode."""
+    root = tempfile.mkdtemp()
+    try:
+        for lib, base, page, section in (('jinja2', jinja_base, jinja_page, jinja_section),
+                                         ('mako', mako_base, mako_page, mako_section)):
+            try: __import__(lib)
+            except ImportError: continue
+            lib_root = os.path.join(root, lib)
+            os.mkdir(lib_root)
+            with open(os.path.join(lib_root, 'base.%s' %lib), 'w') as f: f.write(base)
+            if lib == 'jinja2':
+                with open(os.path.join(lib_root, 'macros.jinja2'), 'w') as f: f.write(jinja_macros)
+            for n in range(200):
+                with open(os.path.join(lib_root, 'page%d.%s' %(n, lib)), 'w') as f:
+                    f.write(page.replace('BODY', ''.join(section.replace('N', str(s))
+                                                         for s in range(10))))
+            cache_dir = os.path.join(root, lib + '-cache')
+            def worker(mode, workers=0):
+                juno.config({'use_templates': True, 'template_lib': lib,
+                             'template_root': lib_root, 'template_mode': mode,
+                             'template_cache_dir': cache_dir if mode != 'dev' else None,
+                             'template_compile_workers': workers, 'log': False})
+                start = time.perf_counter()
+                juno.getHub().setup_templates()
+                startup = time.perf_counter() - start
+                times = []
+                for n in range(51):
+                    start = time.perf_counter()
+                    assert wsgi_get('/page/%d/' %(n % 10))[1]
+                    times.append(time.perf_counter() - start)
+                return startup * 1e3, times[0] * 1e3, percentile(times[1:], 50) * 1e3
+            print('%-8s %-22s %12s %12s %12s' %(lib, 'mode', 'startup ms', '1st req ms', 'median ms'))
+            cases = [('dev', 'dev', 0, True),
+                     ('production, cold', 'production', 0, True),
+                     ('production, cold x%d' %os.cpu_count(), 'production', os.cpu_count(), True),
+                     ('production, warm', 'production', 0, False)]
+            for name, mode, workers, clear in cases:
+                if clear: shutil.rmtree(cache_dir, ignore_errors=True)
+                result = forked(lambda: worker(mode, workers))
+                print('%-8s %-22s %12.1f %12.2f %12.2f' %(lib, name, *result))
+    finally:
+        shutil.rmtree(root)
+
+listing_templates = {
+    'jinja2': '''<html><head><link rel="stylesheet" href="/static/site.css"></head>
+<body><table>{% for row in rows %}<tr><td>{{ row }}</td><td>Item {{ row }}</td>
+<td>{{ "%.2f"|format(row * 1.5) }}</td></tr>{% endfor %}</table></body></html>''',
+    'mako': '''<html><head><link rel="stylesheet" href="/static/site.css"></head>
+<body><table>
+% for row in rows:
+<tr><td>${row}</td><td>Item ${row}</td><td>${'%.2f' % (row * 1.5)}</td></tr>
+% endfor
+</table></body></html>'''}
+
+@benchmark
+def bench_template_stream():
+    """Time to first byte, total time and peak memory of a listing page,
+    rendered whole vs. streamed in 8KB chunks and unbuffered."""
+    root = tempfile.mkdtemp()
+    def call(url, trace):
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': url, 'QUERY_STRING': '',
+                   'CONTENT_TYPE': '', 'wsgi.input': None}
+        if trace: tracemalloc.start()
+        start = time.perf_counter()
+        body = iter(application(environ, lambda status, headers: None))
+        next(body)
+        first = time.perf_counter() - start
+        for chunk in body: pass
+        took = time.perf_counter() - start
+        if not trace: return first * 1000, took * 1000
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return peak / 1024
+    try:
+        print('%-7s %8s %-10s %10s %10s %10s' %('lib', 'rows', 'body', 'ttfb ms',
+                                                 'total ms', 'peak KiB'))
+        for lib, source in sorted(listing_templates.items()):
+            try: __import__(lib)
+            except ImportError: continue
+            with open(os.path.join(root, 'listing.' + lib), 'w') as f: f.write(source)
+            for rows in (1000, 100000):
+                for name, stream, size in (('whole', False, 0), ('8KB', True, 8192),
+                                           ('unbuffered', True, 0)):
+                    juno.config({'use_templates': True, 'template_lib': lib,
+                                 'template_root': root, 'stream_templates': stream,
+                                 'template_chunk_size': size})
+                    juno.getHub().setup_templates()
+                    url = '/listing/%d/' %rows
+                    call(url, False)
+                    first, took = min(call(url, False) for n in range(3))
+                    peak = call(url, True)
+                    print('%-7s %8d %-10s %10.2f %10.2f %10.0f' %(lib, rows, name, first,
+                                                                  took, peak))
+    finally:
+        juno.config({'use_templates': False, 'stream_templates': False,
+                     'template_chunk_size': 8192})
+        shutil.rmtree(root)
+
+# A page with a big navigation menu, per user, and a small dynamic part
+fragment_templates = {
+    'jinja2': ('<html><body><ul>{% for item in menu %}<li class="{{ loop.cycle(\'a\', \'b\') }}">'
+               '<a href="/{{ item|lower }}/?u={{ user }}">{{ item|title }}</a></li>{% endfor %}</ul>'
+               '<p>{{ message }}</p></body></html>',
+               '{% cache user, 300 %}', '{% endcache %}'),
+    'mako': ('<html><body><ul>\n% for n, item in enumerate(menu):\n'
+             '<li class="${\'ab\'[n % 2]}"><a href="/${item.lower()}/?u=${user}">${item.title()}'
+             '</a></li>\n% endfor\n</ul><p>${message}</p></body></html>',
+             '<%block name="nav" cached="True" cache_key="${user}" cache_timeout="300">',
+             '</%block>')}
+
+@benchmark
+def bench_fragments():
+    """Time per page rendered with its menu cached in the fragment cache or
+    not, for 1000 pages to 20 users, and the fragment hit ratio."""
+    root = tempfile.mkdtemp()
+    menu = ['Section %d' %n for n in range(300)]
+    try:
+        print('%-7s %-10s %10s %10s' %('lib', 'menu', 'us/page', 'hit rate'))
+        for lib, (page, start, end) in sorted(fragment_templates.items()):
+            try: __import__(lib)
+            except ImportError: continue
+            head, tail = page.split('<p>')
+            with open(os.path.join(root, 'plain.html'), 'w') as f: f.write(page)
+            with open(os.path.join(root, 'cached.html'), 'w') as f:
+                f.write(head.replace('<ul>', start + '<ul>') + end + '<p>' + tail)
+            juno.config({'use_templates': True, 'template_lib': lib, 'template_root': root})
+            hub = juno.getHub()
+            hub.setup_templates()
+            for name in ('plain', 'cached'):
+                hub.fragment_cache = None
+                template = juno.get_template(name + '.html')
+                def render():
+                    for n in range(1000):
+                        juno.render_template(template, menu=menu, user=n % 20,
+                                             message='Hello %d' %n)
+                took = best_of(render, 1, repeat=3) / 1000
+                stats = juno.fragment_cache_stats()
+                rate = stats[list(stats)[0]]['hit_rate'] if stats else 0
+                print('%-7s %-10s %10.1f %10.3f' %(lib, name, took, rate))
+    finally:
+        juno.config({'use_templates': False})
+        juno.getHub().fragment_cache = None
+        shutil.rmtree(root)
+
+@benchmark
+def bench_errors():
+    """404 and 500 responses per second, with Juno's own error page and
+    with 404.html/500.html templates, with 'log' off and on (to /dev/null)."""
+    root = tempfile.mkdtemp()
+    for name in ('404.html', '500.html'):
+        with open(os.path.join(root, name), 'w') as f:
+            f.write('<html><head><title>Error</title>'
+                    '<link rel="stylesheet" href="/static/site.css"></head><body>'
+                    + '<div class="nav"><a href="/">Home</a></div>' * 20 +
+                    '<h1>Sorry</h1><p>${error}</p></body></html>')
+    stdout, stderr = sys.stdout, sys.stderr
+    try:
+        print('%-8s %-5s %-4s %12s' %('pages', 'code', 'log', 'requests/s'))
+        for lib in (None, 'jinja2', 'mako'):
+            if lib is not None:
+                try: __import__(lib)
+                except ImportError: continue
+                if lib == 'jinja2':
+                    for name in ('404.html', '500.html'):
+                        path = os.path.join(root, name)
+                        with open(path) as f: text = f.read()
+                        with open(path, 'w') as f: f.write(text.replace('${error}', '{{ error }}'))
+                juno.config({'use_templates': True, 'template_lib': lib,
+                             'template_root': root})
+                juno.getHub().setup_templates()
+            for code, url in (('404', '/wp-admin/setup.php'), ('500', '/boom/')):
+                for log in (False, True):
+                    juno.config('log', log)
+                    sys.stdout = sys.stderr = open(os.devnull, 'w')
+                    def get():
+                        for n in range(200): wsgi_get(url)
+                    try: took = best_of(get, 1, repeat=3) / 200
+                    except Exception: took = None
+                    finally:
+                        sys.stderr.close()
+                        sys.stdout, sys.stderr = stdout, stderr
+                    print('%-8s %-5s %-4s %12s' %(lib or 'builtin', code, log and 'on' or 'off',
+                                                  took and '%.0f' %(1e6 / took) or 'error'))
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+        juno.config({'use_templates': False, 'log': False})
+        shutil.rmtree(root)
+
+@benchmark
+def bench_db():
+    """32 threads making 50 requests each to a view that queries and adds a
+    row, with a pool of 5 (+5 overflow) connections.  Prints the most and
+    the last number of connections checked out, requests/s and errors."""
+    try: import sqlalchemy
+    except ImportError:
+        print('needs SQLAlchemy')
+        return
+    root = tempfile.mkdtemp()
+    juno.config({'use_db': True, 'db_location': os.path.join(root, 'bench.db'),
+                 'db_pool_size': 5, 'db_max_overflow': 5, 'db_pool_timeout': 5})
+    juno.getHub().setup_database()
+    juno.model('Note', text='str')
+    pool = juno.config('db_engine').pool
+    counts, errors, done = [], [], threading.Event()
+    def watch():
+        while not done.is_set():
+            counts.append(pool.checkedout())
+            time.sleep(0.001)
+    def client(n):
+        for i in range(50):
+            environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/note/%d/' %(i % 10),
+                       'QUERY_STRING': '', 'wsgi.input': None}
+            status = []
+            application(environ, lambda s, h: status.append(s))
+            if status[0][:3] != '200': errors.append(status[0])
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout = sys.stderr = open(os.devnull, 'w')
+    try:
+        watcher = threading.Thread(target=watch)
+        watcher.start()
+        threads = [threading.Thread(target=client, args=(n,)) for n in range(32)]
+        start = time.perf_counter()
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+        took = time.perf_counter() - start
+        done.set()
+        watcher.join()
+    finally:
+        sys.stderr.close()
+        sys.stdout, sys.stderr = stdout, stderr
+        juno.config({'use_db': False})
+        shutil.rmtree(root)
+    print('%12s %12s %12s %8s' %('most conns', 'conns after', 'requests/s', 'errors'))
+    print('%12d %12d %12.0f %8d' %(max(counts), pool.checkedout(), 32 * 50 / took, len(errors)))
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or sorted(benchmarks)
+    for name in names:
+        print('== %s ==' %name)
+        benchmarks[name]()
+        print('')
@@ -15,6 +15,9 @@
 """ Start Application Code """
 """ ---------------------- """
 
+import asyncio
+import os
+import time
 import juno
 
 juno.init({'use_db': False, 'mode': 'wsgi', 'log': False, 'use_static': False, 
@@ -41,16 +44,213 @@ def x6(web): return str(web.input())
 @juno.get('/7/')
 def x7(web): return str(web.input())
 
+@juno.get('/8/w:name/')
+def x8(web, name): return 'word %s' %name
+
+@juno.get('/8/*:rest/')
+def x8b(web, rest): return 'rest %s' %rest
+
+@juno.get('/10/w:value/')
+def x10(web, value):
+    time.sleep(0)
+    return value
+
+@juno.get('/11/w:value/')
+def x11(web, value):
+    juno.header('X-Value', value)
+    time.sleep(0)
+    juno.append(value)
+    time.sleep(0)
+    juno.append('!')
+
+@juno.get('/12/')
+def x12(web): return str(os.getpid())
+
+@juno.get('/13/')
+def x13(web):
+    time.sleep(0.5)
+    return 'slow'
+
+@juno.get('/14/w:value/')
+async def x14(web, value):
+    juno.header('X-Value', value)
+    await asyncio.sleep(0.2)
+    juno.append(value)
+
+@juno.post('/15/')
+async def x15(web): return str(web.input())
+
+@juno.get('/16/w:count/')
+def x16(web, count):
+    juno.content_type('text/csv')
+    return ('row %d\n' %n for n in range(int(count)))
+
+@juno.get('/17/')
+def x17(web):
+    juno.append('head\n')
+    juno.append(iter(['a\n', b'b\n']))
+    juno.append('tail\n')
+
+juno.get('/18/*:file/')(juno.static_serve)
+
+@juno.get('/19/w:size/')
+def x19(web, size): return 'x' * int(size)
+
+@juno.get('/20/')
+def x20(web):
+    juno.content_type('image/png')
+    juno.header('ETag', '"png"')
+    juno.append(b'\x00' * 2000)
+
+calls = []
+
+@juno.get('/21/w:name/')
+@juno.cached(60, vary=['Accept-Language'])
+def x21(web, name):
+    calls.append(name)
+    return '%s %d %s' %(name, len(calls), web.raw.get('HTTP_ACCEPT_LANGUAGE', ''))
+
+@juno.get('/22/')
+@juno.cached(0.1)
+def x22(web):
+    calls.append('22')
+    return str(len(calls))
+
+@juno.get('/23/')
+@juno.cached(60)
+def x23(web):
+    calls.append('23')
+    time.sleep(0.2)
+    return str(len(calls))
+
+@juno.get('/24/')
+@juno.cached(60)
+async def x24(web):
+    calls.append('24')
+    await asyncio.sleep(0.2)
+    return str(len(calls))
+
+@juno.get('/25/')
+@juno.cached(0.3, stale=60)
+def x25(web):
+    calls.append('25')
+    time.sleep(0.1)
+    return str(len(calls))
+
+@juno.post('/26/')
+def x26(web): return 'ignored'
+
+@juno.get('/27/')
+def x27(web): return '%s %s' %(web.cookie('theme'), sorted(web.cookie()))
+
+environs = []
+
+@juno.get('/41/')
+def x41(web): environs.append(web.raw)
+
+uploads = []
+
+@juno.post('/28/')
+def x28(web):
+    fields = []
+    for name, value in sorted(web.input().items()):
+        if isinstance(value, juno.JunoUpload):
+            uploads.append(value)
+            value = '%s:%s:%s:%d:%s' %(value.filename, value.type, value.value.decode(),
+                                       value.size, value.file._rolled)
+        fields.append('%s=%s' %(name, value))
+    return ' '.join(fields)
+
+@juno.post('/29/')
+def x29(web): return web.json()
+
+@juno.get('/30/')
+def x30(web):
+    juno.status(201)
+    return [1, 'é', {'a': None}]
+
+@juno.get('/32/w:rows/')
+def x32(web, rows): juno.template('rows.html', rows=range(int(rows)))
+
+@juno.get('/33/w:rows/')
+def x33(web, rows): juno.stream_template('rows.html', rows=range(int(rows)))
+
+@juno.get('/31/')
+def x31(web):
+    juno.content_type('application/problem+json')
+    return {'title': 'Problem'}
+
+@juno.get('/34/')
+def x34(web): juno.notfound('<script>')
+
+@juno.get('/35/')
+def x35(web): raise ValueError('<boom>')
+
+@juno.get('/36/w:name/')
+def x36(web, name):
+    juno.session().add(juno.config('db_models')['Item'](name=name))
+    juno.session().flush()
+    return str(juno.config('db_engine').pool.checkedout())
+
+@juno.get('/37/')
+def x37(web):
+    juno.session().add(juno.config('db_models')['Item'](name='lost'))
+    raise ValueError
+
+@juno.get('/38/')
+def x38(web): return (item.name for item in juno.find('Item').order_by('name'))
+
+@juno.post('/39/')
+async def x39(web):
+    # Whether the form was parsed (in the thread pool) before the view ran
+    parsed = 'POST_DICT' in web.raw
+    return '%s %d' %(parsed, len(web.input('a') or ''))
+
+@juno.get('/40/')
+def x40(web):
+    db_session = juno.session()
+    def rows():
+        yield str(juno.session() is db_session)
+        juno.session().add(juno.config('db_models')['Item'](name='streamed'))
+        yield 'done'
+    return rows()
+
 application = juno.run()
+asgi_application = juno.get_asgi_application(juno.getHub().request_async)
 
 """ -------------------------------------- """
 """ End Application Code / Start Test Code """
 """ -------------------------------------- """
 
+import gzip
+import http.client
+import io
+import json
+import mimetypes
+import shutil
+import signal
+import socket
+import stat
+import sys
+import tempfile
+import threading
+import tracemalloc
 import unittest
 from client import Client
 client = Client(application)
 
+def call_asgi(method, url, query=b'', body=b'', headers=()):
+    """Calls the ASGI application, returns (status, headers, body)."""
+    messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    sent = []
+    async def receive(): return messages.pop(0)
+    async def send(message): sent.append(message)
+    scope = {'type': 'http', 'method': method, 'path': url,
+             'query_string': query, 'headers': list(headers)}
+    asyncio.run(asgi_application(scope, receive, send))
+    return (sent[0]['status'], dict(sent[0]['headers']),
+            b''.join(message['body'] for message in sent[1:]))
+
 class ResponseTest(unittest.TestCase):
     """Test basic responses - status codes, headers, bodies. """
     def test200StatusCode(self): 
@@ -78,6 +278,27 @@ class ResponseTest(unittest.TestCase):
         header = client.get_header('content-type')
         self.assertEqual(header[1], 'text/json')
 
+class ResponseBodyTest(unittest.TestCase):
+    """Test building response bodies with append(). """
+    def testAppend(self):
+        response = juno.JunoResponse()
+        for piece in ('caf\xe9', ' ', 42, b' ok'): response.append(piece)
+        self.assertEqual(response.body, 'caf\xe9 42 ok')
+        self.assertEqual(response['Content-Length'], 11)
+        self.assertEqual(response.render()[2], 'caf\xe9 42 ok'.encode('utf-8'))
+
+    def testBinaryBody(self):
+        response = juno.JunoResponse(headers={'Content-Type': 'image/png'})
+        response.append(b'\x89PNG').append(b'\x00')
+        self.assertEqual(response.body, b'\x89PNG\x00')
+        self.assertEqual(response['Content-Length'], 5)
+
+    def testClear(self):
+        response = juno.JunoResponse(body='partial')
+        response.clear().append('error')
+        self.assertEqual(response.body, 'error')
+        self.assertEqual(response['Content-Length'], 5)
+
 class QueryStringTest(unittest.TestCase):
     """Test Juno's handling of query strings. """
     def testQueryStringHeader(self):
@@ -90,6 +311,1748 @@ class QueryStringTest(unittest.TestCase):
         _, _, body = client.request('/7/', QUERY_STRING='a=0&a=1')
         self.assertEqual(body, ["{'a': ['0', '1']}"])
     
+class RouteIndexTest(unittest.TestCase):
+    """Test routing through the compiled route index. """
+    def testFirstMatchWins(self):
+        """Routes are tried in the order they were registered"""
+        _, _, body = client.request('/8/abc/')
+        self.assertEqual(body, [b'word abc'])
+        _, _, body = client.request('/8/a-b/')
+        self.assertEqual(body, [b'rest a-b'])
+
+    def testRouteAddedLater(self):
+        """Adding a route after a request rebuilds the index"""
+        client.request('/1/')
+        @juno.get('/9/late/')
+        def x9(web): return 'late'
+        _, _, body = client.request('/9/late/')
+        self.assertEqual(body, [b'late'])
+
+    def testIndexMatchesLinearScan(self):
+        """The index finds the same route as trying every route"""
+        hub = juno.getHub()
+        index = hub.get_route_index()
+        for url in ('/1/', '/8/abc/', '/8/a/b/', '/8/a-b/', '/10/', '/'):
+            expected = [r for r in hub.routes if r.url.match(url)]
+            found = [r for r in index.candidates(url) if r.url.match(url)]
+            self.assertEqual(found, expected)
+
+class ConcurrencyTest(unittest.TestCase):
+    """Test requests served from many threads at once. """
+    def testConcurrentRouteParams(self):
+        """Concurrent requests to one route get their own url parameters"""
+        errors = []
+        def worker(n):
+            thread_client = Client(application)
+            for i in range(250):
+                value = 'v%d_%d' %(n, i)
+                _, _, body = thread_client.request('/10/%s/' %value)
+                if body != [value.encode()]: errors.append((value, body))
+        # Switch threads as often as possible to shake out races
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            threads = [threading.Thread(target=worker, args=(n,)) for n in range(16)]
+            for t in threads: t.start()
+            for t in threads: t.join()
+        finally:
+            sys.setswitchinterval(interval)
+        self.assertEqual(errors, [])
+
+    def testConcurrentResponses(self):
+        """Threads using the response helpers each get their own response"""
+        errors = []
+        def worker(n):
+            thread_client = Client(application)
+            for i in range(250):
+                value = 'v%d_%d' %(n, i)
+                _, _, body = thread_client.request('/11/%s/' %value)
+                if body != [(value + '!').encode()] or \
+                   thread_client.get_header('x-value')[1] != value:
+                    errors.append((value, body))
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            threads = [threading.Thread(target=worker, args=(n,)) for n in range(16)]
+            for t in threads: t.start()
+            for t in threads: t.join()
+        finally:
+            sys.setswitchinterval(interval)
+        self.assertEqual(errors, [])
+
+    def testAsyncioTasksKeepOwnResponse(self):
+        """Interleaved asyncio requests each get their own response"""
+        hub = juno.getHub()
+        async def main():
+            # /14/ sets a header, awaits, then appends: the requests interleave
+            return await asyncio.gather(*[
+                hub.request_async('/14/%d/' %n, 'GET', PATH_INFO='/14/%d/' %n,
+                                  REQUEST_METHOD='GET') for n in range(50)])
+        for n, (status, headers, body) in enumerate(asyncio.run(main())):
+            self.assertEqual(status, '200 OK')
+            self.assertEqual(dict(headers)['X-Value'], str(n))
+            self.assertEqual(body, str(n).encode())
+
+class StreamingTest(unittest.TestCase):
+    """Test generator and iterable bodies. """
+    def testGeneratorBody(self):
+        status, headers, body = client.request('/16/3/')
+        self.assertEqual(list(body), [b'row 0\n', b'row 1\n', b'row 2\n'])
+        self.assertRaises(Exception, client.get_header, 'Content-Length')
+        self.assertEqual(client.get_header('Content-Type')[1], 'text/csv')
+
+    def testBodyIsLazy(self):
+        """Chunks are generated as the server asks for them"""
+        status, headers, body = client.request('/16/1000000000/')
+        self.assertEqual(next(iter(body)), b'row 0\n')
+        body.close()
+
+    def testAppendIterable(self):
+        status, headers, body = client.request('/17/')
+        self.assertEqual(b''.join(body), b'head\na\nb\ntail\n')
+        self.assertRaises(Exception, client.get_header, 'Content-Length')
+
+class StaticFileTest(unittest.TestCase):
+    """Test serving static files, whole and in ranges. """
+    data = bytes(range(256)) * 1200
+
+    @classmethod
+    def setUpClass(cls):
+        cls.root = tempfile.mkdtemp()
+        with open(os.path.join(cls.root, 'data.bin'), 'wb') as f: f.write(cls.data)
+        cls.old_root = juno.config('static_root')
+        juno.config('static_root', cls.root)
+
+    @classmethod
+    def tearDownClass(cls):
+        juno.config('static_root', cls.old_root)
+        shutil.rmtree(cls.root)
+
+    def request(self, **headers):
+        status, _, body = client.request('/18/data.bin', **headers)
+        for name in headers: del client.environ[name]
+        return status, b''.join(body)
+
+    def testWholeFile(self):
+        status, body = self.request()
+        self.assertEqual((status, body), ('200 OK', self.data))
+        self.assertEqual(client.get_header('Content-Length')[1], str(len(self.data)))
+        self.assertEqual(client.get_header('Accept-Ranges')[1], 'bytes')
+
+    def testFileWrapper(self):
+        """Whole files go to the server's wsgi.file_wrapper"""
+        from wsgiref.util import FileWrapper
+        status, _, body = client.request('/18/data.bin', **{'wsgi.file_wrapper': FileWrapper})
+        del client.environ['wsgi.file_wrapper']
+        self.assertTrue(isinstance(body, FileWrapper))
+        self.assertEqual(b''.join(body), self.data)
+        body.close()
+
+    def testRange(self):
+        status, body = self.request(HTTP_RANGE='bytes=1000-1999')
+        self.assertEqual((status, body), ('206 Partial Content', self.data[1000:2000]))
+        self.assertEqual(client.get_header('Content-Range')[1], 'bytes 1000-1999/307200')
+        self.assertEqual(client.get_header('Content-Length')[1], '1000')
+
+    def testOpenAndSuffixRanges(self):
+        status, body = self.request(HTTP_RANGE='bytes=307190-')
+        self.assertEqual(body, self.data[307190:])
+        status, body = self.request(HTTP_RANGE='bytes=-10')
+        self.assertEqual(body, self.data[-10:])
+        status, body = self.request(HTTP_RANGE='bytes=307190-999999')
+        self.assertEqual(body, self.data[307190:])
+
+    def testUnsatisfiableRange(self):
+        status, body = self.request(HTTP_RANGE='bytes=307200-')
+        self.assertEqual((status, body), ('416 Range Not Satisfiable', b''))
+        self.assertEqual(client.get_header('Content-Range')[1], 'bytes */307200')
+
+    def testIgnoredRanges(self):
+        """Invalid and multiple ranges, and stale If-Range, get the whole file"""
+        for headers in ({'HTTP_RANGE': 'bytes=0-1,5-6'}, {'HTTP_RANGE': 'bytes=9-1'},
+                        {'HTTP_RANGE': 'lines=1-2'},
+                        {'HTTP_RANGE': 'bytes=0-1', 'HTTP_IF_RANGE': 'yesterday'}):
+            self.assertEqual(self.request(**headers), ('200 OK', self.data))
+
+    def testNotModified(self):
+        """Clients with an up to date copy get an empty 304"""
+        self.request()
+        etag = client.get_header('ETag')[1]
+        last_modified = client.get_header('Last-Modified')[1]
+        for headers in ({'HTTP_IF_NONE_MATCH': etag},
+                        {'HTTP_IF_NONE_MATCH': '"other", W/%s' %etag},
+                        {'HTTP_IF_MODIFIED_SINCE': last_modified}):
+            self.assertEqual(self.request(**headers), ('304 Not Modified', b''))
+            self.assertEqual(client.get_header('ETag')[1], etag)
+            self.assertRaises(Exception, client.get_header, 'Content-Length')
+
+    def testModified(self):
+        """Clients with an old copy get the file"""
+        for headers in ({'HTTP_IF_NONE_MATCH': '"other"'},
+                        {'HTTP_IF_MODIFIED_SINCE': 'Sun, 06 Nov 1994 08:49:37 GMT'},
+                        {'HTTP_IF_MODIFIED_SINCE': 'not a date'},
+                        # If-None-Match wins over If-Modified-Since
+                        {'HTTP_IF_NONE_MATCH': '"other"',
+                         'HTTP_IF_MODIFIED_SINCE': 'Sun, 06 Nov 2094 08:49:37 GMT'}):
+            self.assertEqual(self.request(**headers), ('200 OK', self.data))
+
+    def testETagChanges(self):
+        self.request()
+        etag = client.get_header('ETag')[1]
+        path = os.path.join(self.root, 'data.bin')
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+        self.assertEqual(self.request(HTTP_IF_NONE_MATCH=etag), ('200 OK', self.data))
+        self.assertNotEqual(client.get_header('ETag')[1], etag)
+
+    def testIfRangeETag(self):
+        self.request()
+        etag = client.get_header('ETag')[1]
+        status, body = self.request(HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE=etag)
+        self.assertEqual((status, body), ('206 Partial Content', self.data[:10]))
+
+    def testTraversal(self):
+        """Paths outside static_root are turned down before the cache sees them"""
+        outside = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(outside, 'secret'), 'w') as f: f.write('secret')
+            juno.config('static_root', os.path.join(outside, 'static'))
+            os.mkdir(os.path.join(outside, 'static'))
+            juno.getHub().static_cache = None
+            status, _, body = client.request('/18/../secret')
+            self.assertEqual(status, '404 Not Found')
+            self.assertEqual(juno.getHub().get_static_cache().stats()['misses'], 0)
+            self.assertEqual(len(juno.getHub().get_static_cache().entries), 0)
+            # Nor can a symlink lead out of it
+            os.symlink(os.path.join(outside, 'secret'), os.path.join(outside, 'static', 'link'))
+            status, _, body = client.request('/18/link')
+            self.assertEqual(status, '404 Not Found')
+            self.assertEqual(len(juno.getHub().get_static_cache().entries), 0)
+        finally:
+            juno.config('static_root', self.root)
+            shutil.rmtree(outside)
+
+    def testOneLookup(self):
+        """A request looks its file up in the cache once"""
+        juno.getHub().static_cache = None
+        self.request()
+        stats = juno.getHub().get_static_cache().stats()
+        self.assertEqual((stats['hits'], stats['misses']), (0, 1))
+        self.request(HTTP_RANGE='bytes=0-9')
+        stats = juno.getHub().get_static_cache().stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+    def testCacheControl(self):
+        juno.config('static_expires', 60)
+        try:
+            self.request()
+            self.assertEqual(client.get_header('Cache-Control')[1], 'public, max-age=60')
+            juno.config('static_cache_control', 'no-cache')
+            self.request()
+            self.assertEqual(client.get_header('Cache-Control')[1], 'no-cache')
+        finally:
+            # config(key, None) would read the option, not clear it
+            juno.config({'static_expires': 0, 'static_cache_control': None})
+
+class StaticCacheTest(unittest.TestCase):
+    """Test the static file cache. """
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.cache = juno.JunoStaticCache(4 * 2048, 1500)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write(self, name, data):
+        path = os.path.join(self.root, name)
+        with open(path, 'wb') as f: f.write(data)
+        return path
+
+    def testHitsAndMisses(self):
+        path = self.write('a.css', b'body {}')
+        entry = self.cache.get(path)
+        self.assertEqual((entry.data, entry.mimetype), (b'body {}', 'text/css'))
+        self.assertTrue(self.cache.get(path) is entry)
+        self.assertEqual(self.cache.get(os.path.join(self.root, 'missing')), None)
+        self.assertEqual(self.cache.get(self.root), None)
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['entries']), (1, 3, 1))
+
+    def testChangedFile(self):
+        path = self.write('a.txt', b'old')
+        self.cache.get(path)
+        self.write('a.txt', b'newer')
+        self.assertEqual(self.cache.get(path).data, b'newer')
+        os.remove(path)
+        self.assertEqual(self.cache.get(path), None)
+        self.assertEqual(self.cache.stats()['entries'], 0)
+
+    def testBigFilesKeepNoData(self):
+        entry = self.cache.get(self.write('big.bin', b'x' * 2000))
+        self.assertEqual((entry.data, entry.stat.st_size), (None, 2000))
+
+    def testNoCacheNoData(self):
+        """With a cache size of 0, files aren't read"""
+        cache = juno.JunoStaticCache(0, 1500)
+        entry = cache.get(self.write('a.css', b'body {}'))
+        self.assertEqual((entry.data, cache.stats()['entries']), (None, 0))
+
+    def testEviction(self):
+        """The least recently used entries go when over the byte budget"""
+        paths = [self.write('%d.txt' %n, b'x' * 1000) for n in range(5)]
+        for path in paths[:4]: self.cache.get(path)
+        self.cache.get(paths[0])
+        self.cache.get(paths[4])
+        stats = self.cache.stats()
+        self.assertEqual((stats['entries'], stats['evictions']), (4, 1))
+        self.assertTrue(stats['bytes'] <= 4 * 2048)
+        self.assertTrue(paths[1] not in self.cache.entries)
+        self.assertTrue(paths[0] in self.cache.entries)
+
+    def testServedFromMemory(self):
+        self.write('small.txt', b'hello')
+        old_root = juno.config('static_root')
+        juno.config('static_root', self.root)
+        try:
+            status, _, body = client.request('/18/small.txt')
+            self.assertEqual((status, body), ('200 OK', [b'hello']))
+            status, _, body = client.request('/18/small.txt', HTTP_RANGE='bytes=1-2')
+            del client.environ['HTTP_RANGE']
+            self.assertEqual((status, body), ('206 Partial Content', [b'el']))
+        finally:
+            juno.config('static_root', old_root)
+
+class CompressionTest(unittest.TestCase):
+    """Test gzip compression of responses. """
+    def tearDown(self):
+        client.environ.pop('HTTP_ACCEPT_ENCODING', None)
+        client.environ.pop('HTTP_RANGE', None)
+
+    def header(self, name):
+        try: return client.get_header(name)[1]
+        except Exception: return None
+
+    def testCompressed(self):
+        status, headers, body = client.request('/19/5000/', HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(gzip.decompress(body[0]), b'x' * 5000)
+        self.assertEqual(self.header('Content-Encoding'), 'gzip')
+        self.assertEqual(self.header('Content-Length'), str(len(body[0])))
+        self.assertEqual(self.header('Vary'), 'Accept-Encoding')
+
+    def testNotAccepted(self):
+        for accept in (None, 'identity', 'gzip;q=0', 'compress'):
+            if accept is not None: client.environ['HTTP_ACCEPT_ENCODING'] = accept
+            status, headers, body = client.request('/19/5000/')
+            self.assertEqual(body, [b'x' * 5000])
+            self.assertEqual(self.header('Content-Encoding'), None)
+            self.assertEqual(self.header('Vary'), 'Accept-Encoding')
+
+    def testChooseEncoding(self):
+        self.assertEqual(juno.choose_encoding('deflate, gzip;q=0.5'), 'gzip')
+        self.assertEqual(juno.choose_encoding('*'), juno.available_encodings()[0])
+        self.assertEqual(juno.choose_encoding('*, gzip;q=0'),
+                         'br' if 'br' in juno.available_encodings() else None)
+        self.assertEqual(juno.choose_encoding(''), None)
+
+    def testSmallAndBinaryBodies(self):
+        status, headers, body = client.request('/19/100/', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(body, [b'x' * 100])
+        self.assertEqual(self.header('Vary'), None)
+        status, headers, body = client.request('/20/')
+        self.assertEqual(body, [b'\x00' * 2000])
+        self.assertEqual(self.header('Content-Encoding'), None)
+
+    def testStaticFiles(self):
+        root = tempfile.mkdtemp()
+        old_root = juno.config('static_root')
+        juno.config('static_root', root)
+        client.environ['HTTP_ACCEPT_ENCODING'] = 'gzip'
+        try:
+            with open(os.path.join(root, 'app.js'), 'wb') as f: f.write(b'var x;' * 1000)
+            status, headers, body = client.request('/18/app.js')
+            body = b''.join(body)
+            self.assertEqual(gzip.decompress(body), b'var x;' * 1000)
+            self.assertEqual(self.header('Content-Type'), mimetypes.guess_type('app.js')[0])
+            etag = self.header('ETag')
+            self.assertTrue(etag.endswith('-gzip"'))
+            # Compressed once, then kept
+            entry = juno.getHub().get_static_cache().get(os.path.join(root, 'app.js'))
+            self.assertEqual(entry.compressed, {'gzip': body})
+            status, headers, body = client.request('/18/app.js', HTTP_IF_NONE_MATCH=etag)
+            del client.environ['HTTP_IF_NONE_MATCH']
+            self.assertEqual(status, '304 Not Modified')
+            # Partial requests get the file as it is
+            status, headers, body = client.request('/18/app.js', HTTP_RANGE='bytes=0-5')
+            self.assertEqual((status, b''.join(body)), ('206 Partial Content', b'var x;'))
+            del client.environ['HTTP_RANGE']
+            # A precompressed sibling wins
+            with open(os.path.join(root, 'app.js.gz'), 'wb') as f: f.write(b'precompressed')
+            juno.getHub().get_static_cache().clear()
+            status, headers, body = client.request('/18/app.js')
+            self.assertEqual(b''.join(body), b'precompressed')
+            self.assertEqual(self.header('Content-Encoding'), 'gzip')
+        finally:
+            juno.config('static_root', old_root)
+            shutil.rmtree(root)
+
+    def testRangesAndVary(self):
+        """Ranges aren't compressed, and Vary names Accept-Encoding once"""
+        root = tempfile.mkdtemp()
+        old_root = juno.config('static_root')
+        juno.config('static_root', root)
+        try:
+            with open(os.path.join(root, 'app.js'), 'wb') as f: f.write(b'var x;' * 2000)
+            status, headers, body = client.request('/18/app.js')
+            self.assertEqual(b''.join(body), b'var x;' * 2000)
+            self.assertEqual([v for k, v in client.headers if k == 'Vary'], ['Accept-Encoding'])
+            status, headers, body = client.request('/18/app.js', HTTP_ACCEPT_ENCODING='gzip',
+                                                   HTTP_RANGE='bytes=0-4999')
+            self.assertEqual((status, b''.join(body)),
+                             ('206 Partial Content', (b'var x;' * 2000)[:5000]))
+            self.assertEqual(self.header('Content-Encoding'), None)
+            self.assertEqual(self.header('Content-Range'), 'bytes 0-4999/12000')
+        finally:
+            juno.config('static_root', old_root)
+            shutil.rmtree(root)
+
+class OutputCacheTest(unittest.TestCase):
+    """Test caching the responses of cached() views. """
+    def setUp(self):
+        juno.getHub().output_cache = None
+        del calls[:]
+
+    def get(self, url, **headers):
+        # Earlier tests may have left a query string in client.environ
+        headers.setdefault('QUERY_STRING', '')
+        environ = client.environ.copy()
+        try: status, _, body = client.request(url, **headers)
+        finally: client.environ = environ
+        return body[0]
+
+    def testCached(self):
+        self.assertEqual(self.get('/21/a/'), b'a 1 ')
+        self.assertEqual(self.get('/21/a/'), b'a 1 ')
+        self.assertEqual(self.get('/21/b/'), b'b 2 ')
+        self.assertEqual(self.get('/21/a/', QUERY_STRING='x=1'), b'a 3 ')
+        self.assertEqual(calls, ['a', 'b', 'a'])
+        stats = juno.output_cache_stats()['/21/w:name/']
+        self.assertEqual((stats['hits'], stats['misses']), (1, 3))
+        self.assertEqual(stats['hit_rate'], 0.25)
+
+    def testHeadersNotShared(self):
+        """Middleware adding headers doesn't change the cached response"""
+        def add_cookie(environ, start_response):
+            def start(status, headers, exc_info=None):
+                headers.append(('Set-Cookie', 'a=1'))
+                return start_response(status, headers)
+            return application(environ, start)
+        for i in range(3):
+            status, headers, body = Client(add_cookie).request('/21/a/', QUERY_STRING='')
+            self.assertEqual(body, [b'a 1 '])
+            self.assertEqual([v for k, v in headers if k == 'Set-Cookie'], ['a=1'])
+
+    def testVary(self):
+        self.assertEqual(self.get('/21/a/', HTTP_ACCEPT_LANGUAGE='fr'), b'a 1 fr')
+        self.assertEqual(self.get('/21/a/', HTTP_ACCEPT_LANGUAGE='de'), b'a 2 de')
+        self.assertEqual(self.get('/21/a/', HTTP_ACCEPT_LANGUAGE='fr'), b'a 1 fr')
+
+    def testBypass(self):
+        """Requests with a session cookie or credentials run the view"""
+        self.get('/21/a/')
+        self.assertEqual(self.get('/21/a/', HTTP_COOKIE='session=abc'), b'a 2 ')
+        self.assertEqual(self.get('/21/a/', HTTP_AUTHORIZATION='Basic eDp5'), b'a 3 ')
+        self.assertEqual(self.get('/21/a/'), b'a 1 ')
+        policy = juno.JunoCachePolicy(60)
+        self.assertEqual(policy.key('/a/', {'REQUEST_METHOD': 'POST'}), None)
+        self.assertEqual(policy.key('/a/', {'REQUEST_METHOD': 'HEAD'}),
+                         policy.key('/a/', {'REQUEST_METHOD': 'GET'}))
+
+    def testTTL(self):
+        self.assertEqual(self.get('/22/'), b'1')
+        self.assertEqual(self.get('/22/'), b'1')
+        time.sleep(0.15)
+        self.assertEqual(self.get('/22/'), b'2')
+
+    def testInvalidate(self):
+        self.get('/21/a/', HTTP_ACCEPT_LANGUAGE='fr')
+        self.get('/21/a/')
+        self.get('/21/b/')
+        juno.invalidate('/21/a')
+        self.assertEqual(self.get('/21/a/'), b'a 4 ')
+        self.assertEqual(self.get('/21/a/', HTTP_ACCEPT_LANGUAGE='fr'), b'a 5 fr')
+        self.assertEqual(self.get('/21/b/'), b'b 3 ')
+        juno.invalidate_route(x21)
+        self.assertEqual(self.get('/21/b/'), b'b 6 ')
+        juno.invalidate_route('/21/w:name/')
+        self.assertEqual(self.get('/21/b/'), b'b 7 ')
+
+    def testMemoryBound(self):
+        cache = juno.JunoOutputCache(juno.JunoMemoryBackend(4000))
+        rendered = ('200 OK', [], b'x' * 1000)
+        for n in range(5): cache.set(str(n), '/r/', rendered, 60)
+        self.assertTrue(cache.backend.bytes <= 4000)
+        self.assertEqual(cache.get('0', '/r/'), None)
+        self.assertEqual(cache.get('4', '/r/'), rendered)
+
+    def testUncacheableResponses(self):
+        cache = juno.JunoOutputCache(juno.JunoMemoryBackend(4000))
+        cache.set('a', '/r/', ('404 Not Found', [], b''), 60)
+        cache.set('b', '/r/', ('200 OK', [('Set-Cookie', 'a=b')], b''), 60)
+        cache.set('c', '/r/', ('200 OK', [], iter([b''])), 60)
+        self.assertEqual(len(cache.backend.entries), 0)
+
+class CoalescingTest(unittest.TestCase):
+    """Test that concurrent identical requests to cached() views share one
+    run of the view. """
+    def setUp(self):
+        juno.getHub().output_cache = None
+        del calls[:]
+
+    def request(self, url):
+        return juno.getHub().request(url, 'GET', PATH_INFO=url, REQUEST_METHOD='GET',
+                                     QUERY_DICT={}, POST_DICT={})[2]
+
+    def testThreads(self):
+        bodies = []
+        def get(): bodies.append(self.request('/23/'))
+        threads = [threading.Thread(target=get) for n in range(8)]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+        self.assertEqual(calls, ['23'])
+        self.assertEqual(bodies, [b'1'] * 8)
+        stats = juno.output_cache_stats()['/23/']
+        self.assertEqual((stats['misses'], stats['coalesced']), (8, 7))
+
+    def testCoroutines(self):
+        async def main():
+            hub = juno.getHub()
+            return await asyncio.gather(*[
+                hub.request_async('/24/', 'GET', PATH_INFO='/24/', REQUEST_METHOD='GET',
+                                  QUERY_DICT={}, POST_DICT={}) for n in range(8)])
+        rendered = asyncio.run(main())
+        self.assertEqual(calls, ['24'])
+        self.assertEqual([body for _, _, body in rendered], [b'1'] * 8)
+
+    def testUnshareable(self):
+        """Waiting requests run the view themselves if the response can't be
+        shared"""
+        cache = juno.JunoOutputCache(juno.JunoMemoryBackend(4000))
+        flight, leader = cache.join_flight('k')
+        self.assertTrue(leader)
+        self.assertEqual(cache.join_flight('k'), (flight, False))
+        cache.land('k', flight, ('200 OK', [('Set-Cookie', 'a=b')], b''))
+        self.assertEqual(flight.wait(), None)
+        self.assertEqual(cache.join_flight('k')[1], True)
+
+    def testStaleWhileRevalidate(self):
+        self.assertEqual(self.request('/25/'), b'1')
+        time.sleep(0.35)
+        # Stale: served at once, while one refresh runs
+        start = time.time()
+        self.assertEqual(self.request('/25/'), b'1')
+        self.assertEqual(self.request('/25/'), b'1')
+        self.assertTrue(time.time() - start < 0.1)
+        time.sleep(0.2)
+        self.assertEqual(self.request('/25/'), b'2')
+        self.assertEqual(calls, ['25', '25'])
+        self.assertEqual(juno.output_cache_stats()['/25/']['stale'], 2)
+
+    def testStaleWhileRevalidateAsync(self):
+        hub = juno.getHub()
+        async def get():
+            return (await hub.request_async('/25/', 'GET', PATH_INFO='/25/',
+                                            REQUEST_METHOD='GET', QUERY_DICT={},
+                                            POST_DICT={}))[2]
+        async def main():
+            self.assertEqual(await get(), b'1')
+            await asyncio.sleep(0.35)
+            self.assertEqual(await get(), b'1')
+            await asyncio.sleep(0.2)
+            self.assertEqual(await get(), b'2')
+        asyncio.run(main())
+        self.assertEqual(calls, ['25', '25'])
+
+class CacheBackendTest(unittest.TestCase):
+    """Test the output cache backends shared between processes. """
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.rendered = ('200 OK', [('Content-Type', 'text/html')], b'cached')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def backends(self):
+        return [juno.JunoMmapBackend(os.path.join(self.root, 'cache.mmap'), 1024 * 1024),
+                juno.JunoSqliteBackend(os.path.join(self.root, 'cache.db'), 1024 * 1024)]
+
+    def entry(self, url='GET /a/', route='/a/', ttl=60):
+        return juno.JunoCacheEntry(self.rendered, route, url, time.time() + ttl, 0.01)
+
+    def testGetSetDelete(self):
+        for backend in self.backends():
+            cache = juno.JunoOutputCache(backend)
+            self.assertEqual(cache.get('GET /a/', '/a/'), None)
+            cache.set('GET /a/', '/a/', self.rendered, 60, 0.01)
+            cache.set('GET /a/\nfr', '/a/', self.rendered, 60)
+            cache.set('GET /b/', '/w:x/', self.rendered, 60)
+            self.assertEqual(cache.get('GET /a/', '/a/'), self.rendered)
+            cache.delete_url('GET /a/')
+            self.assertEqual(backend.get('GET /a/'), None)
+            self.assertEqual(backend.get('GET /a/\nfr'), None)
+            self.assertEqual(backend.get('GET /b/').url, 'GET /b/')
+            cache.delete_route('/w:x/')
+            self.assertEqual(backend.get('GET /b/'), None)
+
+    def testExpiry(self):
+        for backend in self.backends():
+            cache = juno.JunoOutputCache(backend)
+            cache.set('GET /a/', '/a/', self.rendered, -1)
+            self.assertEqual(cache.get('GET /a/', '/a/'), None)
+            self.assertEqual(backend.get('GET /a/'), None)
+
+    def testAbstract(self):
+        """Backends have to implement every method"""
+        self.assertRaises(TypeError, juno.JunoCacheBackend)
+        class Partial(juno.JunoCacheBackend):
+            def get(self, key): return None
+        self.assertRaises(TypeError, Partial)
+
+    def testNoPickles(self):
+        """Entries are JSON and bytes; anything else in the file is a miss"""
+        entry = juno.JunoCacheEntry.decode(self.entry().encode())
+        self.assertEqual((entry.rendered, entry.url, entry.route),
+                         (self.rendered, 'GET /a/', '/a/'))
+        import pickle
+        self.assertIsNone(juno.JunoCacheEntry.decode(pickle.dumps(self.rendered)))
+        backend = self.backends()[1]
+        backend.set('GET /a/', self.entry())
+        backend.connection().execute('UPDATE juno_cache SET value = ?',
+                                     (pickle.dumps(self.rendered),))
+        self.assertIsNone(backend.get('GET /a/'))
+
+    def testPrivateTempdir(self):
+        old = tempfile.tempdir
+        tempfile.tempdir = self.root
+        try:
+            path = juno.private_tempdir('juno-test')
+            self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o700)
+            self.assertEqual(juno.private_tempdir('juno-test'), path)
+            # Somebody else can write to it
+            os.chmod(path, 0o777)
+            self.assertRaises(RuntimeError, juno.private_tempdir, 'juno-test')
+            os.rmdir(path)
+            os.symlink(self.root, path)
+            self.assertRaises(RuntimeError, juno.private_tempdir, 'juno-test')
+        finally: tempfile.tempdir = old
+
+    def testTooBig(self):
+        backend = juno.JunoMmapBackend(os.path.join(self.root, 'cache.mmap'), 8192, 4096)
+        self.rendered = ('200 OK', [], b'x' * 5000)
+        backend.set('GET /a/', self.entry())
+        self.assertEqual(backend.get('GET /a/'), None)
+
+    def testSharedBetweenProcesses(self):
+        """Entries and invalidations are seen by every process"""
+        for backend in self.backends():
+            backend.get('GET /a/')
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    backend.set('GET /a/', self.entry())
+                    backend.set('GET /b/', self.entry('GET /b/'))
+                    backend.delete('GET /b/')
+                finally: os._exit(0)
+            os.waitpid(pid, 0)
+            self.assertEqual(backend.get('GET /a/').rendered, self.rendered)
+            self.assertEqual(backend.get('GET /b/'), None)
+            pid = os.fork()
+            if pid == 0:
+                try: backend.clear()
+                finally: os._exit(0)
+            os.waitpid(pid, 0)
+            self.assertEqual(backend.get('GET /a/'), None)
+
+    def testHubBackend(self):
+        hub = juno.getHub()
+        old = hub.config['output_cache_backend'], hub.config['output_cache_path']
+        hub.config['output_cache_backend'] = 'sqlite'
+        hub.config['output_cache_path'] = os.path.join(self.root, 'hub.db')
+        hub.output_cache = None
+        del calls[:]
+        try:
+            for n in range(2):
+                environ = client.environ.copy()
+                try: status, _, body = client.request('/21/sqlite/')
+                finally: client.environ = environ
+                self.assertEqual(body[0], b'sqlite 1 ')
+            self.assertTrue(isinstance(hub.output_cache.backend, juno.JunoSqliteBackend))
+        finally:
+            hub.config['output_cache_backend'], hub.config['output_cache_path'] = old
+            hub.output_cache = None
+
+class ThreadedServerTest(unittest.TestCase):
+    """Test the threaded HTTP/1.1 server. """
+    def setUp(self):
+        self.server = juno.JunoServer(('127.0.0.1', 0), application, threads=2)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.port = self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+
+    def get(self, conn, url):
+        conn.request('GET', url)
+        response = conn.getresponse()
+        return response, response.read()
+
+    def testKeepAlive(self):
+        """HTTP/1.1 clients can send several requests on one connection"""
+        conn = http.client.HTTPConnection('127.0.0.1', self.port)
+        _, body = self.get(conn, '/10/first/')
+        sock = conn.sock
+        response, body = self.get(conn, '/10/second/')
+        self.assertEqual(body, b'second')
+        self.assertEqual(response.getheader('Content-Length'), '6')
+        self.assertTrue(conn.sock is sock)
+        conn.close()
+
+    def testMaxRequests(self):
+        """No more than max_requests are served, even with busy threads"""
+        server = juno.JunoServer(('127.0.0.1', 0), application, threads=2,
+                                 max_requests=3)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        results = []
+        def get():
+            conn = http.client.HTTPConnection('127.0.0.1',
+                                              server.server_address[1], timeout=5)
+            try: results.append(self.get(conn, '/13/')[0].status)
+            except (OSError, http.client.HTTPException): results.append(None)
+            conn.close()
+        clients = [threading.Thread(target=get) for i in range(5)]
+        for client in clients: client.start()
+        thread.join(10)
+        server.server_close()
+        for client in clients: client.join()
+        self.assertEqual(server.requests, 3)
+        self.assertEqual(results.count(200), 3)
+
+    def testChunkedResponse(self):
+        """Streamed bodies are sent with chunked transfer encoding"""
+        conn = http.client.HTTPConnection('127.0.0.1', self.port)
+        response, body = self.get(conn, '/16/1000/')
+        self.assertEqual(response.getheader('Transfer-Encoding'), 'chunked')
+        self.assertEqual(body, b''.join(b'row %d\n' %n for n in range(1000)))
+        response, body = self.get(conn, '/10/again/')
+        self.assertEqual(body, b'again')
+        conn.close()
+
+    def testSendFile(self):
+        """Static files are sent with sendfile(), whole or in part"""
+        root = tempfile.mkdtemp()
+        old_root = juno.config('static_root')
+        juno.config('static_root', root)
+        try:
+            data = os.urandom(300000)
+            with open(os.path.join(root, 'data.bin'), 'wb') as f: f.write(data)
+            conn = http.client.HTTPConnection('127.0.0.1', self.port)
+            response, body = self.get(conn, '/18/data.bin')
+            self.assertEqual(body, data)
+            conn.request('GET', '/18/data.bin', headers={'Range': 'bytes=100-199'})
+            response = conn.getresponse()
+            self.assertEqual((response.status, response.read()), (206, data[100:200]))
+            response, body = self.get(conn, '/10/again/')
+            self.assertEqual(body, b'again')
+            conn.close()
+        finally:
+            juno.config('static_root', old_root)
+            shutil.rmtree(root)
+
+    def testPipelinedRequests(self):
+        """Requests sent back to back are answered in order"""
+        sock = socket.create_connection(('127.0.0.1', self.port))
+        sock.sendall(b'GET /10/a/ HTTP/1.1\r\nHost: x\r\n\r\n'
+                     b'GET /10/b/ HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n')
+        data = b''
+        while True:
+            chunk = sock.recv(4096)
+            if not chunk: break
+            data += chunk
+        sock.close()
+        self.assertEqual(data.count(b'200 OK'), 2)
+        self.assertTrue(data.index(b'\r\n\r\na') < data.index(b'\r\n\r\nb'))
+
+    def testIdleClientsDontStall(self):
+        """Idle keep-alive and slow clients don't hold up other requests"""
+        idle = []
+        for i in range(4):
+            conn = http.client.HTTPConnection('127.0.0.1', self.port)
+            self.get(conn, '/1/')
+            idle.append(conn)
+        slow = socket.create_connection(('127.0.0.1', self.port))
+        slow.sendall(b'GET /1/ HTTP/1.1\r\nHo')
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=5)
+        _, body = self.get(conn, '/10/ok/')
+        self.assertEqual(body, b'ok')
+        for c in idle + [conn, slow]: c.close()
+
+class PreforkServerTest(unittest.TestCase):
+    """Test the pre-forking server. """
+    def setUp(self):
+        self.master = juno.JunoPreforkMaster(('127.0.0.1', 0), application,
+                                             workers=2, max_requests=3,
+                                             threads=2, graceful_timeout=5)
+        self.port = self.master.address[1]
+        self.pid = os.fork()
+        if self.pid == 0:
+            try: self.master.run()
+            finally: os._exit(0)
+        self.master.socket.close()
+
+    def tearDown(self):
+        if self.pid:
+            try: os.kill(self.pid, signal.SIGKILL)
+            except OSError: pass
+            try: os.waitpid(self.pid, 0)
+            except ChildProcessError: pass
+
+    def get(self, url):
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=10)
+        conn.request('GET', url, headers={'Connection': 'close'})
+        response = conn.getresponse()
+        body = response.read()
+        conn.close()
+        return response.status, body
+
+    def stop(self):
+        os.kill(self.pid, signal.SIGTERM)
+        _, status = os.waitpid(self.pid, 0)
+        self.pid = None
+        return status
+
+    def testWorkersAreRecycled(self):
+        """Workers serve at most max_requests before being replaced"""
+        served = {}
+        for i in range(12):
+            status, body = self.get('/12/')
+            self.assertEqual(status, 200)
+            served[body] = served.get(body, 0) + 1
+        self.assertTrue(len(served) >= 4)
+        self.assertTrue(max(served.values()) <= 3)
+        self.assertTrue(sum(self.master.counts) <= 12)
+        self.assertEqual(self.stop(), 0)
+
+    def testReload(self):
+        """SIGHUP replaces the workers without refusing requests"""
+        old = set(self.get('/12/')[1] for i in range(2))
+        os.kill(self.pid, signal.SIGHUP)
+        time.sleep(0.5)
+        status, body = self.get('/12/')
+        self.assertEqual(status, 200)
+        self.assertTrue(body not in old)
+        self.assertEqual(self.stop(), 0)
+
+    def testGracefulShutdown(self):
+        """Requests in progress finish when the master is stopped"""
+        results = []
+        thread = threading.Thread(target=lambda: results.append(self.get('/13/')))
+        thread.start()
+        time.sleep(0.2)
+        self.assertEqual(self.stop(), 0)
+        thread.join()
+        self.assertEqual(results, [(200, b'slow')])
+
+class LazyParsingTest(unittest.TestCase):
+    """Test that request data is only parsed when a view asks for it. """
+    class Input(object):
+        def __init__(self, data):
+            self.file = io.BytesIO(data)
+            self.reads = 0
+        def read(self, size=-1):
+            self.reads += 1
+            return self.file.read(size)
+        def readline(self, size=-1):
+            self.reads += 1
+            return self.file.readline(size)
+
+    def call(self, method, url, body=b'', **headers):
+        environ = {'REQUEST_METHOD': method, 'PATH_INFO': url, 'QUERY_STRING': '',
+                   'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+                   'CONTENT_LENGTH': str(len(body)), 'wsgi.input': self.Input(body)}
+        environ.update(headers)
+        status = []
+        result = application(environ, lambda s, h: status.append(s))
+        return status[0], b''.join(result), environ['wsgi.input'].reads
+
+    def testBodyNotRead(self):
+        """Views that don't ask for the form data don't read the body"""
+        status, body, reads = self.call('POST', '/26/', b'a=1')
+        self.assertEqual((status, body, reads), ('200 OK', b'ignored', 0))
+        status, body, reads = self.call('POST', '/15/', b'a=1')
+        self.assertEqual(body, b"{'a': '1'}")
+        self.assertTrue(reads > 0)
+
+    def testEnvironCopiedOnce(self):
+        """The view gets the JunoEnviron prepare_environ() made"""
+        environ = juno.prepare_environ({'REQUEST_METHOD': 'GET', 'PATH_INFO': '/41/'})
+        juno.getHub().request('/41/', 'GET', environ=environ)
+        self.assertTrue(environs[-1] is environ)
+        made = []
+        class CountedEnviron(juno.JunoEnviron):
+            def __init__(self, *args):
+                made.append(1)
+                dict.__init__(self, *args)
+        old, juno.JunoEnviron = juno.JunoEnviron, CountedEnviron
+        try: self.call('GET', '/41/')
+        finally: juno.JunoEnviron = old
+        self.assertEqual(len(made), 1)
+        self.assertTrue(isinstance(environs[-1], CountedEnviron))
+
+    def testNotFoundBodyNotRead(self):
+        """Requests no route takes never have their body read"""
+        body = self.Input(b'a=1')
+        environ = {'REQUEST_METHOD': 'POST', 'PATH_INFO': '/missing/',
+                   'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+                   'CONTENT_LENGTH': '3', 'wsgi.input': body}
+        status = []
+        result = b''.join(application(environ, lambda s, h: status.append(s)))
+        self.assertEqual(status, ['404 Not Found'])
+        self.assertTrue(b'No matching routes registered' in result)
+        self.assertEqual(body.reads, 0)
+        self.assertEqual(juno.getHub().find_route('/missing/', 'POST', None, {}),
+                         (None, None))
+
+    def testRawDicts(self):
+        environ = juno.JunoEnviron({'QUERY_STRING': 'a=1&b=2&b=3', 'REQUEST_METHOD': 'GET'})
+        self.assertFalse('QUERY_DICT' in environ)
+        self.assertEqual(environ['QUERY_DICT'], {'a': ['1'], 'b': ['2', '3']})
+        self.assertEqual(environ.get('POST_DICT'), {})
+        self.assertEqual(environ['input'], {'a': '1', 'b': ['2', '3']})
+        self.assertEqual(environ.get('missing', 'x'), 'x')
+        self.assertRaises(KeyError, lambda: environ['missing'])
+
+    def testCookies(self):
+        status, body, reads = self.call('GET', '/27/',
+                                        HTTP_COOKIE='theme=dark; lang="en"')
+        self.assertEqual(body, b"dark ['lang', 'theme']")
+        status, body, reads = self.call('GET', '/27/')
+        self.assertEqual(body, b'None []')
+
+class FormParserTest(unittest.TestCase):
+    """Test parsing urlencoded and multipart form bodies. """
+    boundary = '----juno1234'
+
+    def multipart(self, *parts):
+        body = b''
+        for headers, data in parts:
+            body += ('--%s\r\n%s\r\n\r\n' %(self.boundary, '\r\n'.join(headers))).encode()
+            body += data + b'\r\n'
+        return body + ('--%s--\r\n' %self.boundary).encode()
+
+    def call(self, body, content_type=None, length=None):
+        if content_type is None:
+            content_type = 'multipart/form-data; boundary=%s' %self.boundary
+        stream = LazyParsingTest.Input(body)
+        environ = {'REQUEST_METHOD': 'POST', 'PATH_INFO': '/28/', 'QUERY_STRING': '',
+                   'CONTENT_TYPE': content_type, 'wsgi.input': stream,
+                   'CONTENT_LENGTH': str(len(body) if length is None else length)}
+        status = []
+        result = b''.join(application(environ, lambda s, h: status.append(s)))
+        return status[0], result, stream.reads
+
+    def testParserFeedAbstract(self):
+        self.assertRaises(TypeError, juno.JunoFormParser, 'utf-8')
+
+    def testMultipart(self):
+        body = self.multipart(
+            (['Content-Disposition: form-data; name="title"'], 'Café'.encode()),
+            (['Content-Disposition: form-data; name="doc"; filename="a b.txt"',
+              'Content-Type: text/plain'], b'line 1\r\n--line 2'),
+            (['Content-Disposition: form-data; name="title"'], b''))
+        status, body, reads = self.call(body)
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(body, "doc=a b.txt:text/plain:line 1\r\n--line 2:16:False "
+                               "title=['Café', '']".encode())
+
+    def testChunked(self):
+        """Parts split across reads at any point are put back together"""
+        body = self.multipart(
+            (['Content-Disposition: form-data; name="a"'], b'x' * 100),
+            (['Content-Disposition: form-data; name="f"; filename="f"'], b'\r\n-' * 50))
+        for size in (1, 2, 7, 41, 64):
+            parser = juno.JunoMultipartParser(self.boundary.encode(), 'utf-8')
+            for n in range(0, len(body), size): parser.feed(body[n:n + size])
+            fields = parser.close()
+            self.assertEqual(fields['a'], ['x' * 100])
+            self.assertEqual(fields['f'][0].value, b'\r\n-' * 50)
+        parser = juno.JunoUrlencodedParser('utf-8')
+        for data in (b'a=1&b=caf', b'%C3%A9+', b'x&a=2', b'&c'): parser.feed(data)
+        self.assertEqual(parser.close(), {'a': ['1', '2'], 'b': ['café x'], 'c': ['']})
+
+    def testSpooling(self):
+        """Uploads over 'upload_spool_size' go to a temporary file"""
+        juno.config('upload_spool_size', 1000)
+        try:
+            status, body, reads = self.call(self.multipart(
+                (['Content-Disposition: form-data; name="f"; filename="big"'], b'y' * 2000)))
+        finally: juno.config('upload_spool_size', 1024 * 1024)
+        self.assertTrue(body.endswith(b':2000:True'))
+
+    def testUploadsClosed(self):
+        """Upload files are closed when the request is over, or the form fails"""
+        del uploads[:]
+        self.call(self.multipart(
+            (['Content-Disposition: form-data; name="f"; filename="f"'], b'y' * 2000)))
+        self.assertTrue(uploads[0].file.closed)
+        parser = juno.JunoMultipartParser(self.boundary.encode(), 'utf-8')
+        parser.feed(self.multipart(
+            (['Content-Disposition: form-data; name="f"; filename="f"'], b'y'))[:-20])
+        upload = parser.part
+        self.assertRaises(juno.JunoRequestError, parser.close)
+        parser.abort()
+        self.assertTrue(upload.file.closed)
+
+    def testUrlencoded(self):
+        status, body, reads = self.call(b'a=1&b=%26', 'application/x-www-form-urlencoded')
+        self.assertEqual(body, b'a=1 b=&')
+
+    def testBodyTooLarge(self):
+        """Bodies over 'max_body_size' are refused before they are read"""
+        juno.config('max_body_size', 100)
+        try: status, body, reads = self.call(b'a=1', length=101)
+        finally: juno.config('max_body_size', 100 * 1024 * 1024)
+        self.assertEqual((status, reads), ('413 Payload Too Large', 0))
+
+    def testLimits(self):
+        juno.config('max_form_parts', 10)
+        try:
+            status, body, reads = self.call(b'&'.join([b'a=1'] * 11),
+                                            'application/x-www-form-urlencoded')
+            self.assertEqual(status, '413 Payload Too Large')
+            status, body, reads = self.call(self.multipart(
+                *[(['Content-Disposition: form-data; name="a"'], b'1')] * 11))
+            self.assertEqual(status, '413 Payload Too Large')
+        finally: juno.config('max_form_parts', 1000)
+        juno.config('max_field_size', 100)
+        try:
+            status, body, reads = self.call(b'a=' + b'x' * 200,
+                                            'application/x-www-form-urlencoded')
+            self.assertEqual(status, '413 Payload Too Large')
+            status, body, reads = self.call(self.multipart(
+                (['Content-Disposition: form-data; name="a"'], b'x' * 200)))
+            self.assertEqual(status, '413 Payload Too Large')
+            # Files aren't fields
+            status, body, reads = self.call(self.multipart(
+                (['Content-Disposition: form-data; name="a"; filename="a"'], b'x' * 200)))
+            self.assertEqual(status, '200 OK')
+        finally: juno.config('max_field_size', 1024 * 1024)
+
+    def testMalformed(self):
+        body = self.multipart((['Content-Disposition: form-data; name="a"'], b'1'))
+        for data, content_type in ((body[:-10], None),
+                                   (body, 'multipart/form-data'),
+                                   (body.replace(b' name="a"', b''), None)):
+            status, result, reads = self.call(data, content_type)
+            self.assertEqual(status, '400 Bad Request')
+            self.assertTrue(result.startswith(b'Incomplete') or result.startswith(b'Multipart')
+                            or result.startswith(b'Form field'))
+
+class JsonTest(unittest.TestCase):
+    """Test decoding JSON requests and returning JSON. """
+    def call(self, method, url, body=b'', content_type='application/json'):
+        environ = {'REQUEST_METHOD': method, 'PATH_INFO': url, 'QUERY_STRING': '',
+                   'CONTENT_TYPE': content_type, 'CONTENT_LENGTH': str(len(body)),
+                   'wsgi.input': io.BytesIO(body)}
+        response = []
+        body = b''.join(application(environ, lambda s, h: response.extend([s, dict(h)])))
+        return response[0], response[1], body
+
+    def testEcho(self):
+        status, headers, body = self.call('POST', '/29/', b'{"a": [1, 2.5, "\xc3\xa9"], "b": {}}')
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(headers['Content-Type'], 'application/json')
+        self.assertEqual(body, '{"a":[1,2.5,"é"],"b":{}}'.encode('utf-8'))
+        self.assertEqual(headers['Content-Length'], str(len(body)))
+
+    def testNotJson(self):
+        status, headers, body = self.call('POST', '/29/', b'a=1',
+                                          'application/x-www-form-urlencoded')
+        self.assertEqual((status, body), ('200 OK', b''))
+        status, headers, body = self.call('POST', '/29/', b'{"a": 1}',
+                                          'application/vnd.api+json')
+        self.assertEqual(body, b'{"a":1}')
+
+    def testInvalid(self):
+        status, headers, body = self.call('POST', '/29/', b'{"a": ')
+        self.assertEqual(status, '400 Bad Request')
+        juno.config('max_json_size', 10)
+        try: status, headers, body = self.call('POST', '/29/', b'{"a": "123456789"}')
+        finally: juno.config('max_json_size', 10 * 1024 * 1024)
+        self.assertEqual(status, '413 Payload Too Large')
+
+    def testList(self):
+        status, headers, body = self.call('GET', '/30/')
+        self.assertEqual(status, '201 Created')
+        self.assertEqual(json.loads(body), [1, 'é', {'a': None}])
+        status, headers, body = self.call('GET', '/31/')
+        self.assertEqual(headers['Content-Type'], 'application/problem+json')
+        self.assertEqual(body, b'{"title":"Problem"}')
+
+    def testEncoders(self):
+        """orjson, if installed, and the json module give the same bytes"""
+        data = {'a': [1, 2.5, 'é', None, True], 1: {'b': ''}, 'big': 2 ** 70}
+        juno.config('use_orjson', False)
+        try: plain = juno.json_dumps(data)
+        finally: juno.config('use_orjson', True)
+        self.assertEqual(juno.json_dumps(data), plain)
+        self.assertEqual(juno.json_loads(plain), json.loads(plain))
+
+class AllocationTest(unittest.TestCase):
+    """Test the memory a request takes, with tracemalloc. """
+    def call(self):
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/8/juno/', 'QUERY_STRING': 'a=1',
+                   'HTTP_USER_AGENT': 'test', 'wsgi.input': io.BytesIO()}
+        return b''.join(application(environ, lambda s, h: None))
+
+    def setUp(self):
+        for n in range(100): self.call()
+        tracemalloc.start()
+
+    def tearDown(self):
+        tracemalloc.stop()
+
+    def testPeakPerRequest(self):
+        """A plain request never holds more than a few KB at once"""
+        peak = 0
+        for n in range(100):
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            self.assertEqual(self.call(), b'word juno')
+            peak = max(peak, tracemalloc.get_traced_memory()[1] - before)
+        self.assertLess(peak, 6000)
+
+    def testNothingKept(self):
+        """Requests don't leave anything behind"""
+        start = tracemalloc.get_traced_memory()[0]
+        for n in range(1000): self.call()
+        self.assertLess(tracemalloc.get_traced_memory()[0] - start, 16000)
+
+    def testSlots(self):
+        """The objects made for every request have no __dict__"""
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/8/juno/', 'QUERY_STRING': ''}
+        juno.prepare_environ(environ)
+        match = juno.getHub().get_route_index().match('/8/juno/', 'GET')
+        for obj in (juno.JunoRequest(environ), juno.JunoResponse(), match.route, match):
+            self.assertRaises(AttributeError, setattr, obj, 'extra', 1)
+
+class SettingsTest(unittest.TestCase):
+    """Test the compiled settings() snapshot. """
+    def testSnapshot(self):
+        settings = juno.settings()
+        self.assertEqual(settings.charset, juno.config('charset'))
+        self.assertEqual(settings.content_type_header, 'text/html; charset=utf-8')
+        self.assertIsNone(settings.no_such_option)
+        self.assertRaises(AttributeError, setattr, settings, 'charset', 'latin-1')
+        # Asking again gives the same snapshot
+        self.assertIs(juno.settings(), settings)
+
+    def testConfigInvalidates(self):
+        """Setting an option with config() recompiles the snapshot"""
+        juno.config('content_type', 'text/plain')
+        try:
+            self.assertEqual(juno.settings().content_type_header,
+                             'text/plain; charset=utf-8')
+            self.assertEqual(juno.JunoResponse()['Content-Type'],
+                             'text/plain; charset=utf-8')
+        finally: juno.config({'content_type': 'text/html'})
+        self.assertEqual(juno.settings().content_type_header, 'text/html; charset=utf-8')
+
+    def testNoConfigLookups(self):
+        """Static files and cached views read the snapshot, not config()"""
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        old_root = juno.config('static_root')
+        juno.config({'static_root': root, 'static_expires': 60})
+        self.addCleanup(juno.config, {'static_root': old_root, 'static_expires': 0})
+        with open(os.path.join(root, 'a.css'), 'w') as f: f.write('a {}')
+        self.assertEqual(juno.settings().static_cache_header, 'public, max-age=60')
+        lookups = []
+        config = juno.config
+        def counting_config(*args):
+            lookups.append(args)
+            return config(*args)
+        juno.config = counting_config
+        try:
+            status, _, body = client.request('/18/a.css', QUERY_STRING='',
+                                             HTTP_COOKIE='theme=dark')
+            client.request('/21/a/')
+        finally:
+            juno.config = config
+            del client.environ['HTTP_COOKIE']
+        self.assertEqual((status, b''.join(body)), ('200 OK', b'a {}'))
+        self.assertEqual(lookups, [])
+
+def installed(module):
+    try: __import__(module)
+    except ImportError: return False
+    return True
+
+class TemplateTestCase(unittest.TestCase):
+    """Sets up templates in a temporary directory. """
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.templates = os.path.join(self.root, 'templates')
+        self.cache_dir = os.path.join(self.root, 'cache')
+        os.makedirs(os.path.join(self.templates, 'parts'))
+        os.mkdir(os.path.join(self.templates, '.svn'))
+        for name in ('a.html', 'b.html', 'parts/c.html', '.a.html.swp', '.svn/x.html'):
+            with open(os.path.join(self.templates, name), 'w') as f: f.write('${x}{{ x }}')
+        self.hub = juno.getHub()
+        self.old = dict((key, self.hub.config.get(key)) for key in
+                        ('template_lib', 'template_root', 'template_mode', 'template_env',
+                         'template_cache_dir', 'template_compile_workers',
+                         'stream_templates', 'template_chunk_size'))
+
+    def tearDown(self):
+        juno.config(self.old)
+        shutil.rmtree(self.root)
+
+    def setup(self, lib, mode, **options):
+        options.setdefault('template_cache_dir', self.cache_dir)
+        options.update({'template_lib': lib, 'template_root': self.templates,
+                        'template_mode': mode})
+        juno.config(options)
+        self.hub.setup_templates()
+        return juno.config('template_env')
+
+class TemplateModeTest(TemplateTestCase):
+    """Test the 'production' template mode. """
+    def testNames(self):
+        juno.config('template_root', self.templates)
+        self.assertEqual(self.hub.template_names(), ['a.html', 'b.html', 'parts/c.html'])
+
+    @unittest.skipUnless(installed('jinja2'), 'needs Jinja2')
+    def testJinja2(self):
+        env = self.setup('jinja2', 'production')
+        self.assertFalse(env.auto_reload)
+        self.assertEqual(len(env.cache), 3)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 3)
+        # A new worker loads them from the cache
+        env = self.setup('jinja2', 'production', template_compile_workers=2)
+        self.assertEqual(len(env.cache), 3)
+        self.assertEqual(env.get_template('parts/c.html').render(x=1), '${x}1')
+
+    @unittest.skipUnless(installed('jinja2') and hasattr(os, 'fork'), 'needs Jinja2')
+    def testParallel(self):
+        env = self.setup('jinja2', 'production', template_compile_workers=3)
+        self.assertEqual(len(env.cache), 3)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 3)
+
+    @unittest.skipUnless(installed('jinja2'), 'needs Jinja2')
+    def testDev(self):
+        env = self.setup('jinja2', 'dev', template_cache_dir=None)
+        self.assertTrue(env.auto_reload)
+        self.assertIsNone(env.bytecode_cache)
+        self.assertEqual(len(env.cache), 0)
+
+    @unittest.skipUnless(installed('jinja2') and hasattr(os, 'getuid'), 'needs Jinja2')
+    def testDefaultCacheDir(self):
+        """The default cache directory is private to the user"""
+        self.setup('jinja2', 'production', template_cache_dir=None)
+        cache_dir = juno.config('template_cache_dir')
+        self.addCleanup(shutil.rmtree, cache_dir)
+        parent = juno.private_tempdir('juno-templates')
+        self.assertEqual(os.path.dirname(cache_dir), parent)
+        self.assertEqual(stat.S_IMODE(os.stat(parent).st_mode), 0o700)
+        self.assertEqual(len(os.listdir(cache_dir)), 3)
+
+    @unittest.skipUnless(installed('mako'), 'needs Mako')
+    def testMako(self):
+        lookup = self.setup('mako', 'production')
+        self.assertFalse(lookup.filesystem_checks)
+        self.assertEqual(sorted(lookup._collection), ['a.html', 'b.html', 'parts/c.html'])
+        self.assertTrue(os.path.exists(os.path.join(self.cache_dir, 'parts', 'c.html.py')))
+
+class StreamingTemplateTest(TemplateTestCase):
+    """Test streaming templates into the response. """
+    rows = {'jinja2': '<head></head>{% for row in rows %}<p>{{ row }}</p>{% endfor %}',
+            'mako': '<head></head>\\\n% for row in rows:\n<p>${row}</p>\\\n% endfor\n'}
+
+    def setup(self, lib, mode='dev', **options):
+        with open(os.path.join(self.templates, 'rows.html'), 'w') as f: f.write(self.rows[lib])
+        return TemplateTestCase.setup(self, lib, mode, **options)
+
+    def expected(self, rows):
+        return ('<head></head>' + ''.join('<p>%d</p>' %n for n in range(rows))).encode()
+
+    def check(self, lib):
+        self.setup(lib, template_chunk_size=100)
+        status, headers, body = client.request('/33/1000/')
+        chunks = list(body)
+        self.assertEqual(b''.join(chunks), self.expected(1000))
+        self.assertTrue(all(len(chunk) >= 100 for chunk in chunks[:-1]))
+        self.assertLess(max(len(chunk) for chunk in chunks), 200)
+        self.assertRaises(Exception, client.get_header, 'Content-Length')
+        # Not buffered: every piece the template engine makes
+        self.setup(lib, template_chunk_size=0)
+        status, headers, body = client.request('/33/10/')
+        self.assertEqual(b''.join(body), self.expected(10))
+
+    @unittest.skipUnless(installed('jinja2'), 'needs Jinja2')
+    def testJinja2(self): self.check('jinja2')
+
+    @unittest.skipUnless(installed('mako'), 'needs Mako')
+    def testMako(self): self.check('mako')
+
+    @unittest.skipUnless(installed('jinja2'), 'needs Jinja2')
+    def testStreamTemplates(self):
+        """'stream_templates' makes template() stream"""
+        self.setup('jinja2')
+        status, headers, body = client.request('/32/3/')
+        self.assertEqual(client.get_header('Content-Length')[1], str(len(self.expected(3))))
+        self.setup('jinja2', stream_templates=True)
+        status, headers, body = client.request('/32/3/')
+        self.assertRaises(Exception, client.get_header, 'Content-Length')
+        self.assertEqual(b''.join(body), self.expected(3))
+
+    @unittest.skipUnless(installed('jinja2'), 'needs Jinja2')
+    def testLazy(self):
+        """The template renders as the body is read"""
+        self.setup('jinja2', template_chunk_size=10)
+        status, headers, body = client.request('/33/1000000000/')
+        self.assertEqual(next(iter(body)), b'<head></head>')
+        body.close()
+
+    @unittest.skipUnless(installed('mako'), 'needs Mako')
+    def testMakoClose(self):
+        """Closing a Mako stream stops its rendering thread"""
+        lookup = self.setup('mako')
+        stream = juno.JunoMakoStream(lookup.get_template('rows.html'), {'rows': range(10 ** 9)}, 4)
+        chunks = iter(stream)
+        self.assertEqual(next(chunks), '<head></head>')
+        threads = threading.active_count()
+        chunks.close()
+        for n in range(30):
+            if threading.active_count() < threads: break
+            time.sleep(0.1)
+        self.assertLess(threading.active_count(), threads)
+
+    @unittest.skipUnless(installed('mako'), 'needs Mako')
+    def testMakoError(self):
+        lookup = self.setup('mako')
+        stream = juno.JunoMakoStream(lookup.get_template('rows.html'), {'rows': None})
+        self.assertRaises(TypeError, list, stream)
+
+class FragmentCacheTest(TemplateTestCase):
+    """Test the template fragment cache. """
+    def setUp(self):
+        TemplateTestCase.setUp(self)
+        self.hub.fragment_cache = None
+        self.renders = 0
+
+    def tearDown(self):
+        TemplateTestCase.tearDown(self)
+        self.hub.fragment_cache = None
+
+    def count(self):
+        self.renders += 1
+        return self.renders
+
+    def write(self, name, source):
+        with open(os.path.join(self.templates, name), 'w') as f: f.write(source)
+
+    def testCache(self):
+        cache = juno.JunoFragmentCache(1000)
+        cache.set('menu', 1, 'x' * 100, 60)
+        cache.set('menu', 2, 'y', -1)
+        self.assertEqual(cache.get('menu', 1), 'x' * 100)
+        self.assertIsNone(cache.get('menu', 2))
+        self.assertIsNone(cache.get('menu', 3))
+        self.assertEqual(cache.stats()['menu'], {'hits': 1, 'misses': 2, 'hit_rate': 1 / 3.0})
+        # Only so much fits; the least recently used entries go
+        for n in range(10): cache.set('list', n, 'z' * 100, 60)
+        self.assertLessEqual(cache.bytes, 1000)
+        self.assertIsNone(cache.get('menu', 1))
+        self.assertEqual(cache.get('list', 9), 'z' * 100)
+        cache.delete('list', 9)
+        self.assertIsNone(cache.get('list', 9))
+        cache.delete('list')
+        self.assertEqual(len(cache.entries), 0)
+
+    def testFunctions(self):
+        render = lambda: 'menu %d' %self.count()
+        self.assertEqual(juno.cache_fragment('menu', [1, 'en'], 60, render), 'menu 1')
+        self.assertEqual(juno.cache_fragment('menu', [1, 'en'], 60, render), 'menu 1')
+        self.assertEqual(juno.cache_fragment('menu', [2, 'en'], 60, render), 'menu 2')
+        juno.invalidate_fragment('menu', [1, 'en'])
+        self.assertEqual(juno.cache_fragment('menu', [1, 'en'], 60, render), 'menu 3')
+        self.assertEqual(juno.fragment_cache_stats()['menu']['hits'], 1)
+
+    @unittest.skipUnless(installed('jinja2'), 'needs Jinja2')
+    def testJinja2(self):
+        self.write('page.html', '<h1>{{ title }}</h1>\n'
+                                '{% cache user %}[{{ count() }}]{% endcache %}\n'
+                                '{% cache "nav", 0 %}({{ count() }}){% endcache %}')
+        self.setup('jinja2', 'dev')
+        t = juno.get_template('page.html')
+        pages = [juno.render_template(t, title=n, user=n % 2, count=self.count)
+                 for n in range(4)]
+        self.assertEqual(pages, ['<h1>0</h1>\n[1]\n(2)', '<h1>1</h1>\n[3]\n(4)',
+                                 '<h1>2</h1>\n[1]\n(5)', '<h1>3</h1>\n[3]\n(6)'])
+        stats = juno.fragment_cache_stats()
+        self.assertEqual(stats['page.html:2'], {'hits': 2, 'misses': 2, 'hit_rate': 0.5})
+        self.assertEqual(stats['page.html:3']['hits'], 0)
+        juno.invalidate_fragment('page.html:2')
+        self.assertIn('[7]', juno.render_template(t, title='', user=0, count=self.count))
+
+    @unittest.skipUnless(installed('jinja2'), 'needs Jinja2')
+    def testRenderTemplate(self):
+        """render_template() caches whole templates with _cache_key"""
+        self.write('page.html', '{{ count() }}')
+        self.setup('jinja2', 'dev')
+        t = juno.get_template('page.html')
+        first = juno.render_template(t, count=self.count, _cache_key='a', _cache_ttl=60)
+        self.assertEqual(juno.render_template(t, count=self.count, _cache_key='a'), first)
+        self.assertEqual(juno.render_template(t, count=self.count), '2')
+        self.assertEqual(juno.fragment_cache_stats()['page.html']['hits'], 1)
+
+    @unittest.skipUnless(installed('mako'), 'needs Mako')
+    def testMako(self):
+        self.write('page.html', '<%block name="side" cached="True" cache_key="${user}" '
+                                'cache_timeout="60">[${count()}]</%block>')
+        self.setup('mako', 'dev')
+        t = juno.get_template('page.html')
+        pages = [juno.render_template(t, user=n % 2, count=self.count) for n in range(4)]
+        self.assertEqual(pages, [b'[1]', b'[2]', b'[1]', b'[2]'])
+        self.assertEqual(juno.fragment_cache_stats()['page.html']['hit_rate'], 0.5)
+
+class ErrorPageTest(TemplateTestCase):
+    """Test 404 and 500 pages. """
+    def setUp(self):
+        TemplateTestCase.setUp(self)
+        self.old_error = dict((key, self.hub.config.get(key)) for key in
+                              ('use_templates', '500_show_traceback', 'log', 'log_rate_limit'))
+        self.hub.error_pages = {}
+
+    def tearDown(self):
+        juno.config(self.old_error)
+        self.hub.error_pages = {}
+        TemplateTestCase.tearDown(self)
+
+    def get(self, url):
+        status, headers, body = client.request(url)
+        return status, b''.join(body).decode('utf-8')
+
+    def write(self, name, source):
+        with open(os.path.join(self.templates, name), 'w') as f: f.write(source)
+
+    def testBuiltinPage(self):
+        """Without templates, Juno's own page is used"""
+        status, body = self.get('/no/such/page/')
+        self.assertEqual(status, '404 Not Found')
+        self.assertIn('<h1>404 Not Found</h1>', body)
+        self.assertIn('No matching routes registered', body)
+        status, body = self.get('/34/')
+        self.assertIn('&lt;script&gt;', body)
+        self.assertNotIn('<script>', body)
+
+    def testServerError(self):
+        status, body = self.get('/35/')
+        self.assertEqual(status, '500 Internal Server Error')
+        self.assertIn('ValueError: &lt;boom&gt;', body)
+        juno.config('500_show_traceback', False)
+        status, body = self.get('/35/')
+        self.assertIn('Unspecified error', body)
+        self.assertNotIn('boom', body)
+
+    def testMarkup(self):
+        class Markup(str):
+            def __html__(self): return self
+        self.assertEqual(juno.escape_error(Markup('<b>x</b>')), '<b>x</b>')
+        self.assertEqual(juno.escape_error('<b>"x"</b>'), '&lt;b&gt;&quot;x&quot;&lt;/b&gt;')
+
+    @unittest.skipUnless(installed('jinja2'), 'needs Jinja2')
+    def testJinja2(self):
+        """The page is rendered once, and again when the template changes"""
+        self.write('404.html', '<h1>Gone</h1><p>{{ error }}</p>')
+        self.setup('jinja2', 'dev', use_templates=True)
+        status, body = self.get('/34/')
+        self.assertEqual((status, body), ('404 Not Found', '<h1>Gone</h1><p>&lt;script&gt;</p>'))
+        self.assertEqual(self.hub.error_pages[404, '404.html'][1], ['<h1>Gone</h1><p>', '</p>'])
+        self.assertEqual(self.get('/no/')[1], '<h1>Gone</h1><p>No matching routes registered</p>')
+        # Templates that change the error are rendered every time
+        time.sleep(1.1)
+        self.write('404.html', '<p>{{ error|upper }}</p>')
+        self.assertEqual(self.get('/34/')[1], '<p>&LT;SCRIPT&GT;</p>')
+        self.assertIsNone(self.hub.error_pages[404, '404.html'][1])
+        # A missing template gets Juno's own page
+        status, body = self.get('/35/')
+        self.assertEqual(status, '500 Internal Server Error')
+        self.assertIn('ValueError: &lt;boom&gt;', body)
+
+    @unittest.skipUnless(installed('mako'), 'needs Mako')
+    def testMako(self):
+        self.write('500.html', '<h1>Oops</h1><pre>${error}</pre>')
+        self.setup('mako', 'dev', use_templates=True)
+        status, body = self.get('/35/')
+        self.assertEqual(status, '500 Internal Server Error')
+        self.assertTrue(body.startswith('<h1>Oops</h1><pre>Traceback'))
+        self.assertTrue(body.endswith('ValueError: &lt;boom&gt;\n</pre>'))
+        self.assertEqual(len(self.hub.error_pages[500, '500.html'][1]), 2)
+
+    def testLogRateLimit(self):
+        limiter = juno.JunoLogLimiter()
+        self.assertEqual([limiter.allow(2) for n in range(4)], [0, 0, None, None])
+        # The next second
+        limiter.second -= 1
+        self.assertEqual(limiter.allow(2), 2)
+        self.assertEqual(limiter.allow(0), 0)
+        juno.config({'log': True, 'log_rate_limit': 3})
+        juno._error_log.second = 0
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = io.StringIO(), io.StringIO()
+        try:
+            for n in range(10): self.get('/no/')
+            logged = sys.stderr.getvalue()
+        finally: sys.stdout, sys.stderr = stdout, stderr
+        self.assertEqual(logged.count('Not Found'), 3)
+
+    def testMissFirstSegment(self):
+        """Urls no route can start with are turned down at once"""
+        index = juno.JunoRouteIndex([juno.JunoRoute('/', None, '*'),
+                                     juno.JunoRoute('/a/b/', None, '*'),
+                                     juno.JunoRoute('/c/w:id/', None, '*')])
+        self.assertEqual(index.heads, set(['', 'a', 'c']))
+        self.assertIsNone(index.match('/wp-admin/setup.php/', 'GET'))
+        self.assertEqual(index.match('/c/1/', 'GET').params, {'id': '1'})
+        index = juno.JunoRouteIndex([juno.JunoRoute('/a/', None, '*'),
+                                     juno.JunoRoute('/w:page/', None, '*')])
+        self.assertIsNone(index.heads)
+        self.assertEqual(index.match('/b/', 'GET').params, {'page': 'b'})
+
+@unittest.skipUnless(installed('sqlalchemy'), 'needs SQLAlchemy')
+class DatabaseTest(unittest.TestCase):
+    """Test request-scoped database sessions. """
+    keys = ('use_db', 'db_type', 'db_location', 'db_pool_size', 'db_max_overflow',
+            'db_pool_recycle', 'db_pool_pre_ping', 'db_engine', 'db_session')
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.hub = juno.getHub()
+        self.old = dict((key, self.hub.config.get(key)) for key in self.keys)
+        juno.config({'use_db': True, 'db_type': 'sqlite',
+                     'db_location': os.path.join(self.root, 'test.db'),
+                     'db_pool_size': 2, 'db_max_overflow': 0,
+                     'db_pool_recycle': 600, 'db_pool_pre_ping': True})
+        self.hub.setup_database()
+        self.Item = juno.model('Item', name='str')
+        self.pool = juno.config('db_engine').pool
+
+    def tearDown(self):
+        juno.config('db_session').remove()
+        juno.config('db_engine').dispose()
+        juno.config(self.old)
+        shutil.rmtree(self.root)
+
+    def count(self):
+        try: return juno.find('Item').count()
+        finally: juno.config('db_session').remove()
+
+    def testPoolOptions(self):
+        self.assertEqual(self.pool.size(), 2)
+        self.assertEqual((self.pool._recycle, self.pool._pre_ping), (600, True))
+
+    def testLazy(self):
+        """Requests that don't use the database never connect"""
+        import sqlalchemy
+        checkouts = []
+        sqlalchemy.event.listen(self.pool, 'checkout', lambda *args: checkouts.append(1))
+        status, _, _ = client.request('/1/')
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(checkouts, [])
+
+    def testCommit(self):
+        status, _, body = client.request('/36/a/')
+        self.assertEqual((status, body), ('200 OK', [b'1']))
+        self.assertEqual(self.pool.checkedout(), 0)
+        self.assertEqual(self.count(), 1)
+
+    def testRollback(self):
+        status, _, _ = client.request('/37/')
+        self.assertEqual(status, '500 Internal Server Error')
+        self.assertEqual(self.pool.checkedout(), 0)
+        self.assertEqual(self.count(), 0)
+
+    def testStream(self):
+        """A streamed response keeps its session until it is done"""
+        client.request('/36/b/')
+        client.request('/36/a/')
+        status, _, body = client.request('/38/')
+        self.assertEqual(next(body), b'a')
+        self.assertEqual(self.pool.checkedout(), 1)
+        self.assertEqual(list(body), [b'b'])
+        self.assertEqual(self.pool.checkedout(), 0)
+
+    def testStreamSession(self):
+        """The stream uses, and commits, its request's session"""
+        status, _, body = client.request('/40/')
+        self.assertEqual(list(body), [b'True', b'done'])
+        self.assertEqual(juno.config('db_session').registry.registry, {})
+        self.assertEqual(self.count(), 1)
+        status, _, body = call_asgi('GET', '/40/')
+        self.assertEqual((status, body), (200, b'Truedone'))
+        self.assertEqual(juno.config('db_session').registry.registry, {})
+        self.assertEqual(self.pool.checkedout(), 0)
+        self.assertEqual(self.count(), 2)
+
+    def testStreamClosedUnread(self):
+        """A stream closed before its first chunk still ends its session"""
+        status, _, body = client.request('/40/')
+        body.close()
+        self.assertEqual(juno.config('db_session').registry.registry, {})
+        # Under ASGI, the client is gone before the response starts
+        async def receive(): return {'type': 'http.request', 'body': b''}
+        async def send(message): raise OSError('disconnected')
+        scope = {'type': 'http', 'method': 'GET', 'path': '/40/',
+                 'query_string': b'', 'headers': []}
+        self.assertRaises(OSError, asyncio.run, asgi_application(scope, receive, send))
+        self.assertEqual(juno.config('db_session').registry.registry, {})
+
+    def testFileWrapper(self):
+        """Static files still go to the server's wsgi.file_wrapper"""
+        from wsgiref.util import FileWrapper
+        old_root = juno.config('static_root')
+        juno.config('static_root', self.root)
+        self.addCleanup(juno.config, 'static_root', old_root)
+        with open(os.path.join(self.root, 'data.bin'), 'wb') as f: f.write(b'x' * 300000)
+        status, _, body = client.request('/18/data.bin', **{'wsgi.file_wrapper': FileWrapper})
+        del client.environ['wsgi.file_wrapper']
+        self.assertTrue(isinstance(body, FileWrapper))
+        self.assertEqual(len(b''.join(body)), 300000)
+        body.close()
+
+    def testAsgi(self):
+        """Plain views run in the thread pool, but in the request's session"""
+        status, _, body = call_asgi('GET', '/36/c/')
+        self.assertEqual((status, body), (200, b'1'))
+        self.assertEqual(self.pool.checkedout(), 0)
+        self.assertEqual(self.count(), 1)
+
+    def testConcurrency(self):
+        """More threads than connections: each request gives its connection back"""
+        results = []
+        def run(n):
+            for i in range(10):
+                status, _, body = Client(application).request('/36/%d/' %n)
+                results.append((status, int(b''.join(body))))
+        threads = [threading.Thread(target=run, args=(n,)) for n in range(8)]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+        self.assertEqual(len(results), 80)
+        self.assertEqual(set(status for status, _ in results), set(['200 OK']))
+        self.assertLessEqual(max(count for _, count in results), 2)
+        self.assertEqual(self.pool.checkedout(), 0)
+        self.assertEqual(self.count(), 80)
+
+class AsgiTest(unittest.TestCase):
+    """Test the ASGI application and async views. """
+
+    def testAsyncView(self):
+        status, headers, body = call_asgi('GET', '/14/abc/')
+        self.assertEqual(status, 200)
+        self.assertEqual(headers[b'x-value'], b'abc')
+        self.assertEqual(body, b'abc')
+
+    def testSyncView(self):
+        """Plain views run in the thread pool"""
+        status, headers, body = call_asgi('GET', '/10/abc/')
+        self.assertEqual((status, body), (200, b'abc'))
+
+    def testBigFormParsedOffLoop(self):
+        """Async views get big forms parsed in the thread pool, small ones lazily"""
+        form = [(b'content-type', b'application/x-www-form-urlencoded')]
+        status, headers, body = call_asgi('POST', '/39/', body=b'a=' + b'x' * 100000,
+                                          headers=form)
+        self.assertEqual((status, body), (200, b'True 100000'))
+        status, headers, body = call_asgi('POST', '/39/', body=b'a=xyz', headers=form)
+        self.assertEqual((status, body), (200, b'False 3'))
+        juno.config('max_field_size', 1000)
+        try:
+            status, headers, body = call_asgi('POST', '/39/', body=b'a=' + b'x' * 100000,
+                                              headers=form)
+        finally: juno.config('max_field_size', 1024 * 1024)
+        self.assertEqual(status, 413)
+
+    def testNotFoundBodyNotRead(self):
+        """Requests no route takes never have their body received"""
+        received = []
+        async def receive():
+            received.append(1)
+            return {'type': 'http.request', 'body': b'a=1'}
+        sent = []
+        async def send(message): sent.append(message)
+        scope = {'type': 'http', 'method': 'POST', 'path': '/missing/', 'headers': []}
+        asyncio.run(asgi_application(scope, receive, send))
+        self.assertEqual(received, [])
+        self.assertEqual(sent[0]['status'], 404)
+        self.assertTrue(b'No matching routes registered' in sent[1]['body'])
+
+    def testBodyTooLarge(self):
+        juno.config('max_body_size', 4)
+        try: status, headers, body = call_asgi('POST', '/15/', body=b'a=123')
+        finally: juno.config('max_body_size', 100 * 1024 * 1024)
+        self.assertEqual((status, body), (413, b'Request body too large\n'))
+
+    def testFormBody(self):
+        status, headers, body = call_asgi('POST', '/15/', body=b'b=2&c=3',
+            headers=[(b'content-type', b'application/x-www-form-urlencoded')])
+        self.assertEqual(body, b"{'b': '2', 'c': '3'}")
+
+    def testConcurrentAsyncViews(self):
+        """Slow async views wait concurrently, and keep their own responses"""
+        async def request(n):
+            sent = []
+            async def receive(): return {'type': 'http.request', 'body': b''}
+            async def send(message): sent.append(message)
+            scope = {'type': 'http', 'method': 'GET', 'path': '/14/%d/' %n}
+            await asgi_application(scope, receive, send)
+            return sent[1]['body']
+        async def main():
+            return await asyncio.gather(*[request(n) for n in range(200)])
+        start = time.time()
+        bodies = asyncio.run(main())
+        self.assertTrue(time.time() - start < 1)
+        self.assertEqual(bodies, [str(n).encode() for n in range(200)])
+
+    def testStreamedBody(self):
+        sent = []
+        async def receive(): return {'type': 'http.request', 'body': b''}
+        async def send(message): sent.append(message)
+        scope = {'type': 'http', 'method': 'GET', 'path': '/16/3/'}
+        asyncio.run(asgi_application(scope, receive, send))
+        self.assertTrue(b'content-length' not in dict(sent[0]['headers']))
+        self.assertEqual([m['body'] for m in sent[1:]],
+                         [b'row 0\n', b'row 1\n', b'row 2\n', b''])
+        self.assertEqual([m.get('more_body') for m in sent[1:]],
+                         [True, True, True, None])
+
+    def testLifespan(self):
+        messages = [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}]
+        sent = []
+        async def receive(): return messages.pop(0)
+        async def send(message): sent.append(message['type'])
+        asyncio.run(asgi_application({'type': 'lifespan'}, receive, send))
+        self.assertEqual(sent, ['lifespan.startup.complete',
+                                'lifespan.shutdown.complete'])
+
+    def testAsyncViewUnderWsgi(self):
+        """Async views also work with the WSGI servers"""
+        status, headers, body = client.request('/14/abc/')
+        self.assertEqual(body, [b'abc'])
+
 
 if __name__ == '__main__':
     unittest.main()